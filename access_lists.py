@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Списки доступа в памяти --------------------
+# whitelist.yaml / banlist.yaml разбираются один раз, проверка доступа - поиск в словаре, без чтения файла.
+# Правки через бота меняют индекс на месте и сразу пишутся на диск; ручная правка файла подхватывается
+# по смене mtime/размера, а сам файл проверяется (os.stat) не чаще раза в ACCESS_RECHECK_INTERVAL
+ACCESS_RECHECK_INTERVAL = 5.0 # сек
+
+
+class UserList:
+    """
+    Пользователи из YAML-файла вида [{id, username}]: индекс id -> запись и username -> id.
+    required - записи, которые всегда должны быть в списке (например, админ в whitelist).
+    """
+    def __init__(self, path: str, required: list[dict] | None = None, recheck_interval: float = ACCESS_RECHECK_INTERVAL):
+        self.path = path
+        self.required = required or []
+        self.recheck_interval = recheck_interval
+        self._users: dict[int, dict] = {}
+        self._by_username: dict[str, int] = {}
+        self._signature: tuple[int, int] | None = None # (mtime_ns, размер) прочитанной или записанной версии файла
+        self._checked_at = float("-inf")
+        self.reloads = 0
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self) -> bool:
+        """Перечитывает файл, если он изменился с последнего чтения или записи (нет файла - создается). True - индекс перестроен."""
+        self._checked_at = time.monotonic()
+        signature = self._stat()
+        if signature is not None and signature == self._signature:
+            return False
+        start_time = time.time()
+        if signature is None:
+            logger.warning(f"Файл {self.path} не найден. Создание нового ({len(self.required)} пользователей).")
+            users = []
+        else:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    users = yaml.safe_load(f) or []
+            except Exception as e:
+                logger.error(f"Ошибка загрузки {self.path}: {e}. Остается прежний список ({len(self._users)} пользователей).", exc_info=True)
+                self._signature = signature # Эту версию файла больше не разбираем, ждем следующей правки
+                return False
+        self._users = {user["id"]: user for user in users}
+        self._by_username = {user["username"]: user_id for user_id, user in self._users.items() if user.get("username")}
+        self._signature = signature
+        self.reloads += 1
+        missing = [user for user in self.required if user["id"] not in self._users]
+        for user in missing:
+            logger.warning(f"{user['username']} ({user['id']}) не найден в {self.path}. Добавляем.")
+            self._set(user["id"], user["username"])
+        if missing or signature is None:
+            self.save()
+        logger.info(f"{self.path} загружен ({len(self._users)} пользователей). Время: {time.time() - start_time:.4f} сек.")
+        return True
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._checked_at >= self.recheck_interval:
+            self.refresh()
+
+    def __contains__(self, user_id: int) -> bool:
+        self._maybe_refresh()
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        self._maybe_refresh()
+        return len(self._users)
+
+    def id_by_username(self, username: str) -> int | None:
+        self._maybe_refresh()
+        return self._by_username.get(username)
+
+    def users(self) -> list[dict]:
+        """Копия списка записей (в порядке файла)."""
+        self._maybe_refresh()
+        return [dict(user) for user in self._users.values()]
+
+    def _set(self, user_id: int, username: str):
+        user = self._users.setdefault(user_id, {"id": user_id})
+        old = user.get("username")
+        if old is not None and self._by_username.get(old) == user_id:
+            del self._by_username[old]
+        user["username"] = username
+        self._by_username[username] = user_id
+
+    def put(self, user_id: int, username: str) -> str | None:
+        """Добавляет пользователя или обновляет его username и сохраняет файл: "added", "updated" или None, если менять нечего."""
+        self.refresh() # Свежая версия файла, чтобы не затереть ручную правку
+        user = self._users.get(user_id)
+        if user is not None and user.get("username") == username:
+            return None
+        self._set(user_id, username)
+        self.save()
+        return "added" if user is None else "updated"
+
+    def remove(self, user_id: int) -> dict | None:
+        """Удаляет пользователя и сохраняет файл. Удаленная запись или None, если его не было."""
+        self.refresh()
+        user = self._users.pop(user_id, None)
+        if user is None:
+            return None
+        if self._by_username.get(user.get("username")) == user_id:
+            del self._by_username[user["username"]]
+        self.save()
+        return user
+
+    def save(self):
+        start_time = time.time()
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                yaml.dump(list(self._users.values()), f, allow_unicode=True)
+            self._signature = self._stat() # Своя запись - не повод перечитывать файл
+            logger.info(f"{self.path} сохранен ({len(self._users)} пользователей). Время: {time.time() - start_time:.4f} сек.")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.path}: {e}. Время: {time.time() - start_time:.4f} сек.")
@@ -0,0 +1,274 @@
+import asyncio
+import inspect
+import logging
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import wraps
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Настройки пула соединений --------------------
+CONNECTION_LIMIT = 100 # Общий лимит одновременных соединений
+CONNECTION_LIMIT_PER_HOST = 30 # Лимит соединений к одному хосту (наш API)
+DNS_CACHE_TTL = 300 # Сколько секунд держим резолв DNS в кэше
+KEEPALIVE_TIMEOUT = 60 # Сколько секунд держим простаивающее соединение открытым
+
+# -------------------- Ограничение частоты и повторы --------------------
+RATE_LIMIT_GLOBAL = (20.0, 40) # Общий лимит исходящих запросов: (запросов в секунду, размер пачки)
+RATE_LIMIT_ENDPOINTS = { # Лимиты отдельных эндпоинтов, тот же формат
+    "candles": (10.0, 20),
+    "close": (5.0, 10),
+    "latest": (10.0, 20),
+}
+RETRY_MAX_ATTEMPTS = 3 # Всего попыток на запрос, включая первую
+RETRY_BACKOFF_BASE = 0.5 # Базовая задержка экспоненциального отката, сек
+RETRY_BACKOFF_MAX = 8.0 # Потолок задержки отката, сек
+RETRY_AFTER_MAX = 30.0 # Больше этого Retry-After не ждем, сек
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity. Ожидающие обслуживаются по очереди."""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.blocked_until = 0.0 # До этого момента (loop.time) токены не выдаются - после Retry-After
+        self._updated: float | None = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        """Забирает один токен, при необходимости дожидаясь его. Возвращает время ожидания, сек."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                self._refill(now)
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return loop.time() - started
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """Приостанавливает выдачу токенов (сервер попросил подождать)."""
+        until = asyncio.get_running_loop().time() + seconds
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class RateLimiter:
+    """Общий ограничитель исходящих запросов: глобальный bucket + bucket на каждый эндпоинт."""
+    def __init__(self, global_limit: tuple[float, int] = RATE_LIMIT_GLOBAL,
+                 endpoint_limits: dict[str, tuple[float, int]] | None = None):
+        self.global_bucket = TokenBucket(*global_limit)
+        self.buckets = {name: TokenBucket(*limit) for name, limit in (endpoint_limits or RATE_LIMIT_ENDPOINTS).items()}
+        self.queued = 0 # Сейчас ждут токен
+        self.throttled = 0 # Всего запросов, которым пришлось ждать
+        self.wait_time = 0.0
+
+    async def acquire(self, endpoint: str):
+        self.queued += 1
+        try:
+            waited = 0.0
+            bucket = self.buckets.get(endpoint)
+            if bucket is not None:
+                waited += await bucket.acquire()
+            waited += await self.global_bucket.acquire()
+        finally:
+            self.queued -= 1
+        if waited > 0.001:
+            self.throttled += 1
+            self.wait_time += waited
+            logger.debug(f"RateLimiter: запрос к {endpoint} ждал токен {waited:.3f} сек.")
+
+    def block(self, endpoint: str, seconds: float):
+        bucket = self.buckets.get(endpoint, self.global_bucket)
+        bucket.block(seconds)
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "throttled": self.throttled, "wait_time": self.wait_time}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After в секундах: либо число, либо HTTP-дата. None, если заголовка нет или он некорректен."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BACKOFF_BASE, cap: float = RETRY_BACKOFF_MAX) -> float:
+    """Экспоненциальный откат с полным джиттером: случайная задержка от 0 до base * 2^(attempt-1)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class _LimitedRequest:
+    """Контекстный менеджер запроса через ограничитель и с повторами (см. ApiClient.get)."""
+    def __init__(self, client: "ApiClient", endpoint: str, url: str, kwargs: dict):
+        self.client = client
+        self.endpoint = endpoint
+        self.url = url
+        self.kwargs = kwargs
+        self._response: aiohttp.ClientResponse | None = None
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        self._response = await self.client._request_with_retries(self.endpoint, self.url, self.kwargs)
+        return self._response
+
+    async def __aexit__(self, *exc_info):
+        if self._response is not None:
+            self._response.release()
+
+
+class ApiClient:
+    """
+    Долгоживущий клиент API OHLCV с общим пулом keep-alive соединений.
+    Создается один раз в main() и используется и main.py, и description.py.
+    """
+    def __init__(self, base_url: str, auth_header: dict,
+                 limit: int = CONNECTION_LIMIT, limit_per_host: int = CONNECTION_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = DNS_CACHE_TTL, keepalive_timeout: int = KEEPALIVE_TIMEOUT,
+                 limiter: RateLimiter | None = None, max_attempts: int = RETRY_MAX_ATTEMPTS):
+        self.base_url = base_url.rstrip("/")
+        self.auth_header = auth_header
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.limiter = limiter or RateLimiter()
+        self.max_attempts = max_attempts
+        self.retried = 0 # Всего повторных попыток
+        self.gave_up = 0 # Запросов, не прошедших за все попытки
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self):
+        """Создает сессию с настроенным коннектором. Должна вызываться внутри работающего event loop."""
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        logger.info(f"API клиент запущен: limit={self.limit}, limit_per_host={self.limit_per_host}, dns_ttl={self.dns_cache_ttl} сек, keepalive={self.keepalive_timeout} сек.")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("API клиент не запущен. Вызовите start() перед использованием.")
+        return self._session
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def get(self, path: str, endpoint: str | None = None, **kwargs):
+        """
+        Возвращает контекстный менеджер запроса GET к API (использовать через async with).
+        С endpoint запрос проходит через ограничитель частоты и повторяется при 429/5xx и таймаутах.
+        """
+        kwargs.setdefault("headers", self.auth_header)
+        if endpoint is None:
+            return self.session.get(self.url(path), **kwargs)
+        return _LimitedRequest(self, endpoint, self.url(path), kwargs)
+
+    async def _request_with_retries(self, endpoint: str, url: str, kwargs: dict) -> aiohttp.ClientResponse:
+        """Последняя попытка возвращает ответ как есть (или пробрасывает исключение) - его разбирает вызывающий."""
+        for attempt in range(1, self.max_attempts + 1):
+            await self.limiter.acquire(endpoint)
+            last_attempt = attempt == self.max_attempts
+            try:
+                response = await self.session.get(url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    self.gave_up += 1
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Запрос {url} (попытка {attempt}/{self.max_attempts}) не удался: {e!r}. Повтор через {delay:.2f} сек.")
+            else:
+                if response.status not in RETRY_STATUSES:
+                    return response
+                if last_attempt:
+                    self.gave_up += 1
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                response.release()
+                if retry_after is not None:
+                    delay = min(retry_after, RETRY_AFTER_MAX)
+                    # Сервер попросил подождать - придерживаем и остальные запросы к этому эндпоинту
+                    self.limiter.block(endpoint, delay)
+                else:
+                    delay = backoff_delay(attempt)
+                logger.warning(f"Запрос {url} (попытка {attempt}/{self.max_attempts}) вернул {response.status}. Повтор через {delay:.2f} сек.")
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {**self.limiter.stats(), "retried": self.retried, "gave_up": self.gave_up}
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Сессия API клиента закрыта.")
+        self._session = None
+
+
+class SingleFlight:
+    """
+    Склеивает одновременные одинаковые запросы: пока запрос с ключом в полете,
+    остальные вызывающие ждут его же результат вместо нового похода в API.
+    """
+    def __init__(self):
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: tuple, func, *args, **kwargs):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.debug(f"SingleFlight: запрос {key} уже выполняется, ждем его результат.")
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    def coalesce(self, endpoint: str):
+        """Декоратор: ключ запроса - (endpoint, все аргументы функции с учетом значений по умолчанию)."""
+        def decorator(func):
+            signature = inspect.signature(func)
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = (endpoint,) + tuple(
+                    value.lower() if name == "symbol" and isinstance(value, str) else value
+                    for name, value in bound.arguments.items()
+                )
+                return await self.do(key, func, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict:
+        return {"started": self.started, "coalesced": self.coalesced, "inflight": len(self._inflight)}
@@ -0,0 +1,321 @@
+"""
+Замеры отрисовки графиков на синтетических свечах, без API и Telegram.
+Таблицы сравнений: python benchmarks.py [--sizes 100 500 1000] [--repeat 5] [--only drawers templates]
+Отчет для сравнения версий: python benchmarks.py --report bench.json [--compare baseline.json] (или .csv)
+"""
+import io
+import sys
+import csv
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import statistics
+
+import matplotlib
+import numpy as np
+import PIL
+from PIL import Image
+
+import charts
+import image_encoding
+import indicators
+import indicator_stream
+from candles import Candles
+from image_encoding import EncodedImage
+
+DEFAULT_SIZES = [100, 500, 1000, 5000]
+DEFAULT_REPEAT = 5
+REPORT_SIZES = [100, 500, 1000, 10_000, 100_000]
+REPORT_TOLERANCE = 0.25 # Допустимый рост метрики относительно базового отчета при --compare
+REPORT_METRICS = ("time_ms", "peak_memory_kb", "bytes") # Сравниваемые метрики: больше - хуже
+# Варианты графиков в отчете сверх charts.RENDERERS: имя -> (рендер, доп. параметры)
+REPORT_VARIANTS = {
+    "ohlcv_indicators": ("ohlcv", {"indicators": ("ema20", "bb20", "vwap", "rsi14")}),
+}
+INDICATOR_SIZES = [1000, 10_000, 100_000] # Размеры по умолчанию для замера индикаторов
+
+
+def synthetic_candles(count: int, seed: int = 42, timeframe_ms: int = 300_000) -> Candles:
+    """Случайное блуждание цены с правдоподобными high/low и объемом."""
+    rng = np.random.default_rng(seed)
+    closes = 30_000 * np.exp(np.cumsum(rng.normal(0, 0.002, count)))
+    opens = np.r_[closes[0], closes[:-1]]
+    spread = np.abs(rng.normal(0, 0.0015, count)) * closes
+    highs = np.maximum(opens, closes) + spread
+    lows = np.minimum(opens, closes) - spread
+    volumes = rng.gamma(2.0, 50.0, count)
+    timestamps = 1_700_000_000_000 + np.arange(count, dtype=np.int64) * timeframe_ms
+    return Candles(timestamps, opens, highs, lows, closes, volumes)
+
+
+def measure(func, repeat: int) -> tuple[float, object]:
+    """Медиана времени вызова (первый прогон не считается - прогрев) и результат последнего вызова."""
+    result = func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def image_difference(image_a: EncodedImage, image_b: EncodedImage) -> float:
+    """Средняя разница пикселей (0..255) двух картинок одного размера."""
+    a = np.asarray(Image.open(io.BytesIO(image_a.data)).convert("RGB"), dtype=np.int16)
+    b = np.asarray(Image.open(io.BytesIO(image_b.data)).convert("RGB"), dtype=np.int16)
+    if a.shape != b.shape:
+        return float("nan")
+    return float(np.abs(a - b).mean())
+
+
+def bench_candle_drawers(sizes: list[int], repeat: int):
+    """vlines + bar против PolyCollection + LineCollection."""
+    print(f"{'свечей':>8} | {'bars, мс':>10} | {'collections, мс':>16} | {'ускорение':>9} | {'разница пикселей':>16}")
+    for size in sizes:
+        candles = synthetic_candles(size)
+        results = {}
+        for drawer in ("bars", "collections"):
+            results[drawer] = measure(lambda: charts.render_ohlcv_png(candles, "BENCH", f"Свечи ({size} шт.)", drawer=drawer), repeat)
+        (bars_time, bars_png), (coll_time, coll_png) = results["bars"], results["collections"]
+        print(f"{size:>8} | {bars_time * 1000:>10.1f} | {coll_time * 1000:>16.1f} | {bars_time / coll_time:>8.1f}x | {image_difference(bars_png, coll_png):>16.2f}")
+
+
+def bench_figure_templates(sizes: list[int], repeat: int):
+    """Новая фигура и стиль на каждый график против заготовок из пула процесса."""
+    print(f"{'график':>8} | {'свечей':>8} | {'новая фигура, мс':>17} | {'заготовка, мс':>14} | {'экономия, мс':>13} | {'разница пикселей':>16}")
+    for kind in ("ohlcv", "close"):
+        render = charts.RENDERERS[kind]
+        for size in sizes:
+            candles = synthetic_candles(size)
+            fresh_time, fresh_png = measure(lambda: render(candles, "BENCH", f"{size}", reuse_figures=False), repeat)
+            reused_time, reused_png = measure(lambda: render(candles, "BENCH", f"{size}", reuse_figures=True), repeat)
+            print(f"{kind:>8} | {size:>8} | {fresh_time * 1000:>17.1f} | {reused_time * 1000:>14.1f} | {(fresh_time - reused_time) * 1000:>13.1f} | {image_difference(fresh_png, reused_png):>16.2f}")
+
+
+def bench_downsampling(sizes: list[int], repeat: int):
+    """Полный ряд против сжатого до MAX_CHART_CANDLES / MAX_CHART_POINTS (LTTB) перед отрисовкой."""
+    limits = {"ohlcv": {"max_candles": charts.MAX_CHART_CANDLES}, "close": {"max_points": charts.MAX_CHART_POINTS}}
+    unlimited = {"ohlcv": {"max_candles": None}, "close": {"max_points": None}}
+    print(f"{'график':>8} | {'точек':>8} | {'все точки, мс':>14} | {'со сжатием, мс':>15} | {'разница пикселей':>16}")
+    for kind in ("ohlcv", "close"):
+        render = charts.RENDERERS[kind]
+        for size in sizes:
+            candles = synthetic_candles(size)
+            full_time, full_png = measure(lambda: render(candles, "BENCH", f"{size}", **unlimited[kind]), repeat)
+            reduced_time, reduced_png = measure(lambda: render(candles, "BENCH", f"{size}", **limits[kind]), repeat)
+            print(f"{kind:>8} | {size:>8} | {full_time * 1000:>14.1f} | {reduced_time * 1000:>15.1f} | {image_difference(full_png, reduced_png):>16.2f}")
+
+
+def peak_memory(func) -> int:
+    """Пик памяти (байт) за вызов по tracemalloc: numpy и Pillow учитываются, внутренние буферы Agg - нет."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_pillow_renderer(sizes: list[int], repeat: int):
+    """Свечной график matplotlib против легкого рендера на Pillow (быстрые графики)."""
+    renderers = {"matplotlib": charts.RENDERERS["ohlcv"], "pillow": charts.RENDERERS["ohlcv_pillow"]}
+    print(f"{'свечей':>8} | {'рендер':>10} | {'время, мс':>10} | {'пик памяти, КБ':>15} | {'PNG, КБ':>8}")
+    for size in sizes:
+        candles = synthetic_candles(size)
+        for name, render in renderers.items():
+            elapsed, image = measure(lambda: render(candles, "BENCH", f"Свечи ({size} шт.)", format="png"), repeat)
+            peak = peak_memory(lambda: render(candles, "BENCH", f"Свечи ({size} шт.)", format="png"))
+            print(f"{size:>8} | {name:>10} | {elapsed * 1000:>10.1f} | {peak / 1024:>15.0f} | {len(image) / 1024:>8.1f}")
+
+
+def bench_encoding(sizes: list[int], repeat: int):
+    """Форматы картинки (image_encoding.FORMATS): размер файла и время кодирования, dpi по числу точек против 100."""
+    print(f"{'график':>12} | {'точек':>8} | {'формат':>11} | {'пиксели':>9} | {'рендер, мс':>10} | {'кодирование, мс':>15} | {'КБ':>6} | {'КБ при 100 dpi':>14}")
+    for kind, render in charts.RENDERERS.items():
+        for size in sizes:
+            candles = synthetic_candles(size)
+            for format in image_encoding.FORMATS:
+                elapsed, image = measure(lambda: render(candles, "BENCH", f"{size}", format=format), repeat)
+                dpi_range, image_encoding.CHART_DPI_RANGE = image_encoding.CHART_DPI_RANGE, (100, 100)
+                try:
+                    fixed = render(candles, "BENCH", f"{size}", format=format)
+                finally:
+                    image_encoding.CHART_DPI_RANGE = dpi_range
+                print(f"{kind:>12} | {size:>8} | {format:>11} | {image.width:>4}x{image.height:<4} | {elapsed * 1000:>10.1f} | "
+                      f"{image.encode_time * 1000:>15.1f} | {len(image) / 1024:>6.1f} | {len(fixed) / 1024:>14.1f}")
+
+
+def run_report(sizes: list[int], repeat: int) -> list[dict]:
+    """Каждый рендер (charts.RENDERERS) x каждый формат x каждый размер ряда: одна строка отчета."""
+    rows = []
+    print(f"{'рендер':>12} | {'точек':>8} | {'формат':>11} | {'время':>12} | {'пик памяти':>10} | {'размер':>13}")
+    variants = {kind: (kind, {}) for kind in charts.RENDERERS} | REPORT_VARIANTS
+    for kind, (renderer, options) in variants.items():
+        render = charts.RENDERERS[renderer]
+        for size in sizes:
+            candles = synthetic_candles(size)
+            for format in image_encoding.FORMATS:
+                call = lambda: render(candles, "BENCH", f"{size}", format=format, **options)
+                elapsed, image = measure(call, repeat)
+                rows.append({
+                    "renderer": kind,
+                    "points": size,
+                    "format": format,
+                    "time_ms": round(elapsed * 1000, 2),
+                    "encode_ms": round(image.encode_time * 1000, 2),
+                    "peak_memory_kb": round(peak_memory(call) / 1024),
+                    "bytes": len(image),
+                    "width": image.width,
+                    "height": image.height,
+                })
+                print(f"{kind:>12} | {size:>8} | {format:>11} | {rows[-1]['time_ms']:>9.1f} мс | {rows[-1]['peak_memory_kb']:>7} КБ | {len(image):>8} байт")
+    return rows
+
+
+def report_meta(repeat: int) -> dict:
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "pillow": PIL.__version__,
+    }
+
+
+def write_report(path: str, rows: list[dict], meta: dict):
+    """JSON (строки и параметры запуска) или CSV (только строки) - по расширению файла."""
+    if path.endswith(".csv"):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": rows}, f, ensure_ascii=False, indent=2)
+
+
+def read_report(path: str) -> list[dict]:
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            return [{k: v if k in ("renderer", "format") else float(v) for k, v in row.items()} for row in csv.DictReader(f)]
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def compare_reports(baseline: list[dict], current: list[dict], tolerance: float = REPORT_TOLERANCE) -> list[str]:
+    """Регрессии: метрики, выросшие больше чем на tolerance относительно базового отчета."""
+    base = {(row["renderer"], int(row["points"]), row["format"]): row for row in baseline}
+    regressions = []
+    print(f"{'рендер':>12} | {'точек':>8} | {'формат':>11} | " + " | ".join(f"{metric:>16}" for metric in REPORT_METRICS))
+    for row in current:
+        old = base.get((row["renderer"], int(row["points"]), row["format"]))
+        if old is None:
+            continue
+        cells = []
+        for metric in REPORT_METRICS:
+            change = row[metric] / old[metric] - 1 if old[metric] else 0.0
+            cells.append(f"{change:>+15.1%}{'!' if change > tolerance else ' '}")
+            if change > tolerance:
+                regressions.append(f"{row['renderer']}/{row['points']}/{row['format']}: {metric} {old[metric]} -> {row[metric]} ({change:+.1%})")
+        print(f"{row['renderer']:>12} | {row['points']:>8} | {row['format']:>11} | " + " | ".join(cells))
+    return regressions
+
+
+def ema_loop(values: np.ndarray, period: int) -> np.ndarray:
+    """EMA циклом по свечам - для сверки и сравнения с indicators.ema (на ряду короче периода - тоже все NaN)."""
+    out = np.full(len(values), np.nan)
+    if len(values) < period:
+        return out
+    alpha = 2.0 / (period + 1)
+    out[period - 1] = previous = values[:period].mean()
+    for i in range(period, len(values)):
+        out[i] = previous = alpha * values[i] + (1 - alpha) * previous
+    return out
+
+
+def bench_indicators(sizes: list[int], repeat: int):
+    """Индикаторы numpy по всему ряду (EMA еще и против цикла) и график с индикаторами против голых свечей."""
+    tokens = ["sma20", "ema20", "ema200", "bb20", "rsi14", "vwap"]
+    print(f"{'свечей':>8} | {'индикатор':>9} | {'numpy, мс':>10} | {'цикл, мс':>9} | {'расхождение':>11}")
+    for size in sizes:
+        candles = synthetic_candles(size)
+        for token in tokens:
+            indicator = indicators.Indicator.parse(token)
+            if indicator.period is not None and indicator.period > size:
+                continue # Ряд короче периода - значений нет, мерить нечего
+            elapsed, values = measure(lambda: indicators.compute(candles, indicator), repeat)
+            loop_cell, diff_cell = "-", "-"
+            if indicator.name == "ema":
+                loop_time, expected = measure(lambda: ema_loop(candles.close, indicator.period), 1)
+                loop_cell, diff_cell = f"{loop_time * 1000:.1f}", f"{np.nanmax(np.abs(values[0] - expected)):.1e}"
+            print(f"{size:>8} | {token:>9} | {elapsed * 1000:>10.2f} | {loop_cell:>9} | {diff_cell:>11}")
+    overlay = ("ema20", "bb20", "vwap", "rsi14")
+    print(f"\n{'свечей':>8} | {'свечи, мс':>10} | {'+ ' + ' '.join(overlay) + ', мс':>30}")
+    for size in sizes:
+        candles = synthetic_candles(size)
+        plain_time, _ = measure(lambda: charts.render_ohlcv_png(candles, "BENCH", f"{size}"), repeat)
+        overlay_time, _ = measure(lambda: charts.render_ohlcv_png(candles, "BENCH", f"{size}", indicators=overlay), repeat)
+        print(f"{size:>8} | {plain_time * 1000:>10.1f} | {overlay_time * 1000:>30.1f}")
+
+
+STREAM_STEPS = 1000 # Свечей, добавляемых в поток по одной (время - среднее на свечу)
+
+
+def bench_indicator_streams(sizes: list[int], repeat: int):
+    """Новая закрытая свеча: шаг потокового состояния против пересчета индикатора по всему окну."""
+    tokens = ["sma20", "ema20", "bb20", "rsi14", "vwap"]
+    print(f"{'свечей':>8} | {'индикатор':>9} | {'пересчет, мс':>12} | {'поток, мкс':>10} | {'расхождение':>11}")
+    for size in sizes:
+        candles = synthetic_candles(size)
+        steps = min(STREAM_STEPS, size // 2)
+        history, new = candles[:-steps], candles[-steps:]
+        for token in tokens:
+            indicator = indicators.Indicator.parse(token)
+            full_time, expected = measure(lambda: indicators.compute(candles, indicator), repeat)
+            stream = indicator_stream.IndicatorStream(indicator, 60_000, history)
+            start = time.perf_counter()
+            stream.extend(new)
+            step_time = (time.perf_counter() - start) / steps
+            diff = max(abs(value - line[-1]) for value, line in zip(stream.latest(), expected))
+            print(f"{size:>8} | {token:>9} | {full_time * 1000:>12.2f} | {step_time * 1e6:>10.1f} | {diff:>11.1e}")
+
+
+BENCHMARKS = {
+    "drawers": bench_candle_drawers,
+    "templates": bench_figure_templates,
+    "downsample": bench_downsampling,
+    "pillow": bench_pillow_renderer,
+    "encoding": bench_encoding,
+    "indicators": bench_indicators,
+    "indicator_streams": bench_indicator_streams,
+}
+BENCHMARK_SIZES = {"indicators": INDICATOR_SIZES, "indicator_streams": INDICATOR_SIZES} # Свои размеры по умолчанию (если не задан --sizes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры отрисовки графиков")
+    parser.add_argument("--sizes", type=int, nargs="+", help=f"размеры рядов (по умолчанию {DEFAULT_SIZES}, для отчета {REPORT_SIZES})")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--only", choices=list(BENCHMARKS), nargs="+", help="какие замеры запускать (по умолчанию все)")
+    parser.add_argument("--report", metavar="PATH", help="вместо таблиц записать отчет по всем рендерам и форматам (.json или .csv)")
+    parser.add_argument("--compare", metavar="BASELINE", help="сравнить отчет с базовым; код выхода 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=REPORT_TOLERANCE, help="допустимый рост метрики при --compare (доля)")
+    args = parser.parse_args()
+    if args.report or args.compare:
+        rows = run_report(args.sizes or REPORT_SIZES, args.repeat)
+        if args.report:
+            write_report(args.report, rows, report_meta(args.repeat))
+            print(f"Отчет записан: {args.report}")
+        if args.compare:
+            regressions = compare_reports(read_report(args.compare), rows, args.tolerance)
+            for line in regressions:
+                print(f"Регрессия: {line}")
+            sys.exit(1 if regressions else 0)
+    else:
+        for name in args.only or BENCHMARKS:
+            print(f"\n== {name}: {BENCHMARKS[name].__doc__}")
+            BENCHMARKS[name](args.sizes or BENCHMARK_SIZES.get(name, DEFAULT_SIZES), args.repeat)
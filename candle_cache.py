@@ -0,0 +1,419 @@
+import time
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+
+from candles import Candles
+from indicator_stream import IndicatorStreams
+from indicators import Indicator
+from resample import can_resample, resample_ohlcv
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Настройки хранилища свечей --------------------
+MAX_CACHED_CANDLES = 100_000 # Общий лимит свечей во всех рядах (48 байт на свечу в колонках)
+API_MAX_LIMIT = 1000 # Больше свечей за один запрос API не отдает
+RANGE_FETCH_CONCURRENCY = 4 # Сколько кусков одного длинного диапазона качаем параллельно
+API_PUBLISH_LAG_MS = 60_000 # Сколько после закрытия свеча может еще не появиться в API (короткому ответу у свежего края не верим)
+MAX_RESAMPLE_BASE_CANDLES = 25_000 # Больше базовых свечей ради одного графика не собираем (120 мин x 500 из 5 мин = 12000)
+
+
+def timeframe_to_ms(timeframe: str) -> int | None:
+    """Переводит таймфрейм (минуты или D) в миллисекунды. Возвращает None для неизвестных таймфреймов."""
+    tf = str(timeframe).strip().upper()
+    if tf == "D":
+        return 86_400_000
+    if tf.isdigit() and int(tf) > 0:
+        return int(tf) * 60_000
+    return None
+
+
+def next_candle_close_ms(timeframe_ms: int, now_ms: int) -> int:
+    """Время (UTC, мс) закрытия текущей свечи, т.е. ближайшая граница таймфрейма после now_ms."""
+    return (now_ms // timeframe_ms + 1) * timeframe_ms
+
+
+def count_candles_in_range(timeframe: str, start_ts: int, end_ts: int) -> int | None:
+    """Сколько свечей таймфрейма попадает в диапазон [start_ts, end_ts]. None для неизвестного таймфрейма."""
+    tf_ms = timeframe_to_ms(timeframe)
+    if tf_ms is None:
+        return None
+    first = -(-start_ts // tf_ms) * tf_ms
+    last = end_ts // tf_ms * tf_ms
+    return max(0, (last - first) // tf_ms + 1)
+
+
+def merge_intervals(intervals: list[tuple[int, int]], step: int) -> list[tuple[int, int]]:
+    """Сливает пересекающиеся и стыкующиеся (через один шаг таймфрейма) интервалы [start, end]."""
+    if not intervals:
+        return []
+    intervals = sorted(intervals)
+    merged = [intervals[0]]
+    for a, b in intervals[1:]:
+        last_a, last_b = merged[-1]
+        if a <= last_b + step:
+            merged[-1] = (last_a, max(last_b, b))
+        else:
+            merged.append((a, b))
+    return merged
+
+
+def subtract_intervals(start: int, end: int, covered: list[tuple[int, int]], step: int) -> list[tuple[int, int]]:
+    """Части [start, end], не покрытые отсортированными интервалами covered."""
+    gaps = []
+    cursor = start
+    for a, b in covered:
+        if b < cursor:
+            continue
+        if a > end:
+            break
+        if a > cursor:
+            gaps.append((cursor, a - step))
+        cursor = max(cursor, b + step)
+        if cursor > end:
+            break
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def split_into_chunks(start: int, end: int, timeframe_ms: int, chunk_size: int = API_MAX_LIMIT) -> list[tuple[int, int, int]]:
+    """Режет выровненный интервал [start, end] на куски (start, end, кол-во свечей) не больше chunk_size свечей."""
+    chunks = []
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + (chunk_size - 1) * timeframe_ms, end)
+        chunks.append((chunk_start, chunk_end, (chunk_end - chunk_start) // timeframe_ms + 1))
+        chunk_start = chunk_end + timeframe_ms
+    return chunks
+
+
+class CandleSeries:
+    """
+    Ряд свечей одной пары и таймфрейма + множество покрытых интервалов.
+    В covered лежат только закрытые свечи (они уже не меняются), текущая свеча
+    считается покрытой до своего закрытия (forming_expires).
+    """
+    __slots__ = ("timeframe_ms", "candles", "covered", "forming_ts", "forming_expires", "revised_from")
+
+    def __init__(self, timeframe_ms: int):
+        self.timeframe_ms = timeframe_ms
+        self.candles = Candles.empty()
+        self.covered: list[tuple[int, int]] = [] # Отсортированные непересекающиеся [start, end] включительно
+        self.forming_ts: int | None = None
+        self.forming_expires = 0
+        self.revised_from: int | None = None # Самая ранняя метка среди свечей, влитых с последнего уведомления потоков индикаторов
+
+    def __len__(self):
+        return len(self.candles)
+
+    def missing(self, start: int, end: int, now_ms: int) -> list[tuple[int, int]]:
+        """Интервалы [start, end] (выровненные по таймфрейму), которых нет в ряду."""
+        step = self.timeframe_ms
+        gaps = subtract_intervals(start, end, self.covered, step)
+
+        # Текущая свеча не входит в covered, но свежий снимок ее можно отдавать до закрытия
+        if gaps and self.forming_ts is not None and now_ms < self.forming_expires:
+            a, b = gaps[-1]
+            if b == self.forming_ts:
+                gaps[-1] = (a, b - step)
+                if gaps[-1][0] > gaps[-1][1]:
+                    gaps.pop()
+        return gaps
+
+    def _merge(self, candles: Candles):
+        self.candles = self.candles.merge(candles)
+        if len(candles):
+            first_ts = int(candles.timestamp[0])
+            self.revised_from = first_ts if self.revised_from is None else min(self.revised_from, first_ts)
+
+    def add_closed(self, candles: Candles, start: int, end: int):
+        """Вливает заведомо закрытые свечи интервала [start, end] (например, с диска) и отмечает его покрытым."""
+        self._merge(candles)
+        self._mark_covered(start, end)
+
+    def add(self, candles: Candles, gap_start: int, gap_end: int, requested_limit: int, now_ms: int) -> tuple[int, int] | None:
+        """
+        Вливает ответ API на запрос интервала [gap_start, gap_end] и отмечает покрытие.
+        Возвращает интервал закрытых свечей, который стал покрытым (или None).
+        """
+        step = self.timeframe_ms
+        current_open = now_ms // step * step
+        self._merge(candles)
+
+        # Если API вернуло меньше, чем просили, то в остатке интервала данных просто нет - но только
+        # если конец интервала закрылся давно: свежую закрытую свечу биржа может еще не опубликовать
+        if len(candles) < requested_limit and gap_end + step + API_PUBLISH_LAG_MS <= now_ms:
+            answered_end = gap_end
+        elif len(candles):
+            answered_end = int(candles.timestamp[-1])
+        else:
+            return None
+        closed_end = min(answered_end, current_open - step)
+        if answered_end >= current_open and len(candles) and int(candles.timestamp[-1]) == current_open:
+            self.forming_ts = current_open
+            self.forming_expires = next_candle_close_ms(step, now_ms)
+        if closed_end >= gap_start:
+            self._mark_covered(gap_start, closed_end)
+            return gap_start, closed_end
+        return None
+
+    def _mark_covered(self, start: int, end: int):
+        self.covered = merge_intervals(self.covered + [(start, end)], self.timeframe_ms)
+
+    def window(self, start: int, end: int) -> Candles:
+        return self.candles.window(start, end)
+
+    def trim(self, max_candles: int) -> int:
+        """Обрезает самые старые свечи сверх лимита. Возвращает число удаленных."""
+        extra = len(self.candles) - max_candles
+        if extra <= 0:
+            return 0
+        self.candles = self.candles[extra:]
+        first_ts = int(self.candles.timestamp[0]) if len(self.candles) else None
+        if first_ts is None:
+            self.covered = []
+        else:
+            self.covered = [(max(a, first_ts), b) for a, b in self.covered if b >= first_ts]
+        return extra
+
+
+class CandleStore:
+    """
+    Хранилище свечей по ключу (symbol, timeframe) с индексом покрытия.
+    На запрос любого окна докачивает из API только недостающие интервалы
+    (обычно несколько новых свечей или края диапазона), ряды вытесняются по LRU.
+    """
+    def __init__(self, max_candles: int = MAX_CACHED_CANDLES, fetch_concurrency: int = RANGE_FETCH_CONCURRENCY, disk=None):
+        self.max_candles = max_candles
+        self.fetch_concurrency = fetch_concurrency
+        self.disk = disk # Второй уровень (disk_cache.DiskCandleStore) или None
+        self.indicators = IndicatorStreams() # Потоковые индикаторы по рядам хранилища
+        self._series: OrderedDict[tuple[str, str], CandleSeries] = OrderedDict()
+        self._locks: weakref.WeakValueDictionary[tuple[str, str], asyncio.Lock] = weakref.WeakValueDictionary() # Докачка одного ряда - по очереди
+        self._total_candles = 0
+        self.hits = 0 # Ответ целиком из хранилища
+        self.partial_hits = 0 # Докачаны только недостающие интервалы
+        self.disk_hits = 0 # Недостающие интервалы (целиком или частично) подняты с диска
+        self.misses = 0 # Окно пришлось качать целиком
+        self.evictions = 0
+        self.candles_fetched = 0
+        self.candles_served = 0
+        self.resampled = 0 # Ответы, собранные из более мелкого таймфрейма
+
+    @staticmethod
+    def _key(symbol: str, timeframe: str) -> tuple[str, str]:
+        return symbol.lower(), str(timeframe)
+
+    @staticmethod
+    def request_window(timeframe_ms: int, limit: int, start_ts: int | None, end_ts: int | None, now_ms: int) -> tuple[int, int]:
+        """Выровненное по таймфрейму окно [start, end], которое покрывает запрос."""
+        current_open = now_ms // timeframe_ms * timeframe_ms
+        if start_ts is None and end_ts is None:
+            return current_open - (limit - 1) * timeframe_ms, current_open
+        end = current_open if end_ts is None else min(end_ts // timeframe_ms * timeframe_ms, current_open)
+        start = end - (limit - 1) * timeframe_ms if start_ts is None else -(-start_ts // timeframe_ms) * timeframe_ms
+        return start, end
+
+    async def get_candles(self, symbol: str, timeframe: str, limit: int, start_ts: int | None, end_ts: int | None, fetch) -> Candles | None:
+        """
+        Возвращает свечи для запроса, докачивая через fetch(symbol, timeframe, limit=, start_ts=, end_ts=) только пробелы.
+        Пробелы длиннее лимита API режутся на куски и качаются параллельно (не больше fetch_concurrency одновременно).
+        None - если API не смогло отдать какой-то из недостающих интервалов.
+        """
+        tf_ms = timeframe_to_ms(timeframe)
+        if tf_ms is None:
+            logger.warning(f"Неизвестный таймфрейм '{timeframe}', хранилище свечей не используется.")
+            return await fetch(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
+
+        key = self._key(symbol, timeframe)
+        # Параллельные запросы одного ряда ждут друг друга: второй найдет докачанное первым и не пойдет в API
+        async with self._lock(key):
+            return await self._get_locked(key, symbol, timeframe, tf_ms, limit, start_ts, end_ts, fetch)
+
+    def _lock(self, key: tuple[str, str]) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def _get_locked(self, key: tuple[str, str], symbol: str, timeframe: str, tf_ms: int, limit: int, start_ts: int | None, end_ts: int | None, fetch) -> Candles | None:
+        now_ms = int(time.time() * 1000)
+        series = self._series.get(key)
+        if series is None:
+            series = CandleSeries(tf_ms)
+            self._series[key] = series
+        self._series.move_to_end(key)
+
+        start, end = self.request_window(tf_ms, limit, start_ts, end_ts, now_ms)
+        if start > end:
+            return Candles.empty()
+        gaps = series.missing(start, end, now_ms)
+        if gaps and self.disk is not None:
+            loaded = 0
+            # Чтение memmap - в потоке, чтобы не держать цикл событий
+            parts = await asyncio.to_thread(self.disk.read_covered_many, symbol, timeframe, gaps)
+            for part_start, part_end, candles in parts:
+                series.add_closed(candles, part_start, part_end)
+                loaded += len(candles)
+            if loaded:
+                self.disk_hits += 1
+                gaps = series.missing(start, end, now_ms)
+        if gaps:
+            chunks = [chunk for a, b in gaps for chunk in split_into_chunks(a, b, tf_ms)]
+            logger.info(f"Хранилище свечей {key}: докачка {len(gaps)} интервалов ({sum(c[2] for c in chunks)} свечей, {len(chunks)} запросов) для окна {start}-{end}.")
+            semaphore = asyncio.Semaphore(self.fetch_concurrency)
+
+            async def fetch_chunk(chunk_start: int, chunk_end: int, chunk_limit: int):
+                async with semaphore:
+                    return await fetch(symbol, timeframe, limit=chunk_limit, start_ts=chunk_start, end_ts=chunk_end)
+
+            results = await asyncio.gather(*[fetch_chunk(*chunk) for chunk in chunks])
+            # Успешные куски сохраняем даже при частичной ошибке, чтобы не качать их повторно
+            to_disk = []
+            for (chunk_start, chunk_end, chunk_limit), data in zip(chunks, results):
+                if data is not None:
+                    closed = series.add(data, chunk_start, chunk_end, chunk_limit, now_ms)
+                    self.candles_fetched += len(data)
+                    if closed is not None:
+                        to_disk.append((data.window(*closed), *closed))
+            if to_disk and self.disk is not None:
+                # Дозапись и пересборка файлов - в потоке; ряд заперт, так что запись одного ряда не пересекается с чтением
+                await asyncio.to_thread(self.disk.write_many, symbol, timeframe, to_disk)
+            self._series_grew(key, series)
+            if gaps == [(start, end)]:
+                self.misses += 1
+            else:
+                self.partial_hits += 1
+            if any(data is None for data in results):
+                logger.error(f"Хранилище свечей {key}: не удалось докачать {sum(data is None for data in results)} из {len(chunks)} кусков.")
+                return None
+        else:
+            self.hits += 1
+            self._series_grew(key, series)
+
+        window = series.window(start, end)
+        result = window[-limit:] if start_ts is None else window[:limit]
+        self.candles_served += len(result)
+        return result
+
+    def _series_grew(self, key: tuple[str, str], series: CandleSeries):
+        """После вливания свечей: ряд снова в хранилище (его могли вытеснить, пока шла докачка), пересчет объема, вытеснение."""
+        self._series[key] = series
+        self._series.move_to_end(key)
+        self._total_candles = sum(len(cached) for cached in self._series.values())
+        self._evict(key)
+        self._series_changed(key, series)
+
+    def _base_window(self, timeframe_ms: int, base_timeframe_ms: int, limit: int, start_ts: int | None, end_ts: int | None, now_ms: int) -> tuple[int, int]:
+        """Окно базовых свечей, из которого собирается окно крупного таймфрейма."""
+        start, end = self.request_window(timeframe_ms, limit, start_ts, end_ts, now_ms)
+        base_end = min(end + timeframe_ms - base_timeframe_ms, now_ms // base_timeframe_ms * base_timeframe_ms)
+        return start, base_end
+
+    def pick_base_timeframe(self, symbol: str, timeframe: str, limit: int, start_ts: int | None, end_ts: int | None, hot_base_timeframe: str | None = None) -> str | None:
+        """
+        Базовый таймфрейм, из которого можно собрать запрос: hot_base_timeframe (для горячих пар качаем
+        только его) или самый крупный уже закэшированный ряд той же пары, полностью покрывающий окно.
+        """
+        tf_ms = timeframe_to_ms(timeframe)
+        if tf_ms is None:
+            return None
+        now_ms = int(time.time() * 1000)
+
+        def fits(base_ms: int) -> bool:
+            if not can_resample(base_ms, tf_ms):
+                return False
+            start, base_end = self._base_window(tf_ms, base_ms, limit, start_ts, end_ts, now_ms)
+            return (base_end - start) // base_ms + 1 <= MAX_RESAMPLE_BASE_CANDLES
+
+        if hot_base_timeframe is not None:
+            base_ms = timeframe_to_ms(hot_base_timeframe)
+            if base_ms is not None and fits(base_ms):
+                return hot_base_timeframe
+
+        best = None
+        for (cached_symbol, cached_tf), series in self._series.items():
+            if cached_symbol != symbol.lower() or not fits(series.timeframe_ms):
+                continue
+            start, base_end = self._base_window(tf_ms, series.timeframe_ms, limit, start_ts, end_ts, now_ms)
+            if series.missing(start, base_end, now_ms):
+                continue
+            if best is None or series.timeframe_ms > best[1]:
+                best = (cached_tf, series.timeframe_ms)
+        return best[0] if best else None
+
+    async def get_resampled(self, symbol: str, timeframe: str, base_timeframe: str, limit: int, start_ts: int | None, end_ts: int | None, fetch) -> Candles | None:
+        """Отдает свечи таймфрейма timeframe, собранные из ряда base_timeframe (докачиваемого как обычно)."""
+        tf_ms = timeframe_to_ms(timeframe)
+        base_ms = timeframe_to_ms(base_timeframe)
+        now_ms = int(time.time() * 1000)
+        start, base_end = self._base_window(tf_ms, base_ms, limit, start_ts, end_ts, now_ms)
+        if start > base_end:
+            return Candles.empty()
+        base_limit = (base_end - start) // base_ms + 1
+        base = await self.get_candles(symbol, base_timeframe, base_limit, start, base_end, fetch)
+        if base is None:
+            return None
+        resampled = resample_ohlcv(base, tf_ms)
+        self.resampled += 1
+        logger.info(f"Хранилище свечей: {symbol}/{timeframe} собрано из {len(base)} свечей {base_timeframe} -> {len(resampled)} свечей.")
+        return resampled[-limit:] if start_ts is None else resampled[:limit]
+
+    def _series_changed(self, key: tuple[str, str], series: CandleSeries):
+        """Новые свечи ряда - в потоки индикаторов (продолжение по одной свече или сброс при правке истории)."""
+        if series.revised_from is not None:
+            self.indicators.on_series_update(key, series, series.revised_from)
+            series.revised_from = None
+
+    async def indicator_values(self, symbol: str, timeframe: str, indicator: Indicator, candles: Candles):
+        """
+        Значения индикатора на candles (выдача этого же хранилища) из потока ряда, без пересчета по окну.
+        None, если ряда нет (например, таймфрейм собран из мелкого) или поток не покрывает свечи.
+        Под блокировкой ряда: пока поток строится в отдельном потоке, докачка не меняет ряд.
+        """
+        key = self._key(symbol, timeframe)
+        async with self._lock(key):
+            series = self._series.get(key)
+            if series is None:
+                return None
+            return await self.indicators.values(key, series, indicator, candles)
+
+    def indicator_latest(self, symbol: str, timeframe: str, indicator: Indicator) -> tuple[float, ...] | None:
+        """Значения индикатора на последней закрытой свече ряда, O(1) (если поток уже есть)."""
+        return self.indicators.latest(self._key(symbol, timeframe), indicator)
+
+    def _evict(self, current_key: tuple[str, str]):
+        series = self._series.get(current_key)
+        if series is not None:
+            removed = series.trim(self.max_candles)
+            self._total_candles -= removed
+        while self._total_candles > self.max_candles and len(self._series) > 1:
+            key, evicted = self._series.popitem(last=False)
+            self.indicators.drop(key)
+            self._total_candles -= len(evicted)
+            self.evictions += 1
+            logger.info(f"Хранилище свечей: вытеснен ряд {key} ({len(evicted)} свечей)")
+
+    def clear(self):
+        self._series.clear()
+        self.indicators.clear()
+        self._total_candles = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.partial_hits + self.misses
+        return {
+            "series": len(self._series),
+            "candles": self._total_candles,
+            "max_candles": self.max_candles,
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "candles_fetched": self.candles_fetched,
+            "candles_served": self.candles_served,
+            "resampled": self.resampled,
+        }
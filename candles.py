@@ -0,0 +1,124 @@
+from collections.abc import Sequence
+import numpy as np
+
+# Поля свечи в порядке колонок
+FIELDS = ("timestamp", "open", "high", "low", "close", "volume")
+PRICE_FIELDS = FIELDS[1:]
+
+
+class Candles:
+    """
+    Свечи в колоночном виде: timestamp (int64, мс UTC) и OHLCV (float64) - непрерывные numpy массивы.
+    Собирается один раз при разборе ответа API и дальше проходит через кэш и графики без list[dict].
+    Срез по индексу (candles[a:b]) возвращает Candles поверх тех же массивов, без копирования.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, timestamp, open, high, low, close, volume):
+        self.timestamp = np.asarray(timestamp, dtype=np.int64)
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+
+    @classmethod
+    def empty(cls) -> "Candles":
+        return cls(*([] for _ in FIELDS))
+
+    @classmethod
+    def from_json(cls, data: list[dict]) -> "Candles":
+        """Разбор ответа API (список словарей) за один проход. Отсутствующие поля считаются нулями."""
+        if not data:
+            return cls.empty()
+        # Метки времени в мс меньше 2^53, поэтому через float64 проходят без потерь
+        rows = np.array([tuple(c.get(name, 0) or 0 for name in FIELDS) for c in data], dtype=np.float64)
+        return cls(rows[:, 0].astype(np.int64), *(np.ascontiguousarray(rows[:, i]) for i in range(1, len(FIELDS))))
+
+    @classmethod
+    def concat(cls, parts: list["Candles"]) -> "Candles":
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls.empty()
+        if len(parts) == 1:
+            return parts[0]
+        return cls(*(np.concatenate([getattr(p, name) for p in parts]) for name in FIELDS))
+
+    def columns(self) -> dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or isinstance(index, np.ndarray):
+            return Candles(*(getattr(self, name)[index] for name in FIELDS))
+        return self.row(index)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return "Candles(0)"
+        return f"Candles({len(self)}, {int(self.timestamp[0])}..{int(self.timestamp[-1])})"
+
+    def row(self, index: int) -> dict:
+        return {name: getattr(self, name)[index].item() for name in FIELDS}
+
+    @property
+    def rows(self) -> "CandleRows":
+        """Ленивое представление в старом виде list[dict]: словарь собирается только при обращении к свече."""
+        return CandleRows(self)
+
+    def to_dicts(self) -> list[dict]:
+        """Полная копия в виде list[dict] (для JSON и т.п.)."""
+        columns = [getattr(self, name).tolist() for name in FIELDS]
+        return [dict(zip(FIELDS, row)) for row in zip(*columns)]
+
+    def window(self, start: int, end: int) -> "Candles":
+        """Свечи с меткой времени в [start, end] (ряд отсортирован по времени)."""
+        lo = int(np.searchsorted(self.timestamp, start, side="left"))
+        hi = int(np.searchsorted(self.timestamp, end, side="right"))
+        return self[lo:hi]
+
+    def merge(self, newer: "Candles") -> "Candles":
+        """Объединение с сортировкой по времени; при совпадении меток побеждают свечи из newer."""
+        if not len(newer):
+            return self
+        if not len(self):
+            return newer.sorted()
+        if newer.timestamp[0] > self.timestamp[-1] and np.all(np.diff(newer.timestamp) > 0):
+            # Обычный случай: пришли только более новые свечи
+            return Candles.concat([self, newer])
+        keep = ~np.isin(self.timestamp, newer.timestamp)
+        return Candles.concat([self[keep], newer]).sorted()
+
+    def sorted(self) -> "Candles":
+        """Отсортированная копия без дублей меток времени (из дублей остается последний)."""
+        order = np.argsort(self.timestamp, kind="stable")
+        ts = self.timestamp[order]
+        unique = np.r_[ts[1:] != ts[:-1], True]
+        if unique.all() and np.array_equal(order, np.arange(len(order))):
+            return self
+        return self[order[unique]]
+
+
+class CandleRows(Sequence):
+    """list[dict]-подобное представление Candles для кода, которому нужен старый формат."""
+    __slots__ = ("candles",)
+
+    def __init__(self, candles: Candles):
+        self.candles = candles
+
+    def __len__(self) -> int:
+        return len(self.candles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CandleRows(self.candles[index])
+        if index < 0:
+            index += len(self.candles)
+        if not 0 <= index < len(self.candles):
+            raise IndexError("индекс свечи вне диапазона")
+        return self.candles.row(index)
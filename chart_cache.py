@@ -0,0 +1,140 @@
+import time
+import logging
+from collections import OrderedDict
+
+from candle_cache import timeframe_to_ms
+from candles import Candles
+from image_encoding import EncodedImage
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Настройки кэша графиков --------------------
+MAX_CHART_CACHE_BYTES = 32 * 1024 * 1024 # Лимит на картинки в памяти (после отправки остается только file_id)
+
+
+class CachedChart:
+    """Готовый график: картинка до первой отправки, после нее - file_id Telegram (повторная загрузка не нужна)."""
+    __slots__ = ("key", "data", "filename", "file_id", "expires_at")
+
+    def __init__(self, key: tuple, data: bytes, filename: str, expires_at: int | None):
+        self.key = key
+        self.data: bytes | None = data
+        self.filename = filename # Имя для загрузки, расширение по формату (chart.png / chart.webp)
+        self.file_id: str | None = None
+        self.expires_at = expires_at # мс UTC; None - все свечи закрыты, график больше не изменится
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else len(self.file_id or "")
+
+
+class ChartCache:
+    """
+    Кэш построенных графиков по ключу (вид, пара, таймфрейм, окно, последняя свеча).
+    Запись с текущей (незакрытой) свечой живет до ее закрытия - столько же, сколько
+    ее снимок в хранилище свечей. Размер ограничен суммой байт, вытеснение по LRU.
+    """
+    def __init__(self, max_bytes: int = MAX_CHART_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, CachedChart] = OrderedDict()
+        self._bytes = 0
+        self.file_id_hits = 0 # Отправлено по file_id: без отрисовки и без загрузки
+        self.upload_hits = 0 # Без отрисовки, но с загрузкой
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(kind: str, symbol: str, timeframe: str, candles: Candles, *params) -> tuple:
+        """params - все, что еще влияет на картинку (лимит, подпись диапазона и т.п.)."""
+        first_ts = int(candles.timestamp[0]) if len(candles) else None
+        last_ts = int(candles.timestamp[-1]) if len(candles) else None
+        return (kind, symbol.lower(), str(timeframe), len(candles), first_ts, last_ts) + params
+
+    def get(self, key: tuple) -> CachedChart | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at is not None and int(time.time() * 1000) >= entry.expires_at:
+            self._drop(key)
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if entry.file_id is not None:
+            self.file_id_hits += 1
+        else:
+            self.upload_hits += 1
+        return entry
+
+    def put(self, key: tuple, image: EncodedImage, timeframe: str, last_ts: int | tuple[int, ...] | None) -> CachedChart:
+        """
+        Кладет картинку. Срок жизни - до закрытия последней свечи, если она еще не закрыта.
+        last_ts - последняя свеча графика или последние свечи каждого ряда (сравнение пар): тогда до ближайшего закрытия.
+        """
+        tf_ms = timeframe_to_ms(timeframe)
+        now_ms = int(time.time() * 1000)
+        expires_at = None
+        if tf_ms is None:
+            expires_at = now_ms + 60_000 # Неизвестный таймфрейм: не угадываем закрытие, держим минуту
+        else:
+            closes = [ts + tf_ms for ts in ((last_ts,) if isinstance(last_ts, int) else last_ts or ()) if ts + tf_ms > now_ms]
+            expires_at = min(closes, default=None)
+        if key in self._entries:
+            self._drop(key)
+        entry = CachedChart(key, image.data, f"chart.{image.extension}", expires_at)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        self._purge_expired(now_ms)
+        self._evict()
+        return entry
+
+    def set_file_id(self, key: tuple, file_id: str):
+        """После первой отправки картинка больше не нужна - храним только file_id."""
+        entry = self._entries.get(key)
+        if entry is None or entry.file_id == file_id:
+            return
+        self._bytes -= entry.size
+        entry.file_id = file_id
+        entry.data = None
+        self._bytes += entry.size
+
+    def discard(self, key: tuple):
+        """Убирает запись (например, Telegram не принял file_id)."""
+        if key in self._entries:
+            self._drop(key)
+
+    def _drop(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _purge_expired(self, now_ms: int):
+        for key in [k for k, e in self._entries.items() if e.expires_at is not None and now_ms >= e.expires_at]:
+            self._drop(key)
+            self.expired += 1
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+            logger.debug(f"Кэш графиков: вытеснен {key} ({entry.size} байт)")
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        total = self.file_id_hits + self.upload_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "file_id_hits": self.file_id_hits,
+            "upload_hits": self.upload_hits,
+            "misses": self.misses,
+            "hit_rate": (self.file_id_hits + self.upload_hits) / total if total else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,478 @@
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.figure import Figure
+import numpy as np
+from PIL import Image
+
+from candles import Candles, FIELDS
+from compare import split_series, align_closes, percent_change
+from downsample import lttb_indices, ohlc_buckets, bucket_starts
+from image_encoding import CHART_FORMAT, EncodedImage, encode_image, chart_dpi, crop_background
+from indicators import Indicator, RSI_LEVELS, compute as compute_indicator
+from pillow_charts import render_ohlcv_pillow_png
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Настройки отрисовки --------------------
+RENDER_WORKERS = 2 # Процессов отрисовки; 0 - рисовать в потоке основного процесса
+RENDER_TIMEOUT = 20 # Таймаут на один график, сек
+# fork не импортирует main.py заново в каждом процессе; там, где fork нет (Windows), будет spawn
+RENDER_MP_CONTEXT = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+REUSE_FIGURES = True # Держать в каждом процессе готовые фигуры вместо plt.subplots на каждый график
+CHART_STYLE = 'seaborn-v0_8-darkgrid'
+FIGURE_SIZE = (12, 7)
+# Сколько точек реально рисуем: на 12 дюймов при 100 dpi около 1200 столбцов пикселей, больше не видно.
+# Длинные ряды сжимаются перед отрисовкой (None - рисовать все как есть)
+MAX_CHART_POINTS = 1200 # Линия цен закрытия, LTTB
+MAX_CHART_CANDLES = 1000 # Свечи, объединение соседних с сохранением OHLC
+# Раскладки фигур: панели сверху вниз и их доли по высоте
+FIGURE_LAYOUTS = {
+    "ohlcv": (("price", 1),),
+    "close": (("price", 1),),
+    "ohlcv_rsi": (("price", 3), ("rsi", 1)), # Свечи с индикаторами и RSI под ними
+    "compare": (("change", 1),), # Несколько пар в процентах от начала окна
+}
+PANEL_LABELS = {"price": "Цена (USDT)", "rsi": "RSI", "change": "Изменение, %"}
+
+
+# -------------------- Отрисовка (выполняется в процессах пула) --------------------
+CANDLE_UP_COLOR = '#26a69a'
+CANDLE_DOWN_COLOR = '#ef5350'
+CANDLE_WIDTH = 0.7
+
+
+def draw_candles(ax, candles: Candles):
+    """
+    Свечи двумя коллекциями: тела - одна PolyCollection, тени - одна LineCollection.
+    Координаты считаются numpy целиком, вместо отдельного artist'а на каждую свечу.
+    """
+    opens, highs, lows, closes = candles.open, candles.high, candles.low, candles.close
+    x = np.arange(len(candles), dtype=np.float64)
+    left, right = x - CANDLE_WIDTH / 2, x + CANDLE_WIDTH / 2
+    bottoms = np.minimum(opens, closes)
+    tops = np.maximum(opens, closes)
+    bodies = np.stack([
+        np.column_stack([left, bottoms]), np.column_stack([left, tops]),
+        np.column_stack([right, tops]), np.column_stack([right, bottoms]),
+    ], axis=1)
+    wicks = np.stack([np.column_stack([x, lows]), np.column_stack([x, highs])], axis=1)
+    colors = np.where(closes >= opens, CANDLE_UP_COLOR, CANDLE_DOWN_COLOR)
+    # Порядок слоев как у bar (zorder 1) и vlines (zorder 2)
+    ax.add_collection(PolyCollection(bodies, facecolors=colors, edgecolors='none', linewidths=0, zorder=1))
+    ax.add_collection(LineCollection(wicks, colors='black', linewidths=0.8, alpha=0.7, zorder=2))
+    ax.autoscale_view()
+
+
+def draw_candles_bars(ax, candles: Candles):
+    """Прежний вариант через vlines + bar (artist на каждую свечу). Оставлен для сравнения в benchmarks.py."""
+    opens, highs, lows, closes = candles.open, candles.high, candles.low, candles.close
+    candle_indices = np.arange(len(candles))
+    colors = np.where(closes >= opens, CANDLE_UP_COLOR, CANDLE_DOWN_COLOR)
+    ax.vlines(candle_indices, lows, highs, color='black', linewidth=0.8, alpha=0.7)
+    ax.bar(candle_indices, np.abs(opens - closes), bottom=np.minimum(opens, closes), width=CANDLE_WIDTH, color=colors)
+
+
+CANDLE_DRAWERS = {
+    "collections": draw_candles,
+    "bars": draw_candles_bars,
+}
+
+INDICATOR_COLORS = ['#ff9800', '#8e24aa', '#1e88e5', '#6d4c41', '#00897b']
+COMPARE_COLORS = ['#2962ff', '#ff9800', '#26a69a', '#ef5350', '#8e24aa', '#6d4c41']
+
+
+def draw_indicators(axes, lines: list[tuple[Indicator, tuple[np.ndarray, ...]]]):
+    """Скользящие, полосы Боллинджера и VWAP поверх свечей, RSI - на нижней панели (axes[-1])."""
+    price_ax, lower_ax = axes[0], axes[-1]
+    for i, (indicator, values) in enumerate(lines):
+        color = INDICATOR_COLORS[i % len(INDICATOR_COLORS)]
+        x = np.arange(len(values[0]))
+        label = str(indicator).upper()
+        if indicator.name == "bb":
+            middle, upper, lower = values
+            price_ax.plot(x, middle, color=color, linewidth=1, linestyle='--', label=label)
+            price_ax.plot(x, upper, color=color, linewidth=0.8)
+            price_ax.plot(x, lower, color=color, linewidth=0.8)
+            price_ax.fill_between(x, lower, upper, color=color, alpha=0.08, linewidth=0)
+        elif indicator.panel == "rsi":
+            lower_ax.plot(x, values[0], color=color, linewidth=1.2, label=label)
+        else:
+            price_ax.plot(x, values[0], color=color, linewidth=1.2, label=label)
+    if any(indicator.panel == "rsi" for indicator, _ in lines):
+        for level in RSI_LEVELS:
+            lower_ax.axhline(level, color='gray', linewidth=0.8, linestyle=':')
+    for ax in axes:
+        if ax.get_legend_handles_labels()[0]:
+            ax.legend(loc='upper left', fontsize=9, frameon=True, framealpha=0.8)
+
+
+# Свободные заготовки фигур по раскладке; у каждого процесса пула свои
+_figure_pool: dict[str, list[tuple[Figure, object]]] = {}
+_style_applied = False
+
+
+def _apply_style():
+    """Стиль читается один раз на процесс (параметры rc нужны и при создании фигуры, и при рисовании)."""
+    global _style_applied
+    if not _style_applied:
+        plt.style.use(CHART_STYLE)
+        _style_applied = True
+
+
+def _setup_axes(ax, panel: str = "price"):
+    """Неизменная часть оформления панели: подпись оси, сетка, без делений по X."""
+    ax.set_ylabel(PANEL_LABELS[panel], fontsize=12)
+    ax.set_xticks([])
+    ax.grid(True, linestyle='--', alpha=0.5)
+    if panel == "rsi":
+        ax.set_ylim(0, 100)
+        ax.set_yticks([RSI_LEVELS[0], 50, RSI_LEVELS[1]])
+
+
+def _add_axes(fig, layout: str) -> list:
+    """Панели раскладки layout; у нескольких панелей общая ось X."""
+    panels = FIGURE_LAYOUTS[layout]
+    if len(panels) == 1:
+        axes = [fig.add_subplot()]
+    else:
+        ratios = [ratio for _, ratio in panels]
+        axes = list(fig.subplots(len(panels), 1, sharex=True, gridspec_kw={"height_ratios": ratios, "hspace": 0.05}))
+    for ax, (panel, _) in zip(axes, panels):
+        _setup_axes(ax, panel)
+    return axes
+
+
+def _new_template(layout: str) -> tuple[Figure, list]:
+    # Figure без pyplot: фигура не регистрируется в менеджере и живет, пока лежит в пуле
+    fig = Figure(figsize=FIGURE_SIZE)
+    FigureCanvasAgg(fig)
+    return fig, _add_axes(fig, layout)
+
+
+def _reset_template(axes):
+    """Убирает данные прошлого графика, оформление остается."""
+    for ax in axes:
+        for artist in [*ax.collections, *ax.lines, *ax.patches, *ax.texts]:
+            artist.remove()
+        if ax.legend_ is not None:
+            ax.legend_.remove()
+        ax.relim() # Сбрасывает границы данных, следующий график масштабируется с нуля
+        ax.set_title("")
+        ax.set_xlabel("")
+
+
+@contextmanager
+def _figure(layout: str, reuse: bool = REUSE_FIGURES):
+    """Фигура и ее панели (список axes) для графика: из пула заготовок раскладки layout или новая через pyplot."""
+    if not reuse:
+        plt.style.use(CHART_STYLE)
+        fig = plt.figure(figsize=FIGURE_SIZE)
+        try:
+            yield fig, _add_axes(fig, layout)
+        finally:
+            plt.close(fig)
+        return
+    _apply_style()
+    pool = _figure_pool.setdefault(layout, [])
+    fig, axes = pool.pop() if pool else _new_template(layout)
+    try:
+        yield fig, axes
+    finally:
+        _reset_template(axes)
+        pool.append((fig, axes))
+
+
+def render_ohlcv_png(candles: Candles, title: str, xlabel: str, drawer: str = "collections",
+                     reuse_figures: bool = REUSE_FIGURES, max_candles: int | None = MAX_CHART_CANDLES,
+                     format: str = CHART_FORMAT, indicators: tuple[str, ...] = (), visible: int | None = None,
+                     indicator_values: dict[str, tuple[np.ndarray, ...]] | None = None) -> EncodedImage | None:
+    """
+    Свечной график (PNG или WebP, см. image_encoding). None, если все цены нулевые.
+    indicators - токены индикаторов (ema20, rsi14...); считаются по всему ряду, а рисуются только
+    последние visible свечей: начало ряда - история для разгона индикаторов.
+    indicator_values - уже готовые линии (токен -> линии длины len(candles)), например из потоков хранилища свечей.
+    """
+    indicator_values = indicator_values or {}
+    lines = [(indicator, indicator_values.get(str(indicator)) or compute_indicator(candles, indicator))
+             for indicator in map(Indicator.parse, indicators)]
+    if visible is not None and visible < len(candles):
+        skip = len(candles) - visible
+        candles = candles[skip:]
+        lines = [(indicator, tuple(line[skip:] for line in values)) for indicator, values in lines]
+    opens, highs, lows, closes = candles.open, candles.high, candles.low, candles.close
+    if not ((opens > 0) | (highs > 0) | (lows > 0) | (closes > 0)).any():
+        logger.error("Все ценовые данные нулевые, график не может быть построен.")
+        return None
+    if max_candles is not None and len(candles) > max_candles:
+        # Индикатор в сжатой свече - значение на ее последней исходной свече (как close)
+        ends = np.r_[bucket_starts(len(candles), max_candles)[1:], len(candles)] - 1
+        candles = ohlc_buckets(candles, max_candles)
+        lines = [(indicator, tuple(line[ends] for line in values)) for indicator, values in lines]
+    layout = "ohlcv_rsi" if any(indicator.panel == "rsi" for indicator, _ in lines) else "ohlcv"
+    with _figure(layout, reuse_figures) as (fig, axes):
+        CANDLE_DRAWERS[drawer](axes[0], candles)
+        if lines:
+            draw_indicators(axes, lines)
+        _decorate(axes, title, xlabel)
+        return _encode(fig, chart_dpi(len(candles), FIGURE_SIZE[0]), format)
+
+
+def render_close_png(candles: Candles, title: str, xlabel: str, reuse_figures: bool = REUSE_FIGURES,
+                     max_points: int | None = MAX_CHART_POINTS, format: str = CHART_FORMAT) -> EncodedImage | None:
+    """Линейный график цен закрытия (PNG или WebP). None, если цен нет."""
+    prices = candles.close
+    if not len(prices) or not prices.any():
+        logger.error("Нет валидных цен закрытия для построения графика.")
+        return None
+    # Точки остаются на своих местах по X, поэтому масштаб оси тот же, что у полного ряда
+    x = lttb_indices(prices, max_points) if max_points is not None else np.arange(len(prices))
+    with _figure("close", reuse_figures) as (fig, axes):
+        axes[0].plot(x, prices[x], linestyle='-', color='#2962ff')
+        _decorate(axes, title, xlabel)
+        return _encode(fig, chart_dpi(len(x), FIGURE_SIZE[0]), format)
+
+
+def render_compare_png(candles: Candles, title: str, xlabel: str, symbols: tuple[str, ...] = (), lengths: tuple[int, ...] = (),
+                       reuse_figures: bool = REUSE_FIGURES, max_points: int | None = MAX_CHART_POINTS,
+                       format: str = CHART_FORMAT) -> EncodedImage | None:
+    """
+    Сравнение пар: candles - их ряды подряд (Candles.concat) по lengths свечей, symbols - подписи.
+    Ряды выравниваются по времени и рисуются в процентах от первой общей свечи.
+    """
+    parts = split_series(candles, lengths) if lengths else [candles]
+    grid, closes = align_closes(parts)
+    if not len(grid):
+        logger.error("Нет общих свечей у сравниваемых пар, график не может быть построен.")
+        return None
+    changes = percent_change(closes)
+    labels = symbols or ("",) * len(parts)
+    points = 0
+    with _figure("compare", reuse_figures) as (fig, axes):
+        ax = axes[0]
+        ax.axhline(0, color='gray', linewidth=0.8, linestyle=':')
+        for i, (symbol, line) in enumerate(zip(labels, changes)):
+            if np.isnan(line[0]):
+                continue # Нулевая первая цена - не с чем сравнивать
+            x = lttb_indices(line, max_points) if max_points is not None else np.arange(len(line))
+            points = max(points, len(x))
+            ax.plot(x, line[x], color=COMPARE_COLORS[i % len(COMPARE_COLORS)], linewidth=1.4,
+                    label=f"{symbol.upper()} {line[-1]:+.2f}%" if symbol else None)
+        if symbols:
+            ax.legend(loc='upper left', fontsize=10, frameon=True, framealpha=0.8)
+        _decorate(axes, title, xlabel)
+        return _encode(fig, chart_dpi(points, FIGURE_SIZE[0]), format)
+
+
+def _decorate(axes, title: str, xlabel: str):
+    axes[0].set_title(title, fontsize=14)
+    axes[-1].set_xlabel(xlabel, fontsize=12)
+
+
+def _encode(fig, dpi: int, format: str) -> EncodedImage:
+    """Растр фигуры при заданном dpi, поля обрезаются как у bbox_inches='tight' (отступ 0.1 дюйма)."""
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    pixels = np.asarray(fig.canvas.buffer_rgba())[:, :, :3]
+    background = np.round(np.asarray(fig.get_facecolor()[:3]) * 255).astype(np.uint8)
+    pixels = crop_background(pixels, background, pad=round(0.1 * dpi))
+    return encode_image(Image.fromarray(pixels), format)
+
+
+RENDERERS = {
+    "ohlcv": render_ohlcv_png,
+    "close": render_close_png,
+    "compare": render_compare_png,
+    "ohlcv_pillow": render_ohlcv_pillow_png, # Быстрый вариант без matplotlib
+}
+
+
+# -------------------- Передача свечей через общую память --------------------
+def _pack(candles: Candles, buffer, extra: list[np.ndarray] = ()) -> None:
+    """Колонки подряд: timestamp, open, high, low, close, volume, затем extra той же длины (все по 8 байт на значение)."""
+    length = len(candles)
+    columns = [getattr(candles, name) for name in FIELDS] + [np.asarray(column, dtype=np.float64) for column in extra]
+    for i, column in enumerate(columns):
+        np.ndarray((length,), dtype=column.dtype, buffer=buffer, offset=i * length * 8)[:] = column
+
+
+def _unpack(buffer, length: int, extra: int = 0) -> tuple[Candles, list[np.ndarray]]:
+    # Копия (memcpy) нужна, чтобы после отрисовки общую память можно было закрыть:
+    # matplotlib может держать ссылки на массивы дольше, чем живет фигура
+    columns = [
+        np.ndarray((length,), dtype=np.int64 if i == 0 else np.float64, buffer=buffer, offset=i * length * 8).copy()
+        for i in range(len(FIELDS) + extra)
+    ]
+    return Candles(*columns[:len(FIELDS)]), columns[len(FIELDS):]
+
+
+def _render_shared(kind: str, shm_name: str, length: int, title: str, xlabel: str, options: dict,
+                   indicator_layout: tuple[tuple[str, int], ...] = ()) -> EncodedImage | None:
+    """
+    Точка входа процесса пула: читает свечи из общей памяти и рисует график.
+    indicator_layout - (токен, число линий) готовых индикаторов, лежащих в том же блоке после свечей.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        candles, extra = _unpack(shm.buf, length, sum(count for _, count in indicator_layout))
+    finally:
+        shm.close()
+    if indicator_layout:
+        columns = iter(extra)
+        options = {**options, "indicator_values": {token: tuple(next(columns) for _ in range(count)) for token, count in indicator_layout}}
+    return RENDERERS[kind](candles, title, xlabel, **options)
+
+
+def _warm_up() -> int:
+    """Прогрев процесса: шрифты и заготовки фигур всех раскладок готовы до первого настоящего графика."""
+    candles = Candles(np.arange(2), *(np.ones(2) for _ in FIELDS[1:]))
+    for render in RENDERERS.values():
+        render(candles, "", "")
+    render_ohlcv_png(candles, "", "", indicators=("rsi2",)) # Раскладка с панелью RSI
+    return multiprocessing.current_process().pid
+
+
+def _release(shm: shared_memory.SharedMemory):
+    try:
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка освобождения общей памяти {shm.name}: {e}")
+
+
+class ChartRenderer:
+    """
+    Отрисовка графиков в пуле процессов, чтобы matplotlib не блокировал event loop.
+    Свечи передаются через общую память, обратно приходит закодированная картинка.
+    Сколько графиков рисуется разом, решает вызывающий (render_queue.RenderScheduler, слот на процесс).
+    """
+    def __init__(self, workers: int = RENDER_WORKERS, timeout: float = RENDER_TIMEOUT, mp_context: str = RENDER_MP_CONTEXT):
+        self.workers = workers
+        self.timeout = timeout
+        self.mp_context = mp_context
+        self._executor: ProcessPoolExecutor | None = None
+        self.pending = 0
+        self.rendered = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.render_time = 0.0
+        self.encode_time = 0.0 # Входит в render_time
+        self.image_bytes = 0
+
+    def start(self):
+        """Создает пул и сразу поднимает процессы (до начала поллинга, пока процесс еще легкий)."""
+        if self.workers <= 0 or self._executor is not None:
+            return
+        if os.name == "posix":
+            # Общий трекер с процессами пула: иначе у каждого свой, и при выходе он "чистит" чужие блоки
+            resource_tracker.ensure_running()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(self.mp_context))
+        for _ in range(self.workers):
+            self._executor.submit(_warm_up)
+        logger.info(f"Пул отрисовки запущен: {self.workers} процессов ({self.mp_context}), таймаут {self.timeout} сек.")
+
+    async def render(self, kind: str, candles: Candles, title: str, xlabel: str, **options) -> EncodedImage | None:
+        """График kind (ключ RENDERERS), options - его доп. параметры. None при таймауте или ошибке."""
+        self.pending += 1
+        start_time = time.time()
+        executor = self._executor # Пул, на котором идет именно этот график (его и перезапускаем при поломке)
+        try:
+            if executor is None:
+                image = await asyncio.wait_for(asyncio.to_thread(RENDERERS[kind], candles, title, xlabel, **options), self.timeout)
+            else:
+                image = await self._render_in_pool(executor, kind, candles, title, xlabel, options)
+            if image is not None:
+                self.rendered += 1
+                self.render_time += time.time() - start_time
+                self.encode_time += image.encode_time
+                self.image_bytes += len(image)
+            return image
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.error(f"Таймаут отрисовки графика {title!r} ({self.timeout} сек).")
+            if executor is not None:
+                # wait_for только перестает ждать: процесс рисовал бы дальше, хотя слот очереди уже свободен
+                self._restart(executor, terminate=True)
+            return None
+        except BrokenProcessPool as e:
+            self.failed += 1
+            logger.error(f"Пул отрисовки сломан ({e}).")
+            self._restart(executor)
+            return None
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise # Отменен сам запрос
+            # Задачу в пуле отменил перезапуск пула (поломка или таймаут другого графика)
+            self.failed += 1
+            logger.error(f"График {title!r} отменен перезапуском пула отрисовки.")
+            return None
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка отрисовки графика {title!r}: {e}", exc_info=True)
+            return None
+        finally:
+            self.pending -= 1
+
+    async def _render_in_pool(self, executor: ProcessPoolExecutor, kind: str, candles: Candles, title: str, xlabel: str, options: dict) -> EncodedImage | None:
+        # Готовые линии индикаторов едут в том же блоке общей памяти, что и свечи, а не в pickle параметров
+        options = dict(options)
+        indicator_values = {token: lines for token, lines in (options.pop("indicator_values", None) or {}).items()
+                            if all(len(line) == len(candles) for line in lines)}
+        layout = tuple((token, len(lines)) for token, lines in indicator_values.items())
+        extra = [line for lines in indicator_values.values() for line in lines]
+        shm = shared_memory.SharedMemory(create=True, size=len(candles) * 8 * (len(FIELDS) + len(extra)))
+        try:
+            _pack(candles, shm.buf, extra)
+            future = executor.submit(_render_shared, kind, shm.name, len(candles), title, xlabel, options, layout)
+        except BaseException:
+            _release(shm)
+            raise
+        # Блок освобождается, когда процесс закончил с ним (в том числе после нашего таймаута)
+        future.add_done_callback(lambda _: _release(shm))
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    def _restart(self, executor: ProcessPoolExecutor, terminate: bool = False):
+        """Пересоздает пул executor; terminate - еще и убить его процессы (зависшую отрисовку shutdown не прерывает)."""
+        if self._executor is not executor:
+            return # Этот пул уже пересоздан другим графиком
+        self._executor = None
+        # До shutdown: он обнуляет список процессов. Публичного способа убить процессы пула до Python 3.14 нет
+        processes = list((getattr(executor, "_processes", None) or {}).values()) if terminate else []
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        self.start()
+
+    def close(self):
+        """Останавливает пул при выходе: ждущие графики отменяются, начатые дорисовываются."""
+        if self._executor is not None:
+            # wait=True: без ожидания на 3.11 atexit пула может писать в уже закрытый пайп
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            logger.info("Пул отрисовки остановлен.")
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "rendered": self.rendered,
+            "timeouts": self.timeouts,
+            "failed": self.failed,
+            "avg_render_time": self.render_time / self.rendered if self.rendered else 0.0,
+            "avg_encode_time": self.encode_time / self.rendered if self.rendered else 0.0,
+            "avg_bytes": self.image_bytes // self.rendered if self.rendered else 0,
+        }
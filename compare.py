@@ -0,0 +1,36 @@
+import numpy as np
+
+from candles import Candles
+
+
+def split_series(candles: Candles, lengths: tuple[int, ...]) -> list[Candles]:
+    """Обратно к Candles.concat: ряды подряд по lengths свечей."""
+    bounds = np.r_[0, np.cumsum(lengths)]
+    return [candles[int(a):int(b)] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def align_closes(series: list[Candles]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Цены закрытия нескольких рядов на общей сетке времени: (метки, матрица рядов x меток).
+    Сетка - объединение меток всех рядов начиная с первой, где данные есть у всех (иначе не с чем сравнивать).
+    Пропущенная у ряда свеча (не было сделок или API ее не отдало) заполняется предыдущей ценой.
+    """
+    series = [candles for candles in series if len(candles)]
+    if not series:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0))
+    common_start = max(int(candles.timestamp[0]) for candles in series)
+    grid = np.unique(np.concatenate([candles.timestamp for candles in series]))
+    grid = grid[grid >= common_start]
+    closes = np.empty((len(series), len(grid)))
+    for row, candles in zip(closes, series):
+        # Последняя свеча ряда с меткой <= метки сетки; у всех рядов она есть, сетка начинается с общей точки
+        positions = np.searchsorted(candles.timestamp, grid, side="right") - 1
+        row[:] = candles.close[positions]
+    return grid, closes
+
+
+def percent_change(closes: np.ndarray) -> np.ndarray:
+    """Изменение каждого ряда в процентах от его первой цены. Ряд с нулевой первой ценой - NaN."""
+    base = closes[:, :1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(base != 0, (closes / base - 1.0) * 100.0, np.nan)
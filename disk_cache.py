@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+from candle_cache import merge_intervals, timeframe_to_ms
+from candles import Candles
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Настройки хранилища свечей на диске --------------------
+MAX_DISK_CANDLES = 500_000 # Свечей на ряд (48 байт на свечу, ~24 МБ), лишние - самые старые - обрезаются
+DISK_TRIM_SLACK = 0.1 # Обрезка, когда ряд перерос лимит на эту долю: не пересобирать файлы на каждой дозаписи
+
+# Колонки ряда: по файлу фиксированной ширины на каждую (те же, что у candles.Candles)
+COLUMNS = (
+    ("timestamp", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+)
+
+
+class _DiskSeries:
+    """Набор файлов одного (symbol, timeframe): колонки + coverage.json с покрытыми интервалами закрытых свечей."""
+    def __init__(self, root: str, symbol: str, timeframe: str, max_candles: int = MAX_DISK_CANDLES):
+        self.prefix = os.path.join(root, f"{symbol}_{timeframe}")
+        self.timeframe_ms = timeframe_to_ms(timeframe)
+        self.max_candles = max_candles
+        self.covered: list[tuple[int, int]] = []
+        self._maps: dict[str, np.memmap] | None = None
+        self._load_coverage()
+
+    def path(self, column: str) -> str:
+        return f"{self.prefix}.{column}"
+
+    def _load_coverage(self):
+        try:
+            with open(self.path("coverage.json"), "r", encoding="utf-8") as f:
+                covered = [tuple(pair) for pair in json.load(f)]
+        except FileNotFoundError:
+            covered = []
+        except Exception as e:
+            logger.error(f"Ошибка чтения покрытия {self.prefix}: {e}. Покрытие сброшено.", exc_info=True)
+            covered = []
+        maps = self.columns()
+        if maps is None or not covered:
+            # Колонки без покрытия - оборванная пересборка (или их нет): доверять им нельзя
+            self._maps = None
+            self.covered = []
+            self._remove_columns()
+            return
+        # Покрытие не шире строк, которые реально есть в колонках
+        first_ts, last_ts = int(maps["timestamp"][0]), int(maps["timestamp"][-1])
+        self.covered = [(max(a, first_ts), min(b, last_ts)) for a, b in covered if b >= first_ts and a <= last_ts]
+        if self.covered != covered:
+            logger.warning(f"Покрытие {self.prefix} обрезано по данным колонок: {len(covered)} -> {len(self.covered)} интервалов.")
+
+    def _save_coverage(self, covered: list[tuple[int, int]] | None = None):
+        """Атомарная запись покрытия (временный файл + os.replace), по умолчанию - текущего."""
+        tmp_path = self.path("coverage.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.covered if covered is None else covered, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path("coverage.json"))
+
+    def _remove_columns(self):
+        for name, _ in COLUMNS:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def columns(self) -> dict[str, np.memmap] | None:
+        """Memory map всех колонок (только чтение). Длина - по самой короткой колонке на случай оборванной дозаписи."""
+        if self._maps is None:
+            sizes = []
+            for name, dtype in COLUMNS:
+                try:
+                    sizes.append(os.path.getsize(self.path(name)) // np.dtype(dtype).itemsize)
+                except FileNotFoundError:
+                    return None
+            length = min(sizes)
+            if length == 0:
+                return None
+            self._maps = {name: np.memmap(self.path(name), dtype=dtype, mode="r", shape=(length,)) for name, dtype in COLUMNS}
+        return self._maps
+
+    def read(self, start: int, end: int) -> Candles:
+        maps = self.columns()
+        if maps is None:
+            return Candles.empty()
+        timestamps = maps["timestamp"]
+        # Бинарный поиск по колонке времени
+        lo = int(np.searchsorted(timestamps, start, side="left"))
+        hi = int(np.searchsorted(timestamps, end, side="right"))
+        if lo >= hi:
+            return Candles.empty()
+        # Копия среза: файлы могут быть пересобраны, пока свечи лежат в памяти
+        return Candles(*(np.array(maps[name][lo:hi]) for name, _ in COLUMNS))
+
+    def write(self, candles: Candles, start: int, end: int) -> int:
+        """
+        Дописывает закрытые свечи интервала [start, end]. Если они не строго новее хвоста - файлы пересобираются.
+        Возвращает число обрезанных старых свечей (ряд перерос max_candles).
+        """
+        new = {name: np.ascontiguousarray(getattr(candles, name), dtype=dtype) for name, dtype in COLUMNS}
+        maps = self.columns()
+        length = len(maps["timestamp"]) if maps is not None else 0
+        last_ts = int(maps["timestamp"][-1]) if maps is not None else None
+        if len(candles) and (last_ts is None or new["timestamp"][0] > last_ts) and np.all(np.diff(new["timestamp"]) > 0):
+            # Обычный случай: пришли свечи новее всего, что есть на диске - просто дозаписываем
+            del maps
+            self._maps = None # Отпускаем memmap до изменения файлов (иначе на Windows файл занят)
+            for name, _ in COLUMNS:
+                self._truncate_to(name, length)
+                with open(self.path(name), "ab") as f:
+                    f.write(new[name].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+        elif len(candles):
+            old = {name: np.array(maps[name]) for name, _ in COLUMNS} if maps is not None else None
+            del maps
+            self._maps = None
+            self._rewrite(old, new)
+        # Покрытие - только после того, как колонки на диске
+        self.covered = merge_intervals(self.covered + [(start, end)], self.timeframe_ms)
+        trimmed = self._trim()
+        self._save_coverage()
+        return trimmed
+
+    def _trim(self) -> int:
+        """Обрезает самые старые свечи сверх max_candles (с запасом DISK_TRIM_SLACK). Возвращает число удаленных."""
+        maps = self.columns()
+        length = len(maps["timestamp"]) if maps is not None else 0
+        if length <= self.max_candles * (1 + DISK_TRIM_SLACK):
+            return 0
+        keep = {name: np.array(maps[name][-self.max_candles:]) for name, _ in COLUMNS}
+        del maps
+        self._maps = None
+        self._replace_columns(keep)
+        first_ts = int(keep["timestamp"][0])
+        self.covered = [(max(a, first_ts), b) for a, b in self.covered if b >= first_ts]
+        logger.info(f"Диск: {self.prefix} обрезан до {self.max_candles} свечей (удалено {length - self.max_candles}).")
+        return length - self.max_candles
+
+    def _truncate_to(self, column: str, length: int):
+        """Обрезает колонку до общей длины (после оборванной дозаписи колонки могут различаться)."""
+        size = length * np.dtype(dict(COLUMNS)[column]).itemsize
+        if not os.path.exists(self.path(column)) or os.path.getsize(self.path(column)) != size:
+            with open(self.path(column), "r+b" if os.path.exists(self.path(column)) else "wb") as f:
+                f.truncate(size)
+
+    def _rewrite(self, old: dict[str, np.ndarray] | None, new: dict[str, np.ndarray]):
+        if old is not None:
+            # Новые значения важнее старых: из старых убираем совпадающие метки времени
+            keep = ~np.isin(old["timestamp"], new["timestamp"])
+            merged = {name: np.concatenate([old[name][keep], new[name]]) for name, _ in COLUMNS}
+        else:
+            merged = new
+        order = np.argsort(merged["timestamp"], kind="stable")
+        ts_sorted = merged["timestamp"][order]
+        unique = np.r_[ts_sorted[1:] != ts_sorted[:-1], True] # Последний из дублей внутри новых данных
+        self._replace_columns({name: merged[name][order][unique] for name, _ in COLUMNS})
+
+    def _replace_columns(self, columns: dict[str, np.ndarray]):
+        """
+        Пересобирает файлы колонок. Пока они заменяются по одному, покрытие на диске пустое:
+        после падения посередине смесь старых и новых колонок при загрузке будет выброшена.
+        """
+        self._save_coverage([])
+        for name, _ in COLUMNS:
+            tmp_path = self.path(f"{name}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(columns[name].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path(name))
+
+
+class DiskCandleStore:
+    """
+    Второй уровень кэша свечей на диске: колоночные файлы фиксированной ширины на каждую пару/таймфрейм,
+    читаются через numpy memmap. Хранятся только закрытые свечи, поэтому данные переживают перезапуск.
+    Методы блокирующие - хранилище в памяти зовет их через asyncio.to_thread (один ряд - не больше одного вызова разом).
+    """
+    def __init__(self, root: str, max_candles: int = MAX_DISK_CANDLES):
+        self.root = root
+        self.max_candles = max_candles
+        os.makedirs(root, exist_ok=True)
+        self._series: dict[tuple[str, str], _DiskSeries] = {}
+        self._lock = threading.Lock() # Общий словарь рядов и счетчики трогают потоки разных рядов
+        self.candles_read = 0
+        self.candles_written = 0
+        self.candles_trimmed = 0
+
+    def _get(self, symbol: str, timeframe: str) -> _DiskSeries | None:
+        if timeframe_to_ms(timeframe) is None:
+            return None
+        key = (symbol.lower(), str(timeframe))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = _DiskSeries(self.root, *key, max_candles=self.max_candles)
+                self._series[key] = series
+        return series
+
+    def read_covered(self, symbol: str, timeframe: str, start: int, end: int) -> list[tuple[int, int, Candles]]:
+        """Покрытые на диске части интервала [start, end] вместе со свечами: [(start, end, candles), ...]."""
+        series = self._get(symbol, timeframe)
+        if series is None or not series.covered:
+            return []
+        start_time = time.time()
+        parts = []
+        for a, b in [(max(a, start), min(b, end)) for a, b in series.covered if a <= end and b >= start]:
+            parts.append((a, b, series.read(a, b)))
+        with self._lock:
+            self.candles_read += sum(len(p[2]) for p in parts)
+        if parts:
+            logger.info(f"Диск: {symbol}/{timeframe} прочитано {sum(len(p[2]) for p in parts)} свечей за {time.time() - start_time:.4f} сек.")
+        return parts
+
+    def read_covered_many(self, symbol: str, timeframe: str, intervals: list[tuple[int, int]]) -> list[tuple[int, int, Candles]]:
+        """read_covered по нескольким интервалам за один вызов (один переход в поток)."""
+        return [part for start, end in intervals for part in self.read_covered(symbol, timeframe, start, end)]
+
+    def write(self, symbol: str, timeframe: str, candles: Candles, start: int, end: int):
+        """Сохраняет закрытые свечи интервала [start, end] (пустой список тоже отмечает интервал покрытым)."""
+        series = self._get(symbol, timeframe)
+        if series is None:
+            return
+        try:
+            trimmed = series.write(candles, start, end)
+            with self._lock:
+                self.candles_written += len(candles)
+                self.candles_trimmed += trimmed
+        except Exception as e:
+            logger.error(f"Ошибка записи свечей {symbol}/{timeframe} на диск: {e}", exc_info=True)
+
+    def write_many(self, symbol: str, timeframe: str, parts: list[tuple[Candles, int, int]]):
+        """write по нескольким интервалам [(candles, start, end), ...] за один вызов."""
+        for candles, start, end in parts:
+            self.write(symbol, timeframe, candles, start, end)
+
+    def stats(self) -> dict:
+        return {"series": len(self._series), "candles_read": self.candles_read, "candles_written": self.candles_written,
+                "candles_trimmed": self.candles_trimmed}
@@ -0,0 +1,61 @@
+import numpy as np
+
+from candles import Candles
+
+
+def lttb_indices(y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: индексы threshold точек ряда y, сохраняющих форму линии.
+    Первая и последняя точки всегда остаются; из каждой корзины берется точка с наибольшей
+    площадью треугольника (предыдущая выбранная точка, она, среднее следующей корзины).
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    y = np.asarray(y, dtype=np.float64)
+    # Точки 1..n-2 делятся на threshold-2 корзины
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    starts = edges[:-1]
+    counts = np.diff(edges)
+    # Среднее каждой корзины (x - индекс); для последней корзины "следующая" - последняя точка
+    avg_x = np.r_[(starts + (counts - 1) / 2.0)[1:], n - 1]
+    avg_y = np.r_[(np.add.reduceat(y[1:n - 1], starts - 1) / counts)[1:], y[-1]]
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = starts[i], starts[i] + counts[i]
+        xs = np.arange(lo, hi)
+        area = np.abs((a - avg_x[i]) * (y[lo:hi] - y[a]) - (a - xs) * (avg_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def bucket_starts(n: int, max_candles: int) -> np.ndarray:
+    """Начала корзин, на которые ohlc_buckets делит ряд из n свечей (каждая свеча - своя корзина, если сжимать не нужно)."""
+    if n <= max_candles or max_candles < 1:
+        return np.arange(n)
+    return np.unique(np.arange(max_candles, dtype=np.int64) * n // max_candles)
+
+
+def ohlc_buckets(candles: Candles, max_candles: int) -> Candles:
+    """
+    Сжимает ряд до max_candles свечей: соседние свечи объединяются в корзины примерно равного
+    размера (open - первый, high - максимум, low - минимум, close - последний, volume - сумма).
+    Экстремумы сохраняются, поэтому тени на графике остаются теми же.
+    """
+    n = len(candles)
+    if n <= max_candles or max_candles < 1:
+        return candles
+    starts = bucket_starts(n, max_candles)
+    ends = np.r_[starts[1:], n] - 1
+    return Candles(
+        candles.timestamp[starts],
+        candles.open[starts],
+        np.maximum.reduceat(candles.high, starts),
+        np.minimum.reduceat(candles.low, starts),
+        candles.close[ends],
+        np.add.reduceat(candles.volume, starts),
+    )
@@ -0,0 +1,88 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+# -------------------- Кодирование готовых графиков --------------------
+# От размера файла зависит время загрузки в Telegram, поэтому формат и сжатие выбираются здесь, а не в savefig
+CHART_FORMAT = "png_palette" # "png" - полноцветный, "png_palette" - с палитрой, "webp" - WebP без потерь
+PNG_COMPRESS_LEVEL = 6 # zlib 0-9: на 9 файл меньше на пару процентов, а кодирование в 3 раза дольше
+PALETTE_COLORS = 64 # Цветов на графике немного (фон, сетка, свечи, текст и сглаживание краев)
+WEBP_METHOD = 2 # 0-6: выше 2 файл почти не уменьшается, время растет
+# Пиксельный размер зависит от числа точек: FIGURE_SIZE в дюймах x dpi из этого диапазона.
+# Немного свечей на 1200 пикселях - лишние байты без новых деталей
+CHART_DPI_RANGE = (72, 100)
+PIXELS_PER_POINT = 6 # Сколько пикселей ширины нужно на свечу / точку линии
+
+
+class EncodedImage:
+    """Закодированная картинка и ее параметры для отчета (размер, время кодирования)."""
+    __slots__ = ("data", "format", "width", "height", "encode_time")
+
+    def __init__(self, data: bytes, format: str, width: int, height: int, encode_time: float):
+        self.data = data
+        self.format = format
+        self.width = width
+        self.height = height
+        self.encode_time = encode_time # сек
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][0]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"EncodedImage({self.format}, {self.width}x{self.height}, {len(self.data)} байт, {self.encode_time * 1000:.1f} мс)"
+
+
+def _save_png(image: Image.Image, buffer):
+    image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+
+def _save_png_palette(image: Image.Image, buffer):
+    # FASTOCTREE в разы быстрее MEDIANCUT при том же размере; без дизеринга - чистые заливки, меньше байт
+    palette = image.quantize(PALETTE_COLORS, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    palette.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+
+def _save_webp(image: Image.Image, buffer):
+    # Без потерь: с потерями линии и текст размываются, а файл получается больше палитрового PNG
+    image.save(buffer, format="WEBP", lossless=True, method=WEBP_METHOD)
+
+
+# Формат -> (расширение файла, кодировщик)
+FORMATS = {
+    "png": ("png", _save_png),
+    "png_palette": ("png", _save_png_palette),
+    "webp": ("webp", _save_webp),
+}
+
+
+def encode_image(image: Image.Image, format: str = CHART_FORMAT) -> EncodedImage:
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    FORMATS[format][1](image.convert("RGB") if image.mode != "RGB" else image, buffer)
+    return EncodedImage(buffer.getvalue(), format, image.width, image.height, time.perf_counter() - start)
+
+
+def chart_dpi(points: int, width_inches: float) -> int:
+    """dpi, при котором на точку приходится около PIXELS_PER_POINT пикселей, в пределах CHART_DPI_RANGE."""
+    low, high = CHART_DPI_RANGE
+    return int(np.clip(points * PIXELS_PER_POINT / width_inches, low, high))
+
+
+def crop_background(pixels: np.ndarray, background: np.ndarray, pad: int) -> np.ndarray:
+    """
+    Обрезает поля цвета background вокруг содержимого, оставляя pad пикселей.
+    То же, что bbox_inches='tight' в savefig, но по готовому растру, без второго прохода компоновки.
+    """
+    content = (pixels != background).any(axis=2)
+    rows, cols = np.flatnonzero(content.any(axis=1)), np.flatnonzero(content.any(axis=0))
+    if not len(rows):
+        return pixels
+    top, bottom = max(rows[0] - pad, 0), min(rows[-1] + 1 + pad, pixels.shape[0])
+    left, right = max(cols[0] - pad, 0), min(cols[-1] + 1 + pad, pixels.shape[1])
+    return pixels[top:bottom, left:right]
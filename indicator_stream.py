@@ -0,0 +1,406 @@
+import abc
+import math
+import asyncio
+import bisect
+import logging
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from candles import Candles, FIELDS
+from indicators import Indicator, BOLLINGER_WIDTH, VWAP_SESSION_MS, compute, ema, wilder_averages, vwap_anchored
+
+logger = logging.getLogger(__name__)
+
+# -------------------- Потоковые индикаторы --------------------
+# Состояние индикатора по ряду хранилища: каждая новая закрытая свеча добавляется за O(1),
+# с нуля (векторно, по всему покрытому интервалу) пересчет только после пробела или правки истории
+MAX_INDICATOR_STREAMS = 64 # Потоков (пара, таймфрейм, индикатор) в памяти, вытеснение по LRU
+
+
+class _State(abc.ABC):
+    """Состояние одного индикатора. Строки свечей - (timestamp, open, high, low, close, volume)."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        self.indicator = indicator
+        self.period = indicator.period
+
+    @abc.abstractmethod
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        """Пересчет с нуля: значения по всем свечам (как indicators.compute) и состояние после последней."""
+
+    @abc.abstractmethod
+    def update(self, row: tuple) -> tuple[float, ...]:
+        """Добавляет закрытую свечу и возвращает значения на ней."""
+
+    @abc.abstractmethod
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        """Значения на свече, которая еще не закрыта: состояние не меняется."""
+
+
+class _SmaState(_State):
+    """Кольцо из period цен закрытия и их сумма."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        super().__init__(indicator, timeframe_ms)
+        self.window = deque(maxlen=self.period)
+        self.total = 0.0
+        self.updates = 0
+
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        self.window = deque(candles.close[-self.period:].tolist(), maxlen=self.period)
+        self.total = math.fsum(self.window)
+        return compute(candles, self.indicator)
+
+    def _push(self, close: float):
+        if len(self.window) == self.period:
+            self.total -= self.window[0]
+        self.window.append(close)
+        self.total += close
+        self.updates += 1
+        if self.updates % self.period == 0:
+            self.total = math.fsum(self.window) # Сброс накопленной ошибки округления, в среднем O(1)
+
+    def _mean(self, total: float, count: int) -> float:
+        return total / self.period if count == self.period else math.nan
+
+    def update(self, row: tuple) -> tuple[float, ...]:
+        self._push(row[4])
+        return (self._mean(self.total, len(self.window)),)
+
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        full = len(self.window) == self.period
+        total = self.total - (self.window[0] if full else 0.0) + row[4]
+        return (self._mean(total, min(len(self.window) + 1, self.period)),)
+
+
+class _BollingerState(_SmaState):
+    """Скользящие среднее и сумма квадратов отклонений (вариант Уэлфорда для окна)."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        super().__init__(indicator, timeframe_ms)
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        values = super().build(candles)
+        self._exact()
+        return values
+
+    def _exact(self):
+        window = np.fromiter(self.window, dtype=np.float64, count=len(self.window))
+        self.mean = float(window.mean()) if len(window) else 0.0
+        self.m2 = float(((window - self.mean) ** 2).sum())
+
+    def _step(self, close: float, mean: float, m2: float, count: int) -> tuple[float, float]:
+        if count == self.period:
+            dropped = self.window[0]
+            new_mean = mean + (close - dropped) / self.period
+            return new_mean, m2 + (close - dropped) * (close - new_mean + dropped - mean)
+        new_mean = mean + (close - mean) / (count + 1)
+        return new_mean, m2 + (close - mean) * (close - new_mean)
+
+    def _bands(self, mean: float, m2: float, count: int) -> tuple[float, ...]:
+        if count < self.period:
+            return math.nan, math.nan, math.nan
+        deviation = math.sqrt(max(m2, 0.0) / self.period) * BOLLINGER_WIDTH
+        return mean, mean + deviation, mean - deviation
+
+    def update(self, row: tuple) -> tuple[float, ...]:
+        self.mean, self.m2 = self._step(row[4], self.mean, self.m2, len(self.window))
+        self._push(row[4])
+        if self.updates % self.period == 0:
+            self._exact()
+        return self._bands(self.mean, self.m2, len(self.window))
+
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        mean, m2 = self._step(row[4], self.mean, self.m2, len(self.window))
+        return self._bands(mean, m2, min(len(self.window) + 1, self.period))
+
+
+class _EmaState(_State):
+    """Последнее значение EMA; до period свечей копится сумма для стартового SMA."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        super().__init__(indicator, timeframe_ms)
+        self.alpha = 2.0 / (self.period + 1)
+        self.value = math.nan
+        self.count = 0
+        self.seed_total = 0.0
+
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        values = ema(candles.close, self.period)
+        self.count = len(candles)
+        self.seed_total = float(candles.close[:self.period].sum())
+        self.value = float(values[-1]) if len(values) else math.nan
+        return (values,)
+
+    def _next(self, close: float) -> float:
+        if self.count + 1 < self.period:
+            return math.nan
+        if self.count + 1 == self.period:
+            return (self.seed_total + close) / self.period
+        return self.alpha * close + (1.0 - self.alpha) * self.value
+
+    def update(self, row: tuple) -> tuple[float, ...]:
+        self.value = self._next(row[4])
+        if self.count < self.period:
+            self.seed_total += row[4]
+        self.count += 1
+        return (self.value,)
+
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        return (self._next(row[4]),)
+
+
+class _RsiState(_State):
+    """Сглаженные по Уайлдеру прирост и падение, предыдущая цена закрытия."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        super().__init__(indicator, timeframe_ms)
+        self.previous = None
+        self.deltas = 0
+        self.avg_gain = 0.0 # До period приращений здесь копятся суммы
+        self.avg_loss = 0.0
+
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        closes = candles.close
+        avg_gain, avg_loss = wilder_averages(closes, self.period)
+        self.previous = float(closes[-1]) if len(closes) else None
+        self.deltas = max(len(closes) - 1, 0)
+        if len(avg_gain):
+            self.avg_gain, self.avg_loss = float(avg_gain[-1]), float(avg_loss[-1])
+        else:
+            deltas = np.diff(closes)
+            self.avg_gain, self.avg_loss = float(np.maximum(deltas, 0).sum()), float(np.maximum(-deltas, 0).sum())
+        return compute(candles, self.indicator)
+
+    def _next(self, close: float) -> tuple[int, float, float, float]:
+        if self.previous is None:
+            return 0, 0.0, 0.0, math.nan
+        delta = close - self.previous
+        gain, loss = max(delta, 0.0), max(-delta, 0.0)
+        deltas = self.deltas + 1
+        if deltas < self.period:
+            return deltas, self.avg_gain + gain, self.avg_loss + loss, math.nan
+        if deltas == self.period:
+            avg_gain, avg_loss = (self.avg_gain + gain) / self.period, (self.avg_loss + loss) / self.period
+        else:
+            avg_gain = (self.avg_gain * (self.period - 1) + gain) / self.period
+            avg_loss = (self.avg_loss * (self.period - 1) + loss) / self.period
+        if avg_loss == 0: # Как rsi_from_averages, но без numpy на одном числе
+            return deltas, avg_gain, avg_loss, 50.0 if avg_gain == 0 else 100.0
+        return deltas, avg_gain, avg_loss, 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+    def update(self, row: tuple) -> tuple[float, ...]:
+        self.deltas, self.avg_gain, self.avg_loss, value = self._next(row[4])
+        self.previous = row[4]
+        return (value,)
+
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        return (self._next(row[4])[3],)
+
+
+class _VwapState(_State):
+    """Накопленные цена x объем и объем с начала текущей сессии."""
+    def __init__(self, indicator: Indicator, timeframe_ms: int):
+        super().__init__(indicator, timeframe_ms)
+        self.session_ms = VWAP_SESSION_MS if timeframe_ms < VWAP_SESSION_MS else None
+        self.session = None
+        self.price_volume = 0.0
+        self.volume = 0.0
+
+    def build(self, candles: Candles) -> tuple[np.ndarray, ...]:
+        values = compute(candles, self.indicator)
+        if len(candles) > 1 and not vwap_anchored(candles):
+            self.session_ms = None # Как в пакетном расчете: свечи не мельче сессии
+        current = candles
+        if self.session_ms and len(candles):
+            self.session = int(candles.timestamp[-1]) // self.session_ms
+            current = candles[int(np.searchsorted(candles.timestamp, self.session * self.session_ms)):]
+        typical = (current.high + current.low + current.close) / 3.0
+        self.price_volume, self.volume = float((typical * current.volume).sum()), float(current.volume.sum())
+        return values
+
+    def _next(self, row: tuple) -> tuple[object, float, float, float]:
+        timestamp, _, high, low, close, volume = row
+        session = timestamp // self.session_ms if self.session_ms else None
+        price_volume, total_volume = (self.price_volume, self.volume) if session == self.session else (0.0, 0.0)
+        typical = (high + low + close) / 3.0
+        price_volume += typical * volume
+        total_volume += volume
+        return session, price_volume, total_volume, price_volume / total_volume if total_volume > 0 else typical
+
+    def update(self, row: tuple) -> tuple[float, ...]:
+        self.session, self.price_volume, self.volume, value = self._next(row)
+        return (value,)
+
+    def peek(self, row: tuple) -> tuple[float, ...]:
+        return (self._next(row)[3],)
+
+
+STATES = {
+    "sma": _SmaState,
+    "ema": _EmaState,
+    "bb": _BollingerState,
+    "rsi": _RsiState,
+    "vwap": _VwapState,
+}
+
+
+class IndicatorStream:
+    """
+    Значения индикатора по непрерывному отрезку закрытых свечей ряда [start_ts, last_ts]
+    и состояние для продолжения с last_ts + шаг.
+    """
+    def __init__(self, indicator: Indicator, timeframe_ms: int, candles: Candles):
+        self.indicator = indicator
+        self.timeframe_ms = timeframe_ms
+        self.state = STATES[indicator.name](indicator, timeframe_ms)
+        lines = self.state.build(candles)
+        self.timestamps: list[int] = candles.timestamp.tolist()
+        self.lines: list[list[float]] = [line.tolist() for line in lines]
+
+    @property
+    def start_ts(self) -> int:
+        return self.timestamps[0]
+
+    @property
+    def last_ts(self) -> int:
+        return self.timestamps[-1]
+
+    def extend(self, candles: Candles) -> int:
+        """Добавляет закрытые свечи после last_ts (по одной, O(1) на свечу)."""
+        for row in zip(candles.timestamp.tolist(), candles.open.tolist(), candles.high.tolist(),
+                       candles.low.tolist(), candles.close.tolist(), candles.volume.tolist()):
+            for line, value in zip(self.lines, self.state.update(row)):
+                line.append(value)
+            self.timestamps.append(row[0])
+        return len(candles)
+
+    def trim_before(self, first_ts: int):
+        """Забывает значения раньше first_ts (ряд в хранилище обрезан); состояние не меняется."""
+        cut = bisect.bisect_left(self.timestamps, first_ts)
+        if cut:
+            del self.timestamps[:cut]
+            for line in self.lines:
+                del line[:cut]
+
+    def values_for(self, candles: Candles) -> tuple[np.ndarray, ...] | None:
+        """
+        Значения на свечах candles: закрытые берутся из потока, последняя незакрытая (сразу после last_ts)
+        считается без изменения состояния. None, если поток не покрывает свечи.
+        """
+        timestamps = candles.timestamp
+        closed = int(np.searchsorted(timestamps, self.last_ts, side="right"))
+        if closed == 0 or timestamps[0] < self.start_ts:
+            return None
+        if closed < len(candles) and (len(candles) - closed > 1 or int(timestamps[-1]) != self.last_ts + self.timeframe_ms):
+            return None # После потока больше одной свечи или не следующая свеча
+        lo = bisect.bisect_left(self.timestamps, int(timestamps[0]))
+        hi = lo + closed
+        if hi > len(self.timestamps) or self.timestamps[hi - 1] != int(timestamps[closed - 1]):
+            return None # Внутри окна есть свечи, которых нет в потоке (или наоборот)
+        lines = [np.array(line[lo:hi]) for line in self.lines]
+        if closed < len(candles):
+            row = candles.row(len(candles) - 1)
+            forming = self.state.peek(tuple(row[field] for field in FIELDS))
+            lines = [np.append(line, value) for line, value in zip(lines, forming)]
+        return tuple(lines)
+
+    def latest(self) -> tuple[float, ...]:
+        """Значения на последней закрытой свече."""
+        return tuple(line[-1] for line in self.lines)
+
+
+class IndicatorStreams:
+    """
+    Потоки индикаторов по ключу (пара, таймфрейм, индикатор). Хранилище свечей сообщает о новых
+    свечах ряда (on_series_update): продолжение покрытого отрезка досчитывается по одной свече,
+    правка уже учтенных свечей или пробел перед новыми - поток выбрасывается и при следующем
+    запросе строится заново по ряду.
+    """
+    def __init__(self, max_streams: int = MAX_INDICATOR_STREAMS):
+        self.max_streams = max_streams
+        self._streams: OrderedDict[tuple, IndicatorStream] = OrderedDict()
+        self.served = 0 # Запросов, отданных потоком
+        self.fallbacks = 0 # Поток не покрывает окно - считать пакетно
+        self.rebuilds = 0
+        self.appended = 0 # Свечей, добавленных по одной
+
+    async def values(self, series_key: tuple[str, str], series, indicator: Indicator, candles: Candles) -> tuple[np.ndarray, ...] | None:
+        """
+        Значения индикатора на candles из потока (строится по ряду series при необходимости).
+        Пока поток строится, ряд не должен меняться: хранилище свечей зовет это под блокировкой ряда.
+        """
+        key = series_key + (str(indicator),)
+        stream = self._streams.get(key)
+        lines = stream.values_for(candles) if stream is not None else None
+        if lines is None:
+            stream = await self._build(key, series, indicator, candles)
+            lines = stream.values_for(candles) if stream is not None else None
+        if lines is None:
+            self.fallbacks += 1
+            return None
+        self._streams.move_to_end(key)
+        self.served += 1
+        return lines
+
+    async def _build(self, key: tuple, series, indicator: Indicator, candles: Candles) -> IndicatorStream | None:
+        """
+        Поток по покрытому интервалу ряда, в котором лежат закрытые свечи окна (от начала интервала).
+        Пересчет по всему интервалу (десятки тысяч свечей) - в потоке, на цикле событий остается только extend.
+        """
+        if not len(candles):
+            return None
+        first_ts, last_ts = int(candles.timestamp[0]), int(candles.timestamp[-1])
+        for start, end in series.covered:
+            if start <= first_ts <= end and end >= last_ts - series.timeframe_ms:
+                history = series.window(start, end)
+                if not len(history):
+                    return None
+                stream = await asyncio.to_thread(IndicatorStream, indicator, series.timeframe_ms, history)
+                self._streams[key] = stream
+                self._streams.move_to_end(key)
+                self.rebuilds += 1
+                while len(self._streams) > self.max_streams:
+                    self._streams.popitem(last=False)
+                logger.debug(f"Поток индикатора {key} построен по {len(history)} свечам.")
+                return stream
+        return None
+
+    def on_series_update(self, series_key: tuple[str, str], series, revised_from: int | None):
+        """
+        Ряд series изменился: revised_from - самая ранняя метка среди влитых свечей.
+        Потоки ключа либо продолжаются новыми закрытыми свечами, либо выбрасываются.
+        """
+        keys = [key for key in self._streams if key[:2] == series_key]
+        for key in keys:
+            stream = self._streams[key]
+            if revised_from is not None and stream.start_ts <= revised_from <= stream.last_ts:
+                del self._streams[key] # Правка уже учтенной истории
+                continue
+            covered_end = next((end for start, end in series.covered if start <= stream.last_ts <= end), None)
+            if covered_end is None:
+                del self._streams[key] # Отрезок потока выпал из ряда (обрезка)
+                continue
+            if covered_end > stream.last_ts:
+                self.appended += stream.extend(series.window(stream.last_ts + 1, covered_end))
+            if len(series):
+                stream.trim_before(int(series.candles.timestamp[0]))
+
+    def latest(self, series_key: tuple[str, str], indicator: Indicator) -> tuple[float, ...] | None:
+        """Значения на последней закрытой свече без пересчета (для алертов и т.п.); None, если потока нет."""
+        stream = self._streams.get(series_key + (str(indicator),))
+        return stream.latest() if stream is not None else None
+
+    def drop(self, series_key: tuple[str, str]):
+        for key in [key for key in self._streams if key[:2] == series_key]:
+            del self._streams[key]
+
+    def clear(self):
+        self._streams.clear()
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "served": self.served,
+            "fallbacks": self.fallbacks,
+            "rebuilds": self.rebuilds,
+            "appended": self.appended,
+        }
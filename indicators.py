@@ -0,0 +1,224 @@
+import re
+import math
+
+import numpy as np
+
+from candles import Candles
+
+# -------------------- Технические индикаторы --------------------
+# Все считается numpy по колонкам Candles целиком, без цикла по свечам
+INDICATOR_DEFAULT_PERIODS = {"sma": 20, "ema": 20, "bb": 20, "rsi": 14, "vwap": None} # Период, если в запросе только имя
+MAX_INDICATOR_PERIOD = 500
+MAX_INDICATORS = 5 # Сколько индикаторов можно заказать в одном запросе
+BOLLINGER_WIDTH = 2.0 # Ширина полос Боллинджера в стандартных отклонениях
+EMA_WARMUP = 3 # EMA/RSI "помнят" начало ряда: для точности нужно около 3 периодов истории до первой видимой свечи
+VWAP_SESSION_MS = 86_400_000 # VWAP считается заново с начала каждых суток UTC (на дневках и выше - по всему окну)
+RSI_LEVELS = (30, 70)
+
+_TOKEN = re.compile(r"([a-z]+)(\d*)")
+
+
+class Indicator:
+    """Индикатор из запроса: имя и период (ema20, rsi14, vwap)."""
+    __slots__ = ("name", "period")
+
+    def __init__(self, name: str, period: int | None):
+        self.name = name
+        self.period = period
+
+    @classmethod
+    def parse(cls, token: str) -> "Indicator":
+        """'ema20' -> Indicator('ema', 20). ValueError с понятным пользователю текстом, если токен не индикатор."""
+        match = _TOKEN.fullmatch(token.strip().lower())
+        if not match or match.group(1) not in INDICATOR_DEFAULT_PERIODS:
+            raise ValueError(f"неизвестный индикатор '{token}' (доступны: {', '.join(INDICATOR_DEFAULT_PERIODS)})")
+        name, digits = match.groups()
+        default = INDICATOR_DEFAULT_PERIODS[name]
+        if default is None:
+            if digits:
+                raise ValueError(f"у {name} нет периода")
+            return cls(name, None)
+        period = int(digits) if digits else default
+        if not 2 <= period <= MAX_INDICATOR_PERIOD:
+            raise ValueError(f"период {name} должен быть от 2 до {MAX_INDICATOR_PERIOD}")
+        return cls(name, period)
+
+    @property
+    def panel(self) -> str:
+        """Где рисуется: "price" - поверх свечей, "rsi" - на отдельной панели."""
+        return "rsi" if self.name == "rsi" else "price"
+
+    @property
+    def lookback(self) -> int:
+        """Сколько свечей истории нужно до первой видимой, чтобы значение на ней было точным."""
+        if self.period is None:
+            return 0
+        if self.name in ("ema", "rsi"):
+            return self.period * EMA_WARMUP
+        return self.period - 1
+
+    def __str__(self) -> str:
+        return f"{self.name}{self.period or ''}"
+
+    def __repr__(self) -> str:
+        return f"Indicator({self})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Indicator) and (self.name, self.period) == (other.name, other.period)
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.period))
+
+
+def parse_indicators(tokens: list[str]) -> list[Indicator]:
+    """Токены запроса в индикаторы без повторов. ValueError на неизвестном токене или если их слишком много."""
+    indicators = list(dict.fromkeys(Indicator.parse(token) for token in tokens))
+    if len(indicators) > MAX_INDICATORS:
+        raise ValueError(f"не больше {MAX_INDICATORS} индикаторов за раз")
+    return indicators
+
+
+def indicators_lookback(indicators: list[Indicator]) -> int:
+    return max((indicator.lookback for indicator in indicators), default=0)
+
+
+def _nan(n: int) -> np.ndarray:
+    return np.full(n, np.nan)
+
+
+def sma(values: np.ndarray, period: int) -> np.ndarray:
+    """Скользящее среднее; первые period-1 значений - NaN."""
+    values = np.asarray(values, dtype=np.float64)
+    out = _nan(len(values))
+    if len(values) < period:
+        return out
+    # Сдвиг на первое значение: меньше потеря точности в длинной накопленной сумме
+    sums = np.cumsum(np.r_[0.0, values - values[0]])
+    out[period - 1:] = (sums[period:] - sums[:-period]) / period + values[0]
+    return out
+
+
+def ema_recursive(values: np.ndarray, alpha: float, seed: float) -> np.ndarray:
+    """
+    y[i] = alpha * x[i] + (1 - alpha) * y[i-1], y[-1] = seed.
+    Внутри блока рекурсия раскрывается в накопленную сумму с весами (1 - alpha)^-j; блок ограничен так,
+    чтобы веса не переполнились, поэтому цикл идет по блокам (тысячи свечей), а не по свечам.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    decay = 1.0 - alpha
+    out = np.empty(len(values))
+    if decay <= 0.0:
+        out[:] = values
+        return out
+    block = max(1, int(230 / -math.log(decay))) # (1 - alpha)^-block не больше ~1e100
+    weights = decay ** -np.arange(min(block, len(values)), dtype=np.float64)
+    previous = seed
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        scale = weights[:len(chunk)]
+        result = (previous * decay + alpha * np.cumsum(chunk * scale)) / scale
+        out[start:start + len(chunk)] = result
+        previous = result[-1]
+    return out
+
+
+def ema(values: np.ndarray, period: int) -> np.ndarray:
+    """Экспоненциальное среднее (alpha = 2 / (period + 1)), начало - SMA первых period значений."""
+    values = np.asarray(values, dtype=np.float64)
+    out = _nan(len(values))
+    if len(values) < period:
+        return out
+    out[period - 1] = values[:period].mean()
+    out[period:] = ema_recursive(values[period:], 2.0 / (period + 1), out[period - 1])
+    return out
+
+
+def rolling_std(values: np.ndarray, period: int) -> np.ndarray:
+    """Стандартное отклонение по окну (ddof=0). Окна считаются блоками, чтобы не держать n x period значений разом."""
+    values = np.asarray(values, dtype=np.float64)
+    out = _nan(len(values))
+    if len(values) < period:
+        return out
+    windows = np.lib.stride_tricks.sliding_window_view(values, period)
+    rows = max(1, (1 << 20) // period)
+    for start in range(0, len(windows), rows):
+        out[period - 1 + start:period - 1 + start + rows] = windows[start:start + rows].std(axis=1)
+    return out
+
+
+def bollinger(values: np.ndarray, period: int, width: float = BOLLINGER_WIDTH) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Полосы Боллинджера: (средняя, верхняя, нижняя)."""
+    middle = sma(values, period)
+    deviation = rolling_std(values, period) * width
+    return middle, middle + deviation, middle - deviation
+
+
+def wilder_averages(closes: np.ndarray, period: int) -> tuple[np.ndarray, np.ndarray]:
+    """Сглаженные по Уайлдеру приросты и падения для свечей period..n-1 (пустые, если свечей не больше period)."""
+    closes = np.asarray(closes, dtype=np.float64)
+    if len(closes) <= period:
+        return np.empty(0), np.empty(0)
+    deltas = np.diff(closes)
+    gains, losses = np.maximum(deltas, 0.0), np.maximum(-deltas, 0.0)
+    avg_gain = np.r_[gains[:period].mean(), ema_recursive(gains[period:], 1.0 / period, gains[:period].mean())]
+    avg_loss = np.r_[losses[:period].mean(), ema_recursive(losses[period:], 1.0 / period, losses[:period].mean())]
+    return avg_gain, avg_loss
+
+
+def rsi_from_averages(avg_gain, avg_loss):
+    """RSI по сглаженным приростам и падениям (массивы или числа)."""
+    avg_gain, avg_loss = np.asarray(avg_gain, dtype=np.float64), np.asarray(avg_loss, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+    values = np.where(avg_loss == 0, 100.0, values) # Только росты
+    return np.where((avg_loss == 0) & (avg_gain == 0), 50.0, values) # Ряд стоит на месте
+
+
+def rsi(closes: np.ndarray, period: int) -> np.ndarray:
+    """RSI Уайлдера: сглаживание приростов и падений с alpha = 1 / period. Первые period значений - NaN."""
+    out = _nan(len(closes))
+    avg_gain, avg_loss = wilder_averages(closes, period)
+    if len(avg_gain):
+        out[period:] = rsi_from_averages(avg_gain, avg_loss)
+    return out
+
+
+def vwap_anchored(candles: Candles, session_ms: int | None = VWAP_SESSION_MS) -> bool:
+    """Сбрасывать ли VWAP по сессиям: только если свечи мельче сессии."""
+    return bool(session_ms) and len(candles) > 1 and np.median(np.diff(candles.timestamp)) < session_ms
+
+
+def vwap(candles: Candles, session_ms: int | None = VWAP_SESSION_MS) -> np.ndarray:
+    """
+    VWAP по типичной цене (high + low + close) / 3. С session_ms накопление начинается заново
+    на каждой границе сессии; если свечи не мельче сессии - одно накопление по всему окну.
+    """
+    typical = (candles.high + candles.low + candles.close) / 3.0
+    volume = candles.volume
+    price_volume = np.cumsum(typical * volume)
+    total_volume = np.cumsum(volume)
+    if vwap_anchored(candles, session_ms):
+        sessions = candles.timestamp // session_ms
+        starts = np.flatnonzero(np.r_[True, sessions[1:] != sessions[:-1]])
+        lengths = np.diff(np.r_[starts, len(candles)])
+        # Вычитаем накопленное до начала своей сессии
+        price_volume = price_volume - np.repeat(np.r_[0.0, price_volume][starts], lengths)
+        total_volume = total_volume - np.repeat(np.r_[0.0, total_volume][starts], lengths)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total_volume > 0, price_volume / total_volume, typical)
+
+
+def compute(candles: Candles, indicator: Indicator) -> tuple[np.ndarray, ...]:
+    """Линии индикатора той же длины, что и свечи (у bb - три линии, у остальных одна)."""
+    closes = candles.close
+    if indicator.name == "sma":
+        return (sma(closes, indicator.period),)
+    if indicator.name == "ema":
+        return (ema(closes, indicator.period),)
+    if indicator.name == "bb":
+        return bollinger(closes, indicator.period)
+    if indicator.name == "rsi":
+        return (rsi(closes, indicator.period),)
+    if indicator.name == "vwap":
+        return (vwap(candles),)
+    raise ValueError(f"Неизвестный индикатор: {indicator}")
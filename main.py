@@ -3,20 +3,18 @@ import asyncio
 import logging
 import time
 import aiohttp
-import matplotlib
 import json
 import base64
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import yaml
 from datetime import datetime, timedelta, timezone
 import uuid
 import re
 from functools import wraps
+from typing import Awaitable, Callable
 
 from aiogram import Bot, Dispatcher, types
 from aiogram import F
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, BufferedInputFile
 from aiogram.filters import Command
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -25,6 +23,16 @@ from aiogram.exceptions import TelegramBadRequest, TelegramAPIError # Для о
 from aiogram.utils.markdown import hbold, hcode, hitalic, hlink # Импортируем хелперы разметки
 
 import description # Авто апдейт курса бтс и етх
+from access_lists import UserList # Whitelist/banlist в памяти
+from api_client import ApiClient, SingleFlight # Общий пул соединений к API и склейка одинаковых запросов
+from candle_cache import CandleStore, count_candles_in_range, timeframe_to_ms # Хранилище свечей в памяти с индексом покрытия
+from disk_cache import DiskCandleStore # Второй уровень хранилища свечей на диске
+from candles import Candles # Колоночный контейнер свечей (numpy)
+from charts import ChartRenderer # Отрисовка графиков в пуле процессов
+from render_queue import RenderScheduler, RenderQueueFull, PRIORITY_NORMAL, render_priority # Очередь отрисовки с приоритетами
+from chart_cache import ChartCache, CachedChart # Кэш готовых графиков и их file_id
+from image_encoding import EncodedImage # Закодированный график (формат, размер, время кодирования)
+from indicators import Indicator, parse_indicators, indicators_lookback # SMA/EMA/Bollinger/RSI/VWAP для графиков
 
 # -------------------- Настройки и логирование --------------------
 LOGS_DIR = "logs" # Если хочеться, поменяй
@@ -58,51 +66,20 @@ WHITELIST_FILE = "whitelist.yaml" # тоже можно сменить
 WHITELIST_ENABLED = True # форсированный вайтлист, сбрасываеться на значение True после каждого перезапуска, по необходимости отключаеться в админ панели.
 ADMIN_ID = 123456789 # Смени на свой ID
 
-def load_whitelist():
-    start_time = time.time()
-    logger.info("Загрузка whitelist...")
-    try:
-        if not os.path.exists(WHITELIST_FILE):
-            logger.warning(f"Файл {WHITELIST_FILE} не найден. Создание нового с администратором.")
-            whitelist = [{"id": ADMIN_ID, "username": "@admin_username"}] # замени на свой
-            with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
-                yaml.dump(whitelist, f, allow_unicode=True)
-            logger.info(f"Whitelist создан. Добавлен админ ID: {ADMIN_ID}. Время: {time.time() - start_time:.4f} сек.")
-            return whitelist
-        with open(WHITELIST_FILE, "r", encoding="utf-8") as f:
-            whitelist = yaml.safe_load(f) or []
-            if not any(user["id"] == ADMIN_ID for user in whitelist):
-                 logger.warning(f"Админ ID {ADMIN_ID} не найден в whitelist. Добавляем.")
-                 whitelist.append({"id": ADMIN_ID, "username": "@admin_username"}) # и тут я, замени
-                 save_whitelist(whitelist)
-
-            logger.info(f"Whitelist загружен ({len(whitelist)} пользователей). Время: {time.time() - start_time:.4f} сек.")
-            return whitelist
-    except Exception as e:
-        logger.error(f"Ошибка загрузки whitelist из {WHITELIST_FILE}: {e}. Время: {time.time() - start_time:.4f} сек.", exc_info=True)
-        # Замени админа
-        return [{"id": ADMIN_ID, "username": "@admin_username"}]
+# Индекс в памяти (access_lists.UserList): проверки доступа не читают файл, он перечитывается только после изменения
+whitelist_index = UserList(WHITELIST_FILE, required=[{"id": ADMIN_ID, "username": "@admin_username"}]) # замени на свой
 
-def save_whitelist(whitelist):
-    start_time = time.time()
-    logger.info("Сохранение whitelist...")
-    try:
-        with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
-            yaml.dump(whitelist, f, allow_unicode=True)
-        logger.info(f"Whitelist сохранен ({len(whitelist)} пользователей). Время: {time.time() - start_time:.4f} сек.")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения whitelist в {WHITELIST_FILE}: {e}. Время: {time.time() - start_time:.4f} сек.")
+def load_whitelist():
+    """Whitelist списком записей (файл перечитывается, только если изменился)."""
+    whitelist_index.refresh()
+    return whitelist_index.users()
 
 def is_whitelisted(user_id: int) -> bool:
-    start_time = time.time()
     if user_id == ADMIN_ID:
          return True
     if not WHITELIST_ENABLED:
         return True
-    whitelist = load_whitelist()
-    whitelisted = any(user["id"] == user_id for user in whitelist)
-    logger.debug(f"Результат проверки whitelist для {user_id}: {whitelisted}. Время: {time.time() - start_time:.4f} сек.")
-    return whitelisted
+    return user_id in whitelist_index
 
 def add_to_whitelist(user_id: int, username: str):
     start_time = time.time()
@@ -110,49 +87,31 @@ def add_to_whitelist(user_id: int, username: str):
     # Добавляем '@' если его нет и username не похож на ID_xxx
     safe_username = username if username.startswith('@') or username.startswith('ID_') else f"@{username}"
 
-    whitelist = load_whitelist()
-    if not any(user["id"] == user_id for user in whitelist):
-        whitelist.append({"id": user_id, "username": safe_username})
-        save_whitelist(whitelist)
+    result = whitelist_index.put(user_id, safe_username)
+    if result == "added":
         logger.info(f"УСПЕШНО: Добавлен в whitelist: {safe_username} ({user_id}). Время: {time.time() - start_time:.4f} сек.")
+    elif result == "updated":
+        logger.info(f"Обновлен username в whitelist для {user_id} на {safe_username}. Время: {time.time() - start_time:.4f} сек.")
     else:
-        updated = False
-        for user in whitelist:
-            if user["id"] == user_id and user.get("username") != safe_username:
-                user["username"] = safe_username
-                updated = True
-                break
-        if updated:
-             save_whitelist(whitelist)
-             logger.info(f"Обновлен username в whitelist для {user_id} на {safe_username}. Время: {time.time() - start_time:.4f} сек.")
-        else:
-             logger.info(f"Пользователь {safe_username} ({user_id}) уже в whitelist. Время: {time.time() - start_time:.4f} сек.")
+        logger.info(f"Пользователь {safe_username} ({user_id}) уже в whitelist. Время: {time.time() - start_time:.4f} сек.")
 
 def remove_from_whitelist(identifier: str) -> bool:
     start_time = time.time()
     logger.info(f"Попытка удаления из whitelist: идентификатор={identifier}")
-    whitelist = load_whitelist()
-    initial_len = len(whitelist)
     clean_identifier = identifier.strip()
-    is_username = clean_identifier.startswith('@')
 
-    if is_username:
-        new_whitelist = [user for user in whitelist if user.get("username") != clean_identifier]
+    if clean_identifier.startswith('@'):
+        target_id = whitelist_index.id_by_username(clean_identifier)
     else:
          try:
              target_id = int(clean_identifier)
-             new_whitelist = [user for user in whitelist if user["id"] != target_id]
          except ValueError:
               logger.warning(f"Неверный формат идентификатора для удаления из WL (не ID и не @username): {identifier}")
               return False
 
-    if len(new_whitelist) < initial_len:
-        removed_user = next((user for user in whitelist if (is_username and user.get("username") == clean_identifier) or (not is_username and user["id"] == target_id)), None)
-        save_whitelist(new_whitelist)
-        if removed_user:
-             logger.info(f"УСПЕШНО: Удален из whitelist: {removed_user.get('username','N/A')} ({removed_user['id']}). Идентификатор: {identifier}. Время: {time.time() - start_time:.4f} сек.")
-        else:
-             logger.info(f"УСПЕШНО: Пользователь с идентификатором {identifier} удален из whitelist. Время: {time.time() - start_time:.4f} сек.")
+    removed_user = whitelist_index.remove(target_id) if target_id is not None else None
+    if removed_user:
+        logger.info(f"УСПЕШНО: Удален из whitelist: {removed_user.get('username','N/A')} ({removed_user['id']}). Идентификатор: {identifier}. Время: {time.time() - start_time:.4f} сек.")
         return True
     else:
         logger.warning(f"НЕУДАЧА: Пользователь с идентификатором {identifier} не найден в whitelist. Время: {time.time() - start_time:.4f} сек.")
@@ -160,42 +119,17 @@ def remove_from_whitelist(identifier: str) -> bool:
 
 # -------------------- Banlist --------------------
 BANLIST_FILE = "banlist.yaml" # так же сменить по желанию
+banlist_index = UserList(BANLIST_FILE)
 
 def load_banlist():
-    start_time = time.time()
-    logger.info("Загрузка banlist...")
-    try:
-        if not os.path.exists(BANLIST_FILE):
-            logger.warning(f"Файл {BANLIST_FILE} не найден. Создание пустого.")
-            with open(BANLIST_FILE, "w", encoding="utf-8") as f: yaml.dump([], f)
-            logger.info(f"Banlist создан. Время: {time.time() - start_time:.4f} сек.")
-            return []
-        with open(BANLIST_FILE, "r", encoding="utf-8") as f:
-            banlist = yaml.safe_load(f) or []
-            logger.info(f"Banlist загружен ({len(banlist)} пользователей). Время: {time.time() - start_time:.4f} сек.")
-            return banlist
-    except Exception as e:
-        logger.error(f"Ошибка загрузки banlist из {BANLIST_FILE}: {e}. Время: {time.time() - start_time:.4f} сек.", exc_info=True)
-        return []
-
-def save_banlist(banlist):
-    start_time = time.time()
-    logger.info("Сохранение banlist...")
-    try:
-        with open(BANLIST_FILE, "w", encoding="utf-8") as f:
-            yaml.dump(banlist, f, allow_unicode=True)
-        logger.info(f"Banlist сохранен ({len(banlist)} пользователей). Время: {time.time() - start_time:.4f} сек.")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения banlist в {BANLIST_FILE}: {e}. Время: {time.time() - start_time:.4f} сек.")
+    """Banlist списком записей (файл перечитывается, только если изменился)."""
+    banlist_index.refresh()
+    return banlist_index.users()
 
 def is_banned(user_id: int) -> bool:
-    start_time = time.time()
     if user_id == ADMIN_ID:
         return False
-    banlist = load_banlist()
-    banned = any(user["id"] == user_id for user in banlist)
-    logger.debug(f"Результат проверки banlist для {user_id}: {banned}. Время: {time.time() - start_time:.4f} сек.")
-    return banned
+    return user_id in banlist_index
 
 def ban_user(user_id: int, username: str):
     start_time = time.time()
@@ -205,40 +139,22 @@ def ban_user(user_id: int, username: str):
         return False
 
     safe_username = username if username.startswith('@') or username.startswith('ID_') else f"@{username}"
-    banlist = load_banlist()
-    if not any(user["id"] == user_id for user in banlist):
-        banlist.append({"id": user_id, "username": safe_username})
-        save_banlist(banlist)
+    result = banlist_index.put(user_id, safe_username)
+    if result == "added":
         logger.info(f"УСПЕШНО: Забанен пользователь: {safe_username} ({user_id}). Время: {time.time() - start_time:.4f} сек.")
         return True
+    if result == "updated":
+         logger.info(f"Обновлен username в banlist для {user_id} на {safe_username}. Время: {time.time() - start_time:.4f} сек.")
     else:
-        updated = False
-        for user in banlist:
-            if user["id"] == user_id and user.get("username") != safe_username:
-                user["username"] = safe_username
-                updated = True
-                break
-        if updated:
-             save_banlist(banlist)
-             logger.info(f"Обновлен username в banlist для {user_id} на {safe_username}. Время: {time.time() - start_time:.4f} сек.")
-        else:
-             logger.warning(f"НЕУДАЧА: Пользователь {safe_username} ({user_id}) уже забанен. Время: {time.time() - start_time:.4f} сек.")
-        return False
+         logger.warning(f"НЕУДАЧА: Пользователь {safe_username} ({user_id}) уже забанен. Время: {time.time() - start_time:.4f} сек.")
+    return False
 
 def unban_user(user_id: int) -> bool:
     start_time = time.time()
     logger.info(f"Попытка разбана пользователя: id={user_id}")
-    banlist = load_banlist()
-    initial_len = len(banlist)
-    new_banlist = [user for user in banlist if user["id"] != user_id]
-
-    if len(new_banlist) < initial_len:
-        removed_user = next((user for user in banlist if user["id"] == user_id), None)
-        save_banlist(new_banlist)
-        if removed_user:
-            logger.info(f"УСПЕШНО: Разбанен пользователь: {removed_user.get('username', 'N/A')} ({user_id}). Время: {time.time() - start_time:.4f} сек.")
-        else:
-             logger.info(f"УСПЕШНО: Пользователь с ID {user_id} разбанен. Время: {time.time() - start_time:.4f} сек.")
+    removed_user = banlist_index.remove(user_id)
+    if removed_user:
+        logger.info(f"УСПЕШНО: Разбанен пользователь: {removed_user.get('username', 'N/A')} ({user_id}). Время: {time.time() - start_time:.4f} сек.")
         return True
     else:
         logger.warning(f"НЕУДАЧА: Пользователь с ID {user_id} не найден в banlist. Время: {time.time() - start_time:.4f} сек.")
@@ -426,6 +342,17 @@ API_TOKEN = '' # Токен телеграм бота
 API_BASE_URL = '' # Урл АПИ
 API_AUTH_HEADER = {""} # Ключ АПИ
 
+# Общий клиент API (пул соединений), создается в main()
+api_client: ApiClient | None = None
+MAX_RANGE_CANDLES = 50_000 # Максимум свечей в запросе по диапазону дат (качаются кусками по 1000)
+MAX_COMPARE_SYMBOLS = 5 # Пар на одном графике сравнения (cmp btcusdt,ethusdt,solusdt 60 500)
+COMPARE_FETCH_CONCURRENCY = 4 # Сколько пар сравнения качаем одновременно
+CLOSE_PRICES_ENDPOINT_FALLBACK = False # Если свечи получить не удалось, пробовать отдельный эндпоинт /candles/close
+# Горячие пары: из API качается только базовый таймфрейм, остальные собираются из него локально
+RESAMPLE_HOT_PAIRS = {"btcusdt": "5", "ethusdt": "5"}
+CANDLE_DISK_ENABLED = True # Хранить закрытые свечи на диске, чтобы после перезапуска не качать их заново
+CANDLE_DISK_DIR = "candles_cache" # Можно сменить
+
 # -------------------- Отголоски WebApp--------------------
 # WEBAPP_URL = "" # <-- ЗАМЕНИТЬ!
 # if WEBAPP_URL == "":
@@ -439,7 +366,8 @@ bot = Bot(token=API_TOKEN)
 dp = Dispatcher(storage=storage)
 
 # -------------------- Декоратор для логирования времени выполнения --------------------
-def log_execution_time(is_api_call=False):
+def log_execution_time(is_api_call=False, reraise: tuple[type[Exception], ...] = ()):
+    """reraise - исключения, которые не глушатся, а уходят вызывающему (например, RenderQueueFull для ответа "занято")."""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -456,6 +384,9 @@ def log_execution_time(is_api_call=False):
                     logger.info(f"УСПЕШНО: API вызов {func_name} завершен. Время: {time.time() - start_time:.4f} сек.")
                 elif not is_api_call:
                      logger.info(f"УСПЕШНО: Функция {func_name} завершена. Время: {time.time() - start_time:.4f} сек.")
+            except reraise as e:
+                logger.warning(f"{func_name} прерван: {e}. Время: {time.time() - start_time:.4f} сек.")
+                raise
             except TelegramAPIError as e: # Ловим ошибки API отдельно
                 logger.error(f"ОШИБКА Telegram API в {func_name}: {e}. Время: {time.time() - start_time:.4f} сек.", exc_info=True)
             except Exception as e:
@@ -470,19 +401,19 @@ def log_execution_time(is_api_call=False):
 async def check_api_auth():
     """Проверяет доступность API и авторизацию при старте."""
     logger.info("Проверка авторизации API...")
-    test_url = f"{API_BASE_URL}/candles/latest/btcusdt/1"
+    test_path = "/candles/latest/btcusdt/1"
+    test_url = api_client.url(test_path)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(test_url, headers=API_AUTH_HEADER, timeout=10) as response:
-                if response.status == 200:
-                    logger.info(f"УСПЕШНО: API авторизация и доступ подтверждены. Статус: {response.status}.")
-                    return True
-                elif response.status in [401, 403]:
-                     logger.error(f"ОШИБКА АВТОРИЗАЦИИ API: Неверный API ключ? Статус: {response.status}.")
-                     return False
-                else:
-                    logger.error(f"ОШИБКА ДОСТУПА К API: Сервер ответил со статусом {response.status}. URL: {test_url}.")
-                    return False
+        async with api_client.get(test_path, timeout=10) as response:
+            if response.status == 200:
+                logger.info(f"УСПЕШНО: API авторизация и доступ подтверждены. Статус: {response.status}.")
+                return True
+            elif response.status in [401, 403]:
+                 logger.error(f"ОШИБКА АВТОРИЗАЦИИ API: Неверный API ключ? Статус: {response.status}.")
+                 return False
+            else:
+                logger.error(f"ОШИБКА ДОСТУПА К API: Сервер ответил со статусом {response.status}. URL: {test_url}.")
+                return False
     except aiohttp.ClientConnectorError as e:
          logger.error(f"ОШИБКА СОЕДИНЕНИЯ С API: Не удалось подключиться к {API_BASE_URL}. Ошибка: {e}.")
          return False
@@ -497,32 +428,79 @@ async def check_api_auth():
 
 api_call_logger = log_execution_time(is_api_call=True)
 
+# Хранилище свечей: из API докачиваются только недостающие интервалы, закрытые свечи лежат и на диске
+candle_store = CandleStore(disk=DiskCandleStore(CANDLE_DISK_DIR) if CANDLE_DISK_ENABLED else None)
+# Одновременные одинаковые запросы к API идут наверх один раз
+api_flight = SingleFlight()
+
 @api_call_logger
-async def get_candles(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> list[dict] | None:
-    url = f"{API_BASE_URL}/candles/{symbol.lower()}/{timeframe}"
+async def get_candles(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> Candles | None:
+    """
+    Отдает свечи из хранилища, докачивая из API только отсутствующие интервалы.
+    Крупный таймфрейм собирается из более мелкого ряда, если он уже есть (или пара горячая).
+    """
+    base_timeframe = candle_store.pick_base_timeframe(symbol, timeframe, limit, start_ts, end_ts, hot_base_timeframe=RESAMPLE_HOT_PAIRS.get(symbol.lower()))
+    if base_timeframe is not None:
+        return await candle_store.get_resampled(symbol, timeframe, base_timeframe, limit, start_ts, end_ts, fetch=fetch_candles_from_api)
+    return await candle_store.get_candles(symbol, timeframe, limit, start_ts, end_ts, fetch=fetch_candles_from_api)
+
+async def get_candles_with_history(symbol: str, timeframe: str, limit: int, start_ts: int | None, end_ts: int | None, lookback: int) -> tuple[Candles | None, int | None]:
+    """
+    Свечи запроса и еще lookback свечей перед ними - история для разгона индикаторов.
+    Второе значение - сколько последних свечей относится к самому запросу (None, если истории нет).
+    """
+    tf_ms = timeframe_to_ms(timeframe)
+    if not lookback or tf_ms is None:
+        return await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts), None
+    if start_ts is not None:
+        candles = await get_candles(symbol, timeframe, limit=limit + lookback, start_ts=start_ts - lookback * tf_ms, end_ts=end_ts)
+        return candles, (len(candles.window(start_ts, end_ts)) if candles is not None else None)
+    candles = await get_candles(symbol, timeframe, limit=limit + lookback)
+    return candles, (min(limit, len(candles)) if candles is not None else None)
+
+async def get_compare_candles(symbols: list[str], timeframe: str, limit: int, start_ts: int | None = None, end_ts: int | None = None) -> dict[str, Candles]:
+    """
+    Свечи нескольких пар параллельно (не больше COMPARE_FETCH_CONCURRENCY разом), общее время - как у самой долгой.
+    Пары, по которым данных нет, в ответ не попадают.
+    """
+    semaphore = asyncio.Semaphore(COMPARE_FETCH_CONCURRENCY)
+
+    async def fetch_symbol(symbol: str) -> Candles | None:
+        async with semaphore:
+            return await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
+
+    results = await asyncio.gather(*(fetch_symbol(symbol) for symbol in symbols))
+    missing = [symbol for symbol, candles in zip(symbols, results) if not candles]
+    if missing:
+        logger.warning(f"Сравнение {','.join(symbols)}/{timeframe}: нет данных по {', '.join(missing)}")
+    return {symbol: candles for symbol, candles in zip(symbols, results) if candles}
+
+@api_flight.coalesce("candles")
+async def fetch_candles_from_api(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> Candles | None:
+    path = f"/candles/{symbol.lower()}/{timeframe}"
+    url = api_client.url(path)
     params = {"limit": limit}
     if start_ts is not None: params["start_ts"] = start_ts
     if end_ts is not None: params["end_ts"] = end_ts
     param_str = '&'.join([f"{k}={v}" for k, v in params.items()])
     logger.info(f"Запрос API: {url}?{param_str}")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, headers=API_AUTH_HEADER, timeout=30) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if isinstance(data, list):
-                         logger.info(f"API вернуло {len(data)} свечей для {symbol}/{timeframe}.")
-                         return data
-                    else:
-                        logger.error(f"API вернуло не список для {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
-                        return None
-                elif response.status == 422:
-                     error_details = await response.json()
-                     logger.error(f"Ошибка валидации данных API (422) для {symbol}/{timeframe}. Параметры: {params}. Детали: {error_details}")
-                     return None
+        async with api_client.get(path, endpoint="candles", params=params, timeout=30) as response:
+            if response.status == 200:
+                data = await response.json()
+                if isinstance(data, list):
+                     logger.info(f"API вернуло {len(data)} свечей для {symbol}/{timeframe}.")
+                     return Candles.from_json(data)
                 else:
-                    logger.error(f"Ошибка API при запросе свечей {symbol}/{timeframe}. Статус: {response.status}. Параметры: {params}. Ответ: {await response.text()}")
+                    logger.error(f"API вернуло не список для {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
                     return None
+            elif response.status == 422:
+                 error_details = await response.json()
+                 logger.error(f"Ошибка валидации данных API (422) для {symbol}/{timeframe}. Параметры: {params}. Детали: {error_details}")
+                 return None
+            else:
+                logger.error(f"Ошибка API при запросе свечей {symbol}/{timeframe}. Статус: {response.status}. Параметры: {params}. Ответ: {await response.text()}")
+                return None
     except aiohttp.ClientConnectorError as e:
          logger.error(f"Ошибка соединения с API при запросе {symbol}/{timeframe}: {e}")
          return None
@@ -534,31 +512,32 @@ async def get_candles(symbol: str, timeframe: str, limit: int = 1000, start_ts:
         return None
 
 @api_call_logger
-async def get_close_prices(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> list[dict] | None:
-    url = f"{API_BASE_URL}/candles/close/{symbol.lower()}/{timeframe}"
+@api_flight.coalesce("close")
+async def get_close_prices(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> Candles | None:
+    path = f"/candles/close/{symbol.lower()}/{timeframe}"
+    url = api_client.url(path)
     params = {"limit": limit}
     if start_ts is not None: params["start_ts"] = start_ts
     if end_ts is not None: params["end_ts"] = end_ts
     param_str = '&'.join([f"{k}={v}" for k, v in params.items()])
     logger.info(f"Запрос API (close): {url}?{param_str}")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, headers=API_AUTH_HEADER, timeout=30) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if isinstance(data, list):
-                        logger.info(f"API вернуло {len(data)} цен закрытия для {symbol}/{timeframe}.")
-                        return data
-                    else:
-                        logger.error(f"API вернуло не список для close {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
-                        return None
-                elif response.status == 422:
-                     error_details = await response.json()
-                     logger.error(f"Ошибка валидации данных API (422) для close {symbol}/{timeframe}. Параметры: {params}. Детали: {error_details}")
-                     return None
+        async with api_client.get(path, endpoint="close", params=params, timeout=30) as response:
+            if response.status == 200:
+                data = await response.json()
+                if isinstance(data, list):
+                    logger.info(f"API вернуло {len(data)} цен закрытия для {symbol}/{timeframe}.")
+                    return Candles.from_json(data) # Заполнены только timestamp и close
                 else:
-                    logger.error(f"Ошибка API при запросе цен закрытия {symbol}/{timeframe}. Статус: {response.status}. Параметры: {params}. Ответ: {await response.text()}")
+                    logger.error(f"API вернуло не список для close {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
                     return None
+            elif response.status == 422:
+                 error_details = await response.json()
+                 logger.error(f"Ошибка валидации данных API (422) для close {symbol}/{timeframe}. Параметры: {params}. Детали: {error_details}")
+                 return None
+            else:
+                logger.error(f"Ошибка API при запросе цен закрытия {symbol}/{timeframe}. Статус: {response.status}. Параметры: {params}. Ответ: {await response.text()}")
+                return None
     except aiohttp.ClientConnectorError as e:
          logger.error(f"Ошибка соединения с API при запросе close {symbol}/{timeframe}: {e}")
          return None
@@ -569,37 +548,50 @@ async def get_close_prices(symbol: str, timeframe: str, limit: int = 1000, start
         logger.error(f"Исключение при запросе цен закрытия {symbol}/{timeframe}: {e}", exc_info=True)
         return None
 
+async def get_close_series(symbol: str, timeframe: str, limit: int = 1000, start_ts: int | None = None, end_ts: int | None = None) -> Candles | None:
+    """
+    Цены закрытия для графика. Берутся из колонки close полных свечей (общий кэш и один запрос к API
+    на пару), отдельный эндпоинт используется только при CLOSE_PRICES_ENDPOINT_FALLBACK.
+    """
+    candles = await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
+    if candles is not None or not CLOSE_PRICES_ENDPOINT_FALLBACK:
+        return candles
+    logger.warning(f"Свечи {symbol}/{timeframe} недоступны, пробуем эндпоинт цен закрытия.")
+    # Эндпоинт цен закрытия не режется на куски, поэтому не больше лимита API
+    return await get_close_prices(symbol, timeframe, limit=min(limit, 1000), start_ts=start_ts, end_ts=end_ts)
+
 @api_call_logger
+@api_flight.coalesce("latest")
 async def get_latest_candle(symbol: str, timeframe: str) -> dict | None:
-    url = f"{API_BASE_URL}/candles/latest/{symbol.lower()}/{timeframe}"
+    path = f"/candles/latest/{symbol.lower()}/{timeframe}"
+    url = api_client.url(path)
     logger.info(f"Запрос API (latest): {url}")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=API_AUTH_HEADER, timeout=15) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data and isinstance(data, dict):
-                        logger.info(f"API вернуло последнюю свечу для {symbol}/{timeframe}.")
-                        required_keys = ["timestamp", "open", "high", "low", "close", "volume"]
-                        if not all(k in data for k in required_keys):
-                             logger.warning(f"Последняя свеча для {symbol}/{timeframe} не содержит всех ключей: {data}. Заполняем нулями.")
-                             data.setdefault("timestamp", int(time.time() * 1000))
-                             data.setdefault("open", 0); data.setdefault("high", 0); data.setdefault("low", 0)
-                             data.setdefault("close", 0); data.setdefault("volume", 0)
-                        return data
-                    elif data is None:
-                         logger.warning(f"API вернуло null для последней свечи {symbol}/{timeframe}.")
-                         return None
-                    else:
-                         logger.error(f"API вернуло неожиданный тип для latest {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
-                         return None
-                elif response.status == 422:
-                     error_details = await response.json()
-                     logger.error(f"Ошибка валидации данных API (422) для latest {symbol}/{timeframe}. Детали: {error_details}")
+        async with api_client.get(path, endpoint="latest", timeout=15) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data and isinstance(data, dict):
+                    logger.info(f"API вернуло последнюю свечу для {symbol}/{timeframe}.")
+                    required_keys = ["timestamp", "open", "high", "low", "close", "volume"]
+                    if not all(k in data for k in required_keys):
+                         logger.warning(f"Последняя свеча для {symbol}/{timeframe} не содержит всех ключей: {data}. Заполняем нулями.")
+                         data.setdefault("timestamp", int(time.time() * 1000))
+                         data.setdefault("open", 0); data.setdefault("high", 0); data.setdefault("low", 0)
+                         data.setdefault("close", 0); data.setdefault("volume", 0)
+                    return data
+                elif data is None:
+                     logger.warning(f"API вернуло null для последней свечи {symbol}/{timeframe}.")
                      return None
                 else:
-                    logger.error(f"Ошибка API при запросе последней свечи {symbol}/{timeframe}. Статус: {response.status}. Ответ: {await response.text()}")
-                    return None
+                     logger.error(f"API вернуло неожиданный тип для latest {symbol}/{timeframe}. Тип: {type(data)}. Ответ: {data}")
+                     return None
+            elif response.status == 422:
+                 error_details = await response.json()
+                 logger.error(f"Ошибка валидации данных API (422) для latest {symbol}/{timeframe}. Детали: {error_details}")
+                 return None
+            else:
+                logger.error(f"Ошибка API при запросе последней свечи {symbol}/{timeframe}. Статус: {response.status}. Ответ: {await response.text()}")
+                return None
     except aiohttp.ClientConnectorError as e:
          logger.error(f"Ошибка соединения с API при запросе latest {symbol}/{timeframe}: {e}")
          return None
@@ -692,86 +684,134 @@ def access_check(handler):
     return wrapper
 
 # -------------------- Утилита для построения графиков --------------------
-@log_execution_time()
-async def plot_ohlcv_chart(candles: list[dict], symbol: str, timeframe: str, limit: int | None = None, date_range: str | None = None) -> str | None:
+# matplotlib работает в отдельных процессах, event loop только ждет готовую картинку. Пул запускается в main()
+chart_renderer = ChartRenderer()
+# Все графики идут через слоты очереди (единственное ограничение нагрузки на пул, слот на процесс):
+# быстрые раньше тяжелых, пользователи по кругу, лишние получают "занято"
+render_scheduler = RenderScheduler(slots=max(chart_renderer.workers, 1))
+RENDER_BUSY_TEXT = "⏳ Сейчас строится много графиков, попробуйте через минуту."
+# Графики отправляются из памяти; на диск (в LOGS_DIR) копия пишется только для отладки.
+# Формат и сжатие картинки - CHART_FORMAT в image_encoding.py
+CHART_DEBUG_SAVE = False
+# Чем рисовать свечи: "matplotlib" или "pillow" (легкий растровый вариант). Задается для всех запросов и отдельно для быстрых графиков
+OHLCV_RENDERER = "matplotlib"
+QUICK_CHART_RENDERER = "pillow"
+OHLCV_RENDERER_KINDS = {"matplotlib": "ohlcv", "pillow": "ohlcv_pillow"}
+QUICK_COMPARE_SYMBOLS = ("btcusdt", "ethusdt") # Пары кнопки сравнения в быстрых графиках
+
+# Одинаковые графики (та же пара, окно и последняя свеча) не рисуются и не загружаются повторно
+chart_cache = ChartCache()
+
+def save_debug_chart(image: EncodedImage, prefix: str):
+    debug_path = os.path.join(LOGS_DIR, f"{prefix}_{uuid.uuid4()}.{image.extension}")
+    try:
+        with open(debug_path, "wb") as f:
+            f.write(image.data)
+        logger.info(f"Отладочная копия графика сохранена: {debug_path}")
+    except OSError as e:
+        logger.error(f"Ошибка сохранения отладочной копии графика {debug_path}: {e}")
+
+async def render_cached_chart(kind: str, candles: Candles, symbol: str, timeframe: str, title: str, xlabel: str,
+                              extra: Callable[[], Awaitable[dict]] | None = None, series_edges: tuple[tuple[int, int], ...] | None = None,
+                              user_id: int = 0, priority: int = PRIORITY_NORMAL, **options) -> CachedChart | None:
+    """
+    options входят в ключ кэша; extra - доп. параметры отрисовки, не влияющие на картинку (считаются только при промахе).
+    series_edges - (первая, последняя метка) каждого ряда, если candles склеены из нескольких пар: входят в ключ,
+    а график живет до ближайшего закрытия последних свечей рядов.
+    Слот очереди отрисовки (user_id, priority) берется только на промахе кэша; RenderQueueFull - если очередь заполнена.
+    """
+    key = chart_cache.make_key(kind, symbol, timeframe, candles, title, *sorted(options.items()))
+    if series_edges is not None:
+        key += (series_edges,)
+    chart = chart_cache.get(key)
+    if chart is not None:
+        logger.info(f"График {symbol}/{timeframe} взят из кэша ({'file_id' if chart.file_id else f'{chart.size} байт'}).")
+        return chart
+    if extra is not None:
+        options.update(await extra())
+    async with render_scheduler.slot(user_id, priority):
+        image = await chart_renderer.render(kind, candles, title, xlabel, **options)
+    if image is None:
+        return None
+    logger.info(f"График {symbol}/{timeframe} ({kind}) построен: {image.format} {image.width}x{image.height}, "
+                f"{len(image)} байт, кодирование {image.encode_time * 1000:.1f} мс.")
+    if CHART_DEBUG_SAVE:
+        await asyncio.to_thread(save_debug_chart, image, "chart" if kind == "ohlcv" else f"{kind}_chart")
+    last_ts = tuple(last for _, last in series_edges) if series_edges is not None else int(candles.timestamp[-1])
+    return chart_cache.put(key, image, timeframe, last_ts)
+
+def chart_input_file(chart: CachedChart):
+    """Уже отправленный график шлется по file_id, новый - загружается из памяти."""
+    return chart.file_id or BufferedInputFile(chart.data, filename=chart.filename)
+
+def remember_chart_file_id(chart: CachedChart, sent: types.Message | None):
+    if sent is not None and sent.photo:
+        chart_cache.set_file_id(chart.key, sent.photo[-1].file_id)
+
+@log_execution_time(reraise=(RenderQueueFull,))
+async def plot_ohlcv_chart(candles: Candles, symbol: str, timeframe: str, limit: int | None = None, date_range: str | None = None, renderer: str | None = None,
+                           indicators: list[Indicator] | None = None, visible: int | None = None,
+                           user_id: int = 0, priority: int = PRIORITY_NORMAL) -> CachedChart | None:
+    """indicators рисуются поверх свечей; visible - сколько последних свечей показывать (остальные - история для индикаторов)."""
     logger.info(f"Создание OHLCV графика для {symbol}/{timeframe}...")
     if not candles:
         logger.warning("Нет данных для построения OHLCV графика.")
         return None
-    try:
-        plt.style.use('seaborn-v0_8-darkgrid')
-        fig, ax = plt.subplots(figsize=(12, 7))
-        timestamps = [c.get("timestamp", 0) for c in candles]
-        opens = [float(c.get("open", 0)) for c in candles]
-        highs = [float(c.get("high", 0)) for c in candles]
-        lows = [float(c.get("low", 0)) for c in candles]
-        closes = [float(c.get("close", 0)) for c in candles]
-        if not any(p > 0 for p in opens + highs + lows + closes):
-             logger.error("Все ценовые данные нулевые, график не может быть построен.")
-             plt.close(fig) # Закрываем фигуру
-             return None
-        candle_indices = range(len(timestamps))
-        colors = ['#26a69a' if closes[i] >= opens[i] else '#ef5350' for i in candle_indices]
-        ax.vlines(candle_indices, lows, highs, color='black', linewidth=0.8, alpha=0.7)
-        body_heights = [abs(opens[i] - closes[i]) for i in candle_indices]
-        body_bottoms = [min(opens[i], closes[i]) for i in candle_indices]
-        ax.bar(candle_indices, body_heights, bottom=body_bottoms, width=0.7, color=colors)
-        title = f"{symbol.upper()} - {timeframe} мин"
-        if limit: title += f" (Последние {limit} свечей)"
-        elif date_range: title += f" ({date_range})" # date_range уже должен быть экранирован, если нужно
-        ax.set_title(title, fontsize=14)
-        ax.set_ylabel("Цена (USDT)", fontsize=12)
-        ax.set_xticks([])
-        ax.set_xlabel(f"Свечи ({len(candles)} шт.)", fontsize=12)
-        ax.grid(True, linestyle='--', alpha=0.5)
-        chart_filename = f"chart_{uuid.uuid4()}.png"
-        chart_path = os.path.join(LOGS_DIR, chart_filename)
-        plt.savefig(chart_path, dpi=100, bbox_inches='tight')
-        plt.close(fig)
-        logger.info(f"OHLCV график сохранен: {chart_path}")
-        return chart_path
-    except Exception as e:
-        logger.error(f"Ошибка при создании OHLCV графика: {e}", exc_info=True)
-        if 'fig' in locals() and plt.fignum_exists(fig.number): plt.close(fig)
-        return None
-
-@log_execution_time()
-async def plot_close_price_chart(close_data: list[dict], symbol: str, timeframe: str, limit: int | None = None, date_range: str | None = None) -> str | None:
+    title = f"{symbol.upper()} - {timeframe} мин"
+    if limit: title += f" (Последние {limit} свечей)"
+    elif date_range: title += f" ({date_range})" # date_range уже должен быть экранирован, если нужно
+    kind = OHLCV_RENDERER_KINDS.get(renderer or OHLCV_RENDERER, "ohlcv")
+    options = {}
+    extra = None
+    if indicators:
+        kind = "ohlcv" # Индикаторы рисует только matplotlib-версия
+        options = {"indicators": tuple(map(str, indicators)), "visible": visible}
+
+        async def extra() -> dict:
+            return {"indicator_values": await streamed_indicator_values(candles, symbol, timeframe, indicators)}
+    shown = visible if visible is not None else len(candles)
+    return await render_cached_chart(kind, candles, symbol, timeframe, title, f"Свечи ({shown} шт.)", extra,
+                                     user_id=user_id, priority=priority, **options)
+
+async def streamed_indicator_values(candles: Candles, symbol: str, timeframe: str, indicators: list[Indicator]) -> dict:
+    """Линии индикаторов из потоков хранилища свечей; чего там нет - посчитает отрисовщик."""
+    values = {}
+    for indicator in indicators:
+        lines = await candle_store.indicator_values(symbol, timeframe, indicator, candles)
+        if lines is not None:
+            values[str(indicator)] = lines
+    return values
+
+@log_execution_time(reraise=(RenderQueueFull,))
+async def plot_close_price_chart(close_data: Candles, symbol: str, timeframe: str, limit: int | None = None, date_range: str | None = None,
+                                 user_id: int = 0, priority: int = PRIORITY_NORMAL) -> CachedChart | None:
     logger.info(f"Создание графика цен закрытия для {symbol}/{timeframe}...")
     if not close_data:
         logger.warning("Нет данных для построения графика цен закрытия.")
         return None
-    try:
-        prices = [float(item.get('close', 0)) for item in close_data]
-        timestamps = [item.get('timestamp', 0) for item in close_data]
-        if not prices or all(p == 0 for p in prices):
-             logger.error("Нет валидных цен закрытия для построения графика.")
-             return None
-        plt.style.use('seaborn-v0_8-darkgrid')
-        fig, ax = plt.subplots(figsize=(12, 7))
-        ax.plot(range(len(prices)), prices, linestyle='-', color='#2962ff')
-        title = f"{symbol.upper()} - Цены закрытия ({timeframe} мин)"
-        if limit: title += f" (Последние {limit} записей)"
-        elif date_range: title += f" ({date_range})" # date_range уже должен быть экранирован
-        ax.set_title(title, fontsize=14)
-        ax.set_ylabel("Цена (USDT)", fontsize=12)
-        ax.set_xticks([])
-        ax.set_xlabel(f"Записи ({len(prices)} шт.)", fontsize=12)
-        ax.grid(True, linestyle='--', alpha=0.5)
-        chart_filename = f"close_chart_{uuid.uuid4()}.png"
-        chart_path = os.path.join(LOGS_DIR, chart_filename)
-        plt.savefig(chart_path, dpi=100, bbox_inches='tight')
-        plt.close(fig)
-        logger.info(f"График цен закрытия сохранен: {chart_path}")
-        return chart_path
-    except TypeError as e:
-        logger.error(f"Ошибка типа данных при создании графика закрытий: {e}. Данные: {close_data[:5]}...", exc_info=True)
-        if 'fig' in locals() and plt.fignum_exists(fig.number): plt.close(fig)
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при создании графика цен закрытия: {e}", exc_info=True)
-        if 'fig' in locals() and plt.fignum_exists(fig.number): plt.close(fig)
+    title = f"{symbol.upper()} - Цены закрытия ({timeframe} мин)"
+    if limit: title += f" (Последние {limit} записей)"
+    elif date_range: title += f" ({date_range})" # date_range уже должен быть экранирован
+    return await render_cached_chart("close", close_data, symbol, timeframe, title, f"Записи ({len(close_data)} шт.)",
+                                     user_id=user_id, priority=priority)
+
+@log_execution_time(reraise=(RenderQueueFull,))
+async def plot_compare_chart(series: dict[str, Candles], timeframe: str, limit: int | None = None, date_range: str | None = None,
+                             user_id: int = 0, priority: int = PRIORITY_NORMAL) -> CachedChart | None:
+    """Пары из series на одном графике в процентах от начала окна (выравнивание по времени - в процессе отрисовки)."""
+    symbols = tuple(series)
+    logger.info(f"Создание графика сравнения {', '.join(symbols)}/{timeframe}...")
+    if len(symbols) < 2:
+        logger.warning("Для сравнения нужно хотя бы две пары с данными.")
         return None
+    title = f"{' / '.join(symbol.upper() for symbol in symbols)} - {timeframe} мин, изменение в %"
+    if limit: title += f" (Последние {limit} свечей)"
+    elif date_range: title += f" ({date_range})"
+    parts = list(series.values())
+    # Ключ и срок жизни - по краям каждой пары: у склейки последняя метка только от последней пары
+    edges = tuple((int(part.timestamp[0]), int(part.timestamp[-1])) for part in parts if len(part))
+    return await render_cached_chart("compare", Candles.concat(parts), ",".join(symbols), timeframe, title, f"Свечи ({max(map(len, parts))} шт.)",
+                                     series_edges=edges, user_id=user_id, priority=priority, symbols=symbols, lengths=tuple(map(len, parts)))
 
 # -------------------- Основное меню бота --------------------
 @log_execution_time()
@@ -779,14 +819,11 @@ async def show_main_menu(user_id: int, message_id: int | None = None):
     """Отображает или редактирует главное меню."""
     logger.info(f"Отображение главного меню для user_id: {user_id}")
 
-    btc_price_raw = description.BTC_PRICE
-    eth_price_raw = description.ETH_PRICE
-
-    menu_text = (
-        f"Меню {hbold('MK_OHLCV📉📈')}\n"
-        f"{hbold('BTC/USDT:')} {hcode(btc_price_raw)}$\n"
-        f"{hbold('ETH/USDT:')} {hcode(eth_price_raw)}$"
+    # Цены всех пар из description.TICKER_SYMBOLS
+    price_lines = "\n".join(
+        f"{hbold(description.format_pair(symbol) + ':')} {hcode(price)}$" for symbol, price in description.PRICES.items()
     )
+    menu_text = f"Меню {hbold('MK_OHLCV📉📈')}\n{price_lines}"
 
     # WebApp URL без параметров
     # full_webapp_url = WEBAPP_URL
@@ -915,18 +952,24 @@ async def process_data_request_callback(callback: types.CallbackQuery, state: FS
     # Экранируем примеры для MarkdownV2
     example1 = escape_markdown_v2("btcusdt 5 100")
     example2 = escape_markdown_v2("ethusdt 15 10:00 20.05.2023 12:30 21.05.2023")
+    example3 = escape_markdown_v2("btcusdt 15 500 ema20 rsi14")
+    example4 = escape_markdown_v2("cmp btcusdt,ethusdt,solusdt 60 500")
     timeframes_info = escape_markdown_v2("число минут (например, 1, 5, 15, 30, 60, 120, 240, D - день)")
-    limit_info = escape_markdown_v2("макс. 1000 свечей (для формата 1)")
+    limit_info = escape_markdown_v2(f"макс. 1000 свечей (для формата 1), до {MAX_RANGE_CANDLES} свечей в диапазоне дат")
     datetime_info = escape_markdown_v2("В UTC")
+    indicators_info = escape_markdown_v2("в конце любого формата: sma20, ema50, bb20 (Боллинджер), rsi14, vwap")
 
     prompt_text = (
         f"Введите запрос в одном из форматов:\n\n"
         f"1\\. `{example1}`\n\n"
         f"2\\. `{example2}`\n\n"
+        f"3\\. `{example4}` \\- сравнение до {MAX_COMPARE_SYMBOLS} пар в % \\(лимит или диапазон дат, как выше\\)\n\n"
         f"*Таймфреймы:* {timeframes_info}\\.\n"
         f"*Лимит:* {limit_info}\\.\n"
         f"*Даты/Время:* {datetime_info}\\."
     )
+    if action == "candles":
+        prompt_text += f"\n*Индикаторы:* {indicators_info}\\. Пример: `{example3}`"
 
     try:
         # Отправляем инструкцию новым сообщением
@@ -990,19 +1033,35 @@ async def process_query_input(message: types.Message, state: FSMContext):
     end_ts = None
     date_range_str = None # Для заголовка графика (уже без Markdown)
     date_range_caption_str = None # Для подписи (с Markdown)
+    indicators = [] # Индикаторы в конце запроса: ema20 rsi14 ...
+    symbols = [] # Пары запроса сравнения: cmp btcusdt,ethusdt,solusdt 60 500
 
+    compare = query_text.startswith("cmp ")
+    query_body = query_text[4:].strip() if compare else query_text
+    symbol_group = r"([a-z0-9]+(?:\s*,\s*[a-z0-9]+)*)" if compare else r"(\w+)"
+    indicators_tail = r"((?:\s+[a-z]+\d*)*)"
     date_range_pattern = re.compile(
-        r"(\w+)\s+"
+        symbol_group + r"\s+"
         r"([\w\d]+)\s+"
         r"(\d{1,2}:\d{2})\s+"
         r"(\d{1,2}[./-]\d{1,2}[./-]\d{2,4})\s+"
         r"(\d{1,2}:\d{2})\s+"
         r"(\d{1,2}[./-]\d{1,2}[./-]\d{2,4})"
+        + indicators_tail
     )
-    limit_pattern = re.compile(r"(\w+)\s+([\w\d]+)\s+(\d+)")
+    limit_pattern = re.compile(symbol_group + r"\s+([\w\d]+)\s+(\d+)" + indicators_tail)
 
-    match_date = date_range_pattern.fullmatch(query_text) # Используем fullmatch
-    match_limit = limit_pattern.fullmatch(query_text) # Используем fullmatch
+    match_date = date_range_pattern.fullmatch(query_body) # Используем fullmatch
+    match_limit = limit_pattern.fullmatch(query_body) # Используем fullmatch
+    match_query = match_date or match_limit
+    if match_query and match_query.group(match_query.re.groups).strip():
+        try:
+            indicators = parse_indicators(match_query.group(match_query.re.groups).split())
+        except ValueError as e:
+            logger.warning(f"Ошибка в индикаторах '{query_text}' от {safe_username_log} ({user_id}): {e}")
+            example = escape_markdown_v2("btcusdt 15 500 ema20 rsi14")
+            await message.answer(f"❌ Ошибка в индикаторах: {escape_markdown_v2(str(e))}\nПопробуйте еще раз\\. Пример: `{example}`", parse_mode="MarkdownV2")
+            return
 
     if match_date:
         logger.info("Обнаружен формат запроса с диапазоном дат.")
@@ -1036,7 +1095,12 @@ async def process_query_input(message: types.Message, state: FSMContext):
             # Формируем строки для заголовка (без markdown) и подписи (с markdown)
             date_range_str = f"{start_dt_naive.strftime('%d.%m.%y %H:%M')} - {end_dt_naive.strftime('%d.%m.%y %H:%M')} UTC"
             date_range_caption_str = escape_markdown_v2(date_range_str) # Экранируем для подписи
-            limit = 1000 # API все равно может вернуть меньше, если данных нет
+            # Весь диапазон целиком: хранилище само порежет его на запросы по 1000 свечей
+            limit = count_candles_in_range(timeframe, start_ts, end_ts) or 1000
+            if limit > MAX_RANGE_CANDLES:
+                logger.warning(f"Слишком длинный диапазон от {safe_username_log} ({user_id}): {limit} свечей {symbol}/{timeframe}.")
+                await message.answer(f"❌ Слишком длинный диапазон: {limit} свечей (максимум {MAX_RANGE_CANDLES}). Сократите период или возьмите таймфрейм побольше.")
+                return
 
         except ValueError as e:
             logger.error(f"Ошибка парсинга диапазона дат '{query_text}': {e}")
@@ -1074,58 +1138,93 @@ async def process_query_input(message: types.Message, state: FSMContext):
         logger.warning(f"Нераспознанный формат запроса от {safe_username_log} ({user_id}): '{query_text}'")
         example1_esc = escape_markdown_v2("символ таймфрейм лимит")
         example2_esc = escape_markdown_v2("символ таймфрейм ЧЧ:ММ ДД.ММ.ГГ ЧЧ:ММ ДД.ММ.ГГ")
+        example3_esc = escape_markdown_v2("cmp символ,символ,... таймфрейм лимит")
         await message.answer(
-            f"❌ Неверный формат запроса\\. Используйте:\n`{example1_esc}`\nили\n`{example2_esc}`\n\nПопробуйте еще раз\\.", parse_mode="MarkdownV2"
+            f"❌ Неверный формат запроса\\. Используйте:\n`{example1_esc}`\nили\n`{example2_esc}`\nили\n`{example3_esc}`\n\nПопробуйте еще раз\\.", parse_mode="MarkdownV2"
         )
         return
 
+    if compare:
+        symbols = list(dict.fromkeys(part.strip() for part in symbol.split(",")))
+        if not 2 <= len(symbols) <= MAX_COMPARE_SYMBOLS:
+            await message.answer(f"❌ Для сравнения нужно от 2 до {MAX_COMPARE_SYMBOLS} разных пар через запятую.")
+            return
+        symbol = ",".join(symbols)
+
     # --- Проверка символа ---
-    if symbol not in CRYPTO_LIST:
-        logger.warning(f"Неизвестный символ '{symbol}' от {safe_username_log} ({user_id})")
-        symbol_esc = escape_markdown_v2(symbol)
+    unknown_symbols = [item for item in (symbols or [symbol]) if item not in CRYPTO_LIST]
+    if unknown_symbols:
+        logger.warning(f"Неизвестный символ '{', '.join(unknown_symbols)}' от {safe_username_log} ({user_id})")
+        symbol_esc = escape_markdown_v2(", ".join(unknown_symbols))
         await message.answer(
             f"❌ Неизвестный символ: `{symbol_esc}`\\. Посмотрите доступные пары в меню \\(кнопка 'Список пар'\\)\\.", parse_mode="MarkdownV2"
         )
         return
 
+    if indicators and compare:
+        await message.answer("⚠️ На графике сравнения индикаторов нет, показываю его без них.")
+        indicators = []
+    elif indicators and action != "candles":
+        await message.answer("⚠️ Индикаторы строятся только на свечном графике, показываю цены закрытия без них.")
+        indicators = []
+
     # --- Выполнение запроса к API и построение графика ---
     await bot.send_chat_action(message.chat.id, "upload_photo")
-    chart_path = None
+    chart = None
     api_data = None
     caption = "" # Инициализация подписи
 
+    priority = render_priority(limit * len(symbols or [symbol]))
+
     try:
         symbol_upper_esc = escape_markdown_v2(symbol.upper())
         timeframe_esc = escape_markdown_v2(timeframe)
 
-        if action == "candles":
-            logger.info(f"Запрос свечей (get_candles) для {symbol}/{timeframe}, limit={limit}, start={start_ts}, end={end_ts}")
-            api_data = await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
-            if api_data:
+        if compare:
+            logger.info(f"Запрос сравнения (get_compare_candles) для {symbol}/{timeframe}, limit={limit}, start={start_ts}, end={end_ts}")
+            series = await get_compare_candles(symbols, timeframe, limit, start_ts, end_ts)
+            if len(series) > 1:
+                api_data = series
+                chart = await plot_compare_chart(series, timeframe, limit=None if start_ts else limit, date_range=date_range_str, user_id=user_id, priority=priority)
+                caption = f"⚖️ {escape_markdown_v2(' / '.join(item.upper() for item in series))} {timeframe_esc} мин, изменение в %"
+                if date_range_caption_str: caption += f"\n{date_range_caption_str}"
+                elif limit: caption += f"\nПоследние {limit} свечей"
+                missing = [item for item in symbols if item not in series]
+                if missing: caption += f"\nНет данных: {escape_markdown_v2(', '.join(item.upper() for item in missing))}"
+
+        elif action == "candles":
+            lookback = indicators_lookback(indicators)
+            logger.info(f"Запрос свечей (get_candles) для {symbol}/{timeframe}, limit={limit}, start={start_ts}, end={end_ts}, индикаторы: {indicators or 'нет'} (история {lookback})")
+            api_data, visible = await get_candles_with_history(symbol, timeframe, limit, start_ts, end_ts, lookback)
+            if api_data and visible != 0:
                  # Передаем date_range_str (без Markdown) в функцию графика для заголовка
-                 chart_path = await plot_ohlcv_chart(api_data, symbol, timeframe, limit=None if start_ts else limit, date_range=date_range_str)
+                 chart = await plot_ohlcv_chart(api_data, symbol, timeframe, limit=None if start_ts else limit, date_range=date_range_str, indicators=indicators, visible=visible,
+                                                user_id=user_id, priority=priority)
                  caption = f"🕯 {symbol_upper_esc} {timeframe_esc} мин"
                  if date_range_caption_str: caption += f"\n{date_range_caption_str}" # Используем экранированную строку
                  elif limit: caption += f"\nПоследние {limit} свечей"
+                 if indicators: caption += f"\n{escape_markdown_v2(', '.join(str(indicator).upper() for indicator in indicators))}"
 
         elif action == "close":
-            logger.info(f"Запрос цен закрытия (get_close_prices) для {symbol}/{timeframe}, limit={limit}, start={start_ts}, end={end_ts}")
-            api_data = await get_close_prices(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
+            logger.info(f"Запрос цен закрытия (get_close_series) для {symbol}/{timeframe}, limit={limit}, start={start_ts}, end={end_ts}")
+            api_data = await get_close_series(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
             if api_data:
-                chart_path = await plot_close_price_chart(api_data, symbol, timeframe, limit=None if start_ts else limit, date_range=date_range_str)
+                chart = await plot_close_price_chart(api_data, symbol, timeframe, limit=None if start_ts else limit, date_range=date_range_str, user_id=user_id, priority=priority)
                 caption = f"❌ {symbol_upper_esc} Цены закрытия ({timeframe_esc} мин)"
                 if date_range_caption_str: caption += f"\n{date_range_caption_str}"
                 elif limit: caption += f"\nПоследние {limit} записей"
 
         # --- Отправка результата ---
-        if chart_path:
-            logger.info(f"Отправка графика {chart_path} пользователю {safe_username_log} ({user_id})")
-            chart_file = FSInputFile(chart_path)
+        if chart:
+            logger.info(f"Отправка графика ({'file_id' if chart.file_id else f'{chart.size} байт'}) пользователю {safe_username_log} ({user_id})")
+            chart_file = chart_input_file(chart)
             try:
-                await message.answer_photo(chart_file, caption=caption, parse_mode="MarkdownV2")
+                sent = await message.answer_photo(chart_file, caption=caption, parse_mode="MarkdownV2")
+                remember_chart_file_id(chart, sent)
                 logger.info(f"График успешно отправлен {safe_username_log} ({user_id})")
             except TelegramAPIError as send_error:
                 logger.error(f"Ошибка отправки графика {safe_username_log} ({user_id}): {send_error}", exc_info=True)
+                chart_cache.discard(chart.key)
                 # Попробуем отправить без форматирования
                 try:
                     await message.answer_photo(chart_file, caption=re.sub(r'\\([_*\[\]()~`>#+\-=|{}.!])', r'\1', caption)) # Убираем экранирование
@@ -1133,15 +1232,15 @@ async def process_query_input(message: types.Message, state: FSMContext):
                 except Exception as fallback_send_error:
                      logger.error(f"Ошибка отправки графика без форматирования {safe_username_log} ({user_id}): {fallback_send_error}")
                      await message.answer("❌ Не удалось отправить график.")
-            finally:
-                try: os.remove(chart_path); logger.info(f"Временный файл графика {chart_path} удален.")
-                except OSError as remove_error: logger.error(f"Ошибка удаления файла графика {chart_path}: {remove_error}")
-        elif api_data is not None and not chart_path:
+        elif api_data is not None and not chart:
              await message.answer("⚠️ Не удалось построить график для полученных данных.")
         else: # api_data is None
              symbol_tf_esc = escape_markdown_v2(f"{symbol.upper()}/{timeframe}")
              await message.answer(f"❌ Не удалось получить данные от API для `{symbol_tf_esc}`\\. Попробуйте позже или проверьте параметры запроса\\.", parse_mode="MarkdownV2")
 
+    except RenderQueueFull as e:
+        logger.warning(f"Очередь отрисовки: график для {safe_username_log} ({user_id}) отклонен ({e}).")
+        await message.answer(RENDER_BUSY_TEXT)
     except Exception as e:
         logger.error(f"Общая ошибка при обработке запроса и отправке графика для {safe_username_log} ({user_id}): {e}", exc_info=True)
         await message.answer("❌ Произошла непредвиденная ошибка при обработке вашего запроса.")
@@ -1234,6 +1333,25 @@ async def back_to_main_menu(callback: types.CallbackQuery, state: FSMContext):
 
 
 # -------------------- Быстрые графики (FSM: QuickChartState) --------------------
+async def quick_chart(user_id: int, symbol: str, timeframe: str, limit: int, start_ts: int | None = None, end_ts: int | None = None,
+                      date_range: str | None = None) -> tuple[CachedChart | None, int]:
+    """
+    Быстрый график пары или сравнение пар (symbol вида "btcusdt,ethusdt"), в очереди отрисовки - с высшим приоритетом.
+    Второе значение - сколько свечей получено, 0 - данных нет. RenderQueueFull, если очередь заполнена.
+    """
+    priority = render_priority(limit, quick=True)
+    if "," in symbol:
+        series = await get_compare_candles(symbol.split(","), timeframe, limit, start_ts, end_ts)
+        if len(series) < 2:
+            return None, 0
+        count = max(map(len, series.values()))
+        return await plot_compare_chart(series, timeframe, limit=count if start_ts is not None else limit, date_range=date_range,
+                                        user_id=user_id, priority=priority), count
+    candles = await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
+    if not candles:
+        return None, 0
+    return await plot_ohlcv_chart(candles, symbol, timeframe, limit=len(candles) if start_ts is not None else limit,
+                                  date_range=date_range, renderer=QUICK_CHART_RENDERER, user_id=user_id, priority=priority), len(candles)
 
 @dp.callback_query(F.data == "quick_charts")
 @access_check
@@ -1248,6 +1366,8 @@ async def quick_charts_start(callback: types.CallbackQuery, state: FSMContext):
     keyboard = [
         [types.InlineKeyboardButton(text="BTC/USDT", callback_data="qc_symbol_btcusdt"),
          types.InlineKeyboardButton(text="ETH/USDT", callback_data="qc_symbol_ethusdt")],
+        [types.InlineKeyboardButton(text=f"⚖️ Сравнение {' / '.join(map(description.format_pair, QUICK_COMPARE_SYMBOLS))}",
+                                    callback_data=f"qc_symbol_{','.join(QUICK_COMPARE_SYMBOLS)}")],
         [types.InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_main")]
     ]
     markup = types.InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1332,11 +1452,10 @@ async def quick_charts_process_latest(callback: types.CallbackQuery, state: FSMC
     await callback.answer(f"Загружаю последние {limit} свечей для {symbol.upper()} {timeframe} мин...")
     await bot.send_chat_action(user_id, "upload_photo")
 
-    chart_path = None
+    chart = None
     try:
-        candles = await get_candles(symbol, timeframe, limit=limit)
-        if candles:
-            chart_path = await plot_ohlcv_chart(candles, symbol, timeframe, limit=limit)
+        chart, count = await quick_chart(user_id, symbol, timeframe, limit)
+        if count:
             caption = f"🚀 Быстрый график: {symbol.upper()} {timeframe} мин\nПоследние {limit} свечей"
         else:
             symbol_tf_esc = escape_markdown_v2(f"{symbol.upper()}/{timeframe}")
@@ -1348,26 +1467,28 @@ async def quick_charts_process_latest(callback: types.CallbackQuery, state: FSMC
             except: pass # Игнорируем ошибку, если сообщение уже удалено или изменилось
             return
 
-        if chart_path:
-            logger.info(f"Отправка быстрого графика (latest) {chart_path} пользователю {safe_username_log} ({user_id})")
-            chart_file = FSInputFile(chart_path)
+        if chart:
+            logger.info(f"Отправка быстрого графика (latest, {'file_id' if chart.file_id else f'{chart.size} байт'}) пользователю {safe_username_log} ({user_id})")
+            chart_file = chart_input_file(chart)
             try:
                  kb = [[types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_to_main")]]
                  mk = types.InlineKeyboardMarkup(inline_keyboard=kb)
                  # Отправляем новым сообщением
-                 await bot.send_photo(user_id, chart_file, caption=caption, reply_markup=mk)
+                 sent = await bot.send_photo(user_id, chart_file, caption=caption, reply_markup=mk)
+                 remember_chart_file_id(chart, sent)
                  logger.info(f"Быстрый график (latest) успешно отправлен {safe_username_log} ({user_id})")
                  # Удаляем предыдущее сообщение с кнопками выбора типа
                  try: await callback.message.delete()
                  except Exception as e: logger.debug(f"Не удалось удалить сообщение с кнопками выбора типа: {e}")
             except TelegramAPIError as send_error:
                 logger.error(f"Ошибка отправки быстрого графика (latest) {safe_username_log} ({user_id}): {send_error}", exc_info=True)
+                chart_cache.discard(chart.key)
                 await callback.message.answer("❌ Не удалось отправить график.") # Отправляем в чат
-            finally:
-                try: os.remove(chart_path); logger.info(f"Временный файл графика {chart_path} удален.")
-                except OSError as remove_error: logger.error(f"Ошибка удаления файла графика {chart_path}: {remove_error}")
         # else: # Ошибка получения данных обработана выше
 
+    except RenderQueueFull as e:
+        logger.warning(f"Очередь отрисовки: быстрый график (latest) для {safe_username_log} ({user_id}) отклонен ({e}).")
+        await callback.message.answer(RENDER_BUSY_TEXT)
     except Exception as e:
         logger.error(f"Ошибка при обработке 'latest' для быстрых графиков {safe_username_log} ({user_id}): {e}", exc_info=True)
         await callback.message.answer("❌ Произошла непредвиденная ошибка.") # Отправляем в чат
@@ -1465,39 +1586,39 @@ async def quick_charts_process_period_input(message: types.Message, state: FSMCo
         # Используем HTML для сообщения о загрузке
         await message.answer(f"Загружаю данные для <b>{symbol.upper()} {timeframe} мин</b> за период {start_hour:02d}:{start_minute:02d} - {end_hour:02d}:{end_minute:02d} UTC...", parse_mode="HTML")
 
-        chart_path = None
+        chart = None
         # date_range_str для заголовка графика (без Markdown)
         date_range_str = f"Сегодня {start_hour:02d}:{start_minute:02d} - {end_hour:02d}:{end_minute:02d} UTC"
         try:
             # Запрашиваем с лимитом 1000, API вернет свечи только в указанном диапазоне start_ts/end_ts
-            candles = await get_candles(symbol, timeframe, limit=limit, start_ts=start_ts, end_ts=end_ts)
-            if candles:
-                 # Используем date_range_str для заголовка, limit для информации
-                 chart_path = await plot_ohlcv_chart(candles, symbol, timeframe, limit=len(candles), date_range=date_range_str)
+            chart, count = await quick_chart(user_id, symbol, timeframe, limit, start_ts, end_ts, date_range=date_range_str)
+            if count:
                  # Формируем подпись без Markdown V2
-                 caption = f"🚀 Быстрый график: {symbol.upper()} {timeframe} мин\n{date_range_str}\n({len(candles)} свечей)"
+                 caption = f"🚀 Быстрый график: {symbol.upper()} {timeframe} мин\n{date_range_str}\n({count} свечей)"
             else:
                  symbol_tf_esc = escape_markdown_v2(f"{symbol.upper()}/{timeframe}")
                  await message.answer(f"❌ Не удалось получить данные от API для `{symbol_tf_esc}` за указанный период\\.", parse_mode="MarkdownV2")
                  await state.clear(); await show_main_menu(user_id); return
 
-            if chart_path:
-                logger.info(f"Отправка быстрого графика (period) {chart_path} пользователю {safe_username_log} ({user_id})")
-                chart_file = FSInputFile(chart_path)
+            if chart:
+                logger.info(f"Отправка быстрого графика (period, {'file_id' if chart.file_id else f'{chart.size} байт'}) пользователю {safe_username_log} ({user_id})")
+                chart_file = chart_input_file(chart)
                 try:
                      kb = [[types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_to_main")]]
                      mk = types.InlineKeyboardMarkup(inline_keyboard=kb)
-                     await message.answer_photo(chart_file, caption=caption, reply_markup=mk) # Отправляем без parse_mode
+                     sent = await message.answer_photo(chart_file, caption=caption, reply_markup=mk) # Отправляем без parse_mode
+                     remember_chart_file_id(chart, sent)
                      logger.info(f"Быстрый график (period) успешно отправлен {safe_username_log} ({user_id})")
                 except TelegramAPIError as send_error:
                     logger.error(f"Ошибка отправки быстрого графика (period) {safe_username_log} ({user_id}): {send_error}", exc_info=True)
+                    chart_cache.discard(chart.key)
                     await message.answer("❌ Не удалось отправить график.")
-                finally:
-                    try: os.remove(chart_path); logger.info(f"Временный файл графика {chart_path} удален.")
-                    except OSError as remove_error: logger.error(f"Ошибка удаления файла графика {chart_path}: {remove_error}")
-            elif candles: # Данные есть, но график не построился
+            elif count: # Данные есть, но график не построился
                  await message.answer("⚠️ Не удалось построить график для полученных данных.")
 
+        except RenderQueueFull as e:
+             logger.warning(f"Очередь отрисовки: быстрый график (period) для {safe_username_log} ({user_id}) отклонен ({e}).")
+             await message.answer(RENDER_BUSY_TEXT)
         except Exception as e:
              logger.error(f"Ошибка при обработке 'period' для быстрых графиков {safe_username_log} ({user_id}): {e}", exc_info=True)
              await message.answer("❌ Произошла непредвиденная ошибка.")
@@ -1558,7 +1679,8 @@ async def show_admin_panel(user_id: int, message_id: int | None = None):
         [types.InlineKeyboardButton(text="➖ Удалить из WL", callback_data="admin_remove_wl"),
          types.InlineKeyboardButton(text="❌ Забанить", callback_data="admin_ban"),
          types.InlineKeyboardButton(text="✅ Разбанить", callback_data="admin_unban")],
-        [types.InlineKeyboardButton(text=f"WL: {'ВКЛ ✅' if WHITELIST_ENABLED else 'ВЫКЛ ❌'}", callback_data="admin_toggle_whitelist")],
+        [types.InlineKeyboardButton(text=f"WL: {'ВКЛ ✅' if WHITELIST_ENABLED else 'ВЫКЛ ❌'}", callback_data="admin_toggle_whitelist"),
+         types.InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
         [types.InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_main")]
     ]
     markup = types.InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1662,6 +1784,59 @@ async def admin_download_log(callback: types.CallbackQuery):
         await callback.message.answer(f"❌ Лог\\-файл не найден: `{filename_esc}`", parse_mode="MarkdownV2")
 
 
+@dp.callback_query(F.data == "admin_stats")
+@admin_only
+@log_execution_time()
+async def admin_show_stats(callback: types.CallbackQuery):
+    logger.info(f"Админ {callback.from_user.id} запросил статистику.")
+    cache_stats = candle_store.stats()
+    stream_stats = candle_store.indicators.stats()
+    flight_stats = api_flight.stats()
+    client_stats = api_client.stats()
+    render_stats = chart_renderer.stats()
+    queue_stats = render_scheduler.stats()
+    chart_stats = chart_cache.stats()
+    text = (
+        "📊 <b>Статистика</b>\n\n"
+        "<b>Хранилище свечей:</b>\n"
+        f"Рядов: {hcode(cache_stats['series'])}, свечей: {hcode(cache_stats['candles'])} / {hcode(cache_stats['max_candles'])}\n"
+        f"Попаданий: {hcode(cache_stats['hits'])}, частичных: {hcode(cache_stats['partial_hits'])}, промахов: {hcode(cache_stats['misses'])} ({cache_stats['hit_rate']:.1%})\n"
+        f"Поднято с диска: {hcode(cache_stats['disk_hits'])}\n"
+        f"Свечей скачано: {hcode(cache_stats['candles_fetched'])}, отдано: {hcode(cache_stats['candles_served'])}, собрано из мелкого ТФ: {hcode(cache_stats['resampled'])}\n"
+        f"Вытеснений: {hcode(cache_stats['evictions'])}\n"
+        f"Потоки индикаторов: {hcode(stream_stats['streams'])}, отдано: {hcode(stream_stats['served'])}, "
+        f"пересчетов: {hcode(stream_stats['rebuilds'])}, пакетно: {hcode(stream_stats['fallbacks'])}, свечей по одной: {hcode(stream_stats['appended'])}\n\n"
+        "<b>Запросы к API:</b>\n"
+        f"Отправлено: {hcode(flight_stats['started'])}, склеено: {hcode(flight_stats['coalesced'])}, в полете: {hcode(flight_stats['inflight'])}\n"
+        f"В очереди лимитера: {hcode(client_stats['queued'])}, приторможено: {hcode(client_stats['throttled'])} ({client_stats['wait_time']:.1f} сек)\n"
+        f"Повторов: {hcode(client_stats['retried'])}, исчерпали попытки: {hcode(client_stats['gave_up'])}\n\n"
+        "<b>Отрисовка графиков:</b>\n"
+        f"Процессов: {hcode(render_stats['workers'])}, рисуется: {hcode(render_stats['pending'])}, нарисовано: {hcode(render_stats['rendered'])} (в среднем {render_stats['avg_render_time']:.2f} сек)\n"
+        f"Размер в среднем: {hcode(render_stats['avg_bytes'] // 1024)} КБ, кодирование {render_stats['avg_encode_time'] * 1000:.1f} мс\n"
+        f"Таймаутов: {hcode(render_stats['timeouts'])}, ошибок: {hcode(render_stats['failed'])}\n\n"
+        "<b>Очередь отрисовки:</b>\n"
+        f"Слотов: {hcode(queue_stats['in_flight'])} / {hcode(queue_stats['slots'])}, ждут: {hcode(queue_stats['queued'])} / {hcode(queue_stats['max_queue'])} "
+        f"(по приоритетам {hcode(queue_stats['queued_by_priority'])}), максимум: {hcode(queue_stats['max_depth'])}\n"
+        f"Обслужено: {hcode(queue_stats['served'])}, ждали: {hcode(queue_stats['queued_total'])}, "
+        f"ожидание в среднем {queue_stats['avg_wait']:.2f} сек, p95 {queue_stats['p95_wait']:.2f}, макс. {queue_stats['max_wait']:.2f}\n"
+        f"Отказов \"занято\": {hcode(queue_stats['rejected'])}, по лимиту пользователя: {hcode(queue_stats['rejected_user'])}\n\n"
+        "<b>Списки доступа:</b>\n"
+        f"Whitelist: {hcode(len(whitelist_index))}, banlist: {hcode(len(banlist_index))}, загрузок файлов: {hcode(whitelist_index.reloads + banlist_index.reloads)}\n\n"
+        "<b>Кэш графиков:</b>\n"
+        f"Записей: {hcode(chart_stats['entries'])}, {hcode(chart_stats['bytes'] // 1024)} / {hcode(chart_stats['max_bytes'] // 1024)} КБ\n"
+        f"По file_id: {hcode(chart_stats['file_id_hits'])}, с загрузкой: {hcode(chart_stats['upload_hits'])}, промахов: {hcode(chart_stats['misses'])} ({chart_stats['hit_rate']:.1%})\n"
+        f"Устарело: {hcode(chart_stats['expired'])}, вытеснено: {hcode(chart_stats['evictions'])}"
+    )
+    kb = [[types.InlineKeyboardButton(text="🔙 Назад в админку", callback_data="admin_panel")]]
+    markup = types.InlineKeyboardMarkup(inline_keyboard=kb)
+    try:
+        await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.error(f"Ошибка отображения статистики: {e}")
+    await callback.answer()
+
+
 # -------------------- Админские действия: Управление пользователями --------------------
 
 @dp.callback_query(F.data == "admin_remove_wl")
@@ -1930,7 +2105,11 @@ async def admin_process_remove_ref(message: types.Message, state: FSMContext):
 
 # -------------------- Запуск бота --------------------
 async def main():
+    global api_client
     logger.info("--- Инициализация бота ---")
+    chart_renderer.start() # Первым, пока в процессе нет сессий и фоновых задач
+    api_client = ApiClient(API_BASE_URL, API_AUTH_HEADER)
+    await api_client.start()
     if not await check_api_auth():
         logger.critical("ОШИБКА: Не удалось подключиться или авторизоваться в API. Бот может работать некорректно.")
 
@@ -1938,7 +2117,7 @@ async def main():
 
     # Запуск фоновой задачи обновления описания
     description_task = asyncio.create_task(
-        description.run_description_updater(bot, API_BASE_URL, API_AUTH_HEADER)
+        description.run_description_updater(bot, api_client)
     )
 
     logger.info("--- Запуск поллинга ---")
@@ -1952,6 +2131,8 @@ async def main():
              description_task.cancel()
              try: await description_task # Ждем завершения задачи
              except asyncio.CancelledError: logger.info("Задача обновления описания отменена.")
+         await api_client.close()
+         chart_renderer.close()
          await bot.session.close()
          logger.info("Сессия бота закрыта.")
 
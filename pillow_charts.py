@@ -0,0 +1,107 @@
+import os
+import math
+
+import matplotlib
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from candles import Candles
+from downsample import ohlc_buckets
+from image_encoding import CHART_FORMAT, EncodedImage, encode_image, chart_dpi
+
+# -------------------- Легкий свечной график на Pillow --------------------
+# Размер как у matplotlib-графика (12x7 дюймов при 100 dpi) и похожая палитра seaborn-darkgrid.
+# Для коротких рядов картинка, поля и шрифты уменьшаются так же, как dpi у matplotlib (chart_dpi)
+IMAGE_SIZE = (1200, 700)
+MARGINS = (20, 60, 100, 50) # слева, сверху (заголовок), справа (цены), снизу (подпись)
+BACKGROUND = (255, 255, 255)
+PLOT_BACKGROUND = (234, 234, 242)
+GRID_COLOR = (255, 255, 255)
+TEXT_COLOR = (30, 30, 30)
+WICK_COLOR = (77, 77, 77)
+UP_COLOR = (38, 166, 154)
+DOWN_COLOR = (239, 83, 80)
+BODY_WIDTH = 0.7 # Доля шага свечи
+PRICE_TICKS = 8 # Примерное число делений шкалы цен
+
+_fonts: dict[int, ImageFont.ImageFont] = {}
+
+
+def _font(size: int) -> ImageFont.ImageFont:
+    """DejaVu Sans из поставки matplotlib (есть кириллица); если его нет - встроенный шрифт Pillow."""
+    font = _fonts.get(size)
+    if font is None:
+        path = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans.ttf")
+        try:
+            font = ImageFont.truetype(path, size)
+        except OSError:
+            font = ImageFont.load_default(size)
+        _fonts[size] = font
+    return font
+
+
+def nice_ticks(low: float, high: float, count: int = PRICE_TICKS) -> np.ndarray:
+    """Круглые значения шкалы (шаг 1, 2, 2.5 или 5 x 10^k) внутри [low, high]."""
+    span = high - low
+    if span <= 0:
+        return np.array([low])
+    raw_step = span / max(count, 1)
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw_step)
+    return np.arange(math.ceil(low / step) * step, high + step * 1e-9, step)
+
+
+def format_price(value: float, step: float) -> str:
+    decimals = max(0, -math.floor(math.log10(step))) if step > 0 else 2
+    return f"{value:,.{min(decimals, 8)}f}".replace(",", " ")
+
+
+def render_ohlcv_pillow_png(candles: Candles, title: str, xlabel: str, max_candles: int | None = None,
+                            format: str = CHART_FORMAT) -> EncodedImage | None:
+    """Свечной график без matplotlib: координаты считаются numpy, рисуется прямо в изображение Pillow."""
+    if not len(candles):
+        return None
+    scale = chart_dpi(len(candles), IMAGE_SIZE[0] / 100) / 100
+    width, height = (round(side * scale) for side in IMAGE_SIZE)
+    left, top, right, bottom = (round(margin * scale) for margin in MARGINS)
+    plot_w, plot_h = width - left - right, height - top - bottom
+    # Свеча уже пикселя не видна: сжимаем ряд до ширины области графика
+    candles = ohlc_buckets(candles, min(max_candles or plot_w, plot_w))
+    lows, highs = candles.low, candles.high
+    if not (highs > 0).any():
+        return None
+    price_low, price_high = float(lows.min()), float(highs.max())
+    pad = (price_high - price_low) * 0.05 or abs(price_high) * 0.01 or 1.0
+    price_low, price_high = price_low - pad, price_high + pad
+
+    def to_y(prices: np.ndarray) -> np.ndarray:
+        return top + (price_high - prices) / (price_high - price_low) * plot_h
+
+    image = Image.new("RGB", (width, height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([left, top, left + plot_w, top + plot_h], fill=PLOT_BACKGROUND)
+
+    # Сетка и подписи шкалы цен справа
+    ticks = nice_ticks(price_low, price_high)
+    step = float(ticks[1] - ticks[0]) if len(ticks) > 1 else 0.0
+    label_font = _font(round(12 * scale))
+    for value, y in zip(ticks.tolist(), to_y(ticks).tolist()):
+        draw.line([(left, y), (left + plot_w, y)], fill=GRID_COLOR, width=1)
+        draw.text((left + plot_w + 8 * scale, y), format_price(value, step), fill=TEXT_COLOR, font=label_font, anchor="lm")
+
+    # Свечи: координаты всех тел и теней сразу
+    n = len(candles)
+    slot = plot_w / n
+    centers = left + (np.arange(n) + 0.5) * slot
+    half_body = max(slot * BODY_WIDTH / 2, 0.5)
+    body_top = to_y(np.maximum(candles.open, candles.close))
+    body_bottom = to_y(np.minimum(candles.open, candles.close))
+    wick_top, wick_bottom = to_y(highs), to_y(lows)
+    up = (candles.close >= candles.open).tolist()
+    for x, wt, wb, bt, bb, is_up in zip(centers.tolist(), wick_top.tolist(), wick_bottom.tolist(), body_top.tolist(), body_bottom.tolist(), up):
+        draw.rectangle([x - half_body, bt, x + half_body, max(bb, bt + 1)], fill=UP_COLOR if is_up else DOWN_COLOR)
+        draw.line([(x, wt), (x, wb)], fill=WICK_COLOR, width=1) # Тень поверх тела, как у matplotlib-версии
+
+    draw.text((left + plot_w / 2, top / 2), title, fill=TEXT_COLOR, font=_font(round(18 * scale)), anchor="mm")
+    draw.text((left + plot_w / 2, top + plot_h + bottom / 2), xlabel, fill=TEXT_COLOR, font=_font(round(14 * scale)), anchor="mm")
+    return encode_image(image, format)
@@ -0,0 +1,149 @@
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+# -------------------- Очередь отрисовки --------------------
+# Стоит между хэндлерами и построением графиков: число графиков в работе ограничено слотами,
+# ожидающих - общей очередью и лимитом на пользователя. Дешевые графики идут раньше тяжелых,
+# внутри одного приоритета пользователи обслуживаются по кругу (по одному графику за раз)
+RENDER_QUEUE_SIZE = 16 # Сколько графиков всего может ждать слота, сверх этого - ответ "занято"
+RENDER_QUEUE_PER_USER = 2 # Сколько графиков одного пользователя может ждать одновременно
+PRIORITY_QUICK = 0 # Быстрые графики
+PRIORITY_NORMAL = 1
+PRIORITY_LARGE = 2 # Длинные диапазоны
+LARGE_RENDER_CANDLES = 5000 # С какого числа свечей (по всем парам запроса) график считается тяжелым
+WAIT_SAMPLES = 512 # Сколько последних ожиданий хранить для перцентиля
+
+
+class RenderQueueFull(Exception):
+    """Очередь отрисовки (общая или пользователя) заполнена."""
+
+
+def render_priority(candles: int, quick: bool = False) -> int:
+    if quick:
+        return PRIORITY_QUICK
+    return PRIORITY_LARGE if candles >= LARGE_RENDER_CANDLES else PRIORITY_NORMAL
+
+
+class RenderScheduler:
+    """
+    Слоты отрисовки с приоритетной очередью: async with scheduler.slot(user_id, priority) ждет своей очереди
+    и держит слот до выхода из блока. RenderQueueFull - если ждать негде (вызывающий отвечает "занято").
+    """
+    def __init__(self, slots: int, max_queue: int = RENDER_QUEUE_SIZE, max_per_user: int = RENDER_QUEUE_PER_USER):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.in_flight = 0
+        self._waiting: dict[int, OrderedDict[int, deque[asyncio.Future]]] = {} # Приоритет -> пользователь -> ожидающие
+        self._queued = 0
+        self._queued_by_user: dict[int, int] = {}
+        self._waits: deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.served = 0
+        self.queued_total = 0 # Сколько графиков ждали слота (остальные получили его сразу)
+        self.rejected = 0 # Общая очередь заполнена
+        self.rejected_user = 0 # Лимит пользователя
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, priority: int = PRIORITY_NORMAL):
+        start = time.perf_counter()
+        if self.in_flight < self.slots and not self._queued:
+            self.in_flight += 1
+        else:
+            await self._wait(user_id, priority)
+        self._record_wait(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    async def _wait(self, user_id: int, priority: int):
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise RenderQueueFull(f"очередь заполнена ({self._queued}/{self.max_queue})")
+        if self._queued_by_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected_user += 1
+            raise RenderQueueFull(f"у пользователя уже {self.max_per_user} графиков в очереди")
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(priority, OrderedDict()).setdefault(user_id, deque()).append(future)
+        self._queued += 1
+        self._queued_by_user[user_id] = self._queued_by_user.get(user_id, 0) + 1
+        self.queued_total += 1
+        self.max_depth = max(self.max_depth, self._queued)
+        try:
+            await future # Слот уже засчитан в in_flight тем, кто его освободил (_dispatch)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.in_flight -= 1 # Слот выдан, но задача отменена раньше, чем его заняла
+                self._dispatch()
+            else:
+                self._forget(priority, user_id, future)
+            raise
+
+    def _forget(self, priority: int, user_id: int, future: asyncio.Future):
+        """Убирает из очереди ожидающего, которого отменили."""
+        users = self._waiting.get(priority, {})
+        queue = users.get(user_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del users[user_id]
+            self._dequeued(user_id)
+
+    def _dequeued(self, user_id: int):
+        self._queued -= 1
+        left = self._queued_by_user[user_id] - 1
+        if left:
+            self._queued_by_user[user_id] = left
+        else:
+            del self._queued_by_user[user_id]
+
+    def _dispatch(self):
+        """Свободные слоты - следующим: самый срочный приоритет, в нем - пользователь, дольше всех ждущий своей очереди."""
+        while self.in_flight < self.slots and self._queued:
+            priority = min(priority for priority, users in self._waiting.items() if users)
+            users = self._waiting[priority]
+            user_id, queue = next(iter(users.items()))
+            future = queue.popleft()
+            if queue:
+                users.move_to_end(user_id) # Следующий график этого пользователя - после остальных
+            else:
+                del users[user_id]
+            self._dequeued(user_id)
+            if future.done(): # Отменен, пока ждал
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _record_wait(self, wait: float):
+        self.served += 1
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._waits.append(wait)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "queued_by_priority": {priority: sum(map(len, users.values())) for priority, users in sorted(self._waiting.items())},
+            "max_queue": self.max_queue,
+            "max_depth": self.max_depth,
+            "served": self.served,
+            "queued_total": self.queued_total,
+            "rejected": self.rejected,
+            "rejected_user": self.rejected_user,
+            "avg_wait": self.wait_time / self.served if self.served else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max_wait": self.max_wait,
+        }
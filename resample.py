@@ -0,0 +1,31 @@
+import numpy as np
+
+from candles import Candles
+
+
+def can_resample(base_timeframe_ms: int, timeframe_ms: int) -> bool:
+    """Можно ли собрать таймфрейм из базового: он крупнее и делится на базовый без остатка."""
+    return timeframe_ms > base_timeframe_ms and timeframe_ms % base_timeframe_ms == 0
+
+
+def resample_ohlcv(candles: Candles, timeframe_ms: int) -> Candles:
+    """
+    Собирает свечи крупного таймфрейма из отсортированных свечей мелкого (векторно, numpy).
+    Корзины выровнены по границам UTC: open - первый, high - максимум, low - минимум,
+    close - последний, volume - сумма. Неполная последняя корзина - это текущая свеча.
+    """
+    if not len(candles):
+        return Candles.empty()
+    buckets = candles.timestamp // timeframe_ms * timeframe_ms
+    # Индексы начала каждой корзины в отсортированном ряду
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(candles)] - 1
+
+    return Candles(
+        buckets[starts],
+        candles.open[starts],
+        np.maximum.reduceat(candles.high, starts),
+        np.minimum.reduceat(candles.low, starts),
+        candles.close[ends],
+        np.add.reduceat(candles.volume, starts),
+    )